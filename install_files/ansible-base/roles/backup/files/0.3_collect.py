@@ -5,34 +5,232 @@ This script should be copied to the App server and ran by the anisble
 plabook. When run (as root), it collects all of the necessary information
 to backup the 0.3 system and stores it in /tmp/sd-backup-0.3-TIME_STAMP.zip.gpg
 
+The zip archive is streamed straight into gpg as it is written, so no
+plaintext copy of the backup is ever written to disk and the data root is
+only read once.
+
+With --incremental, only the files in SECUREDROP_DATA_ROOT that are new or
+have changed since the last backup are archived. Every backup includes a
+manifest (path, size, mtime and SHA-256 of each file in the data root) that
+is also kept on the server, so the next incremental backup can tell what
+changed. A file whose content was already backed up under another path
+(e.g. a renamed submission) is recorded as a copy instead of being archived
+again. 0.3_restore.py restores a full backup followed by its increments.
+
+    python 0.3_collect.py [--incremental] [--manifest PATH]
+
 """
 
 import sys
 import os
 import re
+import hashlib
+import json
+import struct
+import time
 import zipfile
+import zlib
+from argparse import ArgumentParser
 from datetime import datetime
 import functools
 # Import the application config.py file
 sys.path.append("/var/www/securedrop")
 import config
-import gnupg
 import subprocess
 
 TOR_SERVICES = "/var/lib/tor/services"
 TOR_CONFIG = "/etc/tor/torrc"
 
+# Size of the chunks read from each file. Only one chunk is held in memory
+# at a time.
+CHUNK_SIZE = 64 * 1024
+
+# Name of the manifest in the backup archive
+MANIFEST_ARCNAME = "sd-backup-manifest.json"
+# Where the manifest of the last successful backup is kept on the server
+DEFAULT_MANIFEST_PATH = os.path.join(
+    os.path.dirname(config.SECUREDROP_DATA_ROOT.rstrip('/')),
+    "securedrop-backup-manifest.json")
+
+
+class TellableWriter(object):
+    """Wraps a write-only stream (such as a pipe) and keeps track of the
+    number of bytes written to it, which zipfile needs to know the offsets
+    of the archive members."""
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.offset = 0
+
+    def write(self, data):
+        self.fp.write(data)
+        self.offset += len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        self.fp.flush()
+
+
+class StreamingZipFile(zipfile.ZipFile):
+    """A ZipFile that can be written to a stream that doesn't support seeking.
+
+    zipfile.ZipFile.write seeks back to fill in each member's CRC and sizes
+    after writing its data. Instead, we set the "data descriptor" flag and
+    write them after the data, which every zip reader supports.
+
+    Files that are already encrypted (and therefore incompressible) are
+    stored without compression. `write` returns the SHA-256 hex digest of the
+    file it archived.
+    """
+
+    INCOMPRESSIBLE_EXTENSIONS = ('.gpg',)
+
+    def __init__(self, fp):
+        zipfile.ZipFile.__init__(self, TellableWriter(fp), 'w',
+                                 zipfile.ZIP_DEFLATED, allowZip64=True)
+        self.bytes_read = 0
+
+    def write(self, filename, arcname=None, compress_type=None):
+        st = os.stat(filename)
+        if arcname is None:
+            arcname = filename
+        arcname = os.path.normpath(os.path.splitdrive(arcname)[1])
+        while arcname[0] in (os.sep, os.altsep):
+            arcname = arcname[1:]
+
+        zinfo = zipfile.ZipInfo(arcname, time.localtime(st.st_mtime)[0:6])
+        zinfo.external_attr = (st.st_mode & 0xFFFF) << 16L
+        if compress_type is not None:
+            zinfo.compress_type = compress_type
+        elif filename.endswith(self.INCOMPRESSIBLE_EXTENSIONS):
+            zinfo.compress_type = zipfile.ZIP_STORED
+        else:
+            zinfo.compress_type = self.compression
+        zinfo.flag_bits = 0x08
+        zinfo.header_offset = self.fp.tell()
+        zip64 = st.st_size * 1.05 > zipfile.ZIP64_LIMIT
+
+        self._writecheck(zinfo)
+        self._didModify = True
+        self.fp.write(zinfo.FileHeader(zip64))
+
+        if zinfo.compress_type == zipfile.ZIP_DEFLATED:
+            cmpr = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                    zlib.DEFLATED, -15)
+        else:
+            cmpr = None
+        CRC = file_size = compress_size = 0
+        digest = hashlib.sha256()
+        with open(filename, "rb") as fp:
+            while True:
+                buf = fp.read(CHUNK_SIZE)
+                if not buf:
+                    break
+                file_size += len(buf)
+                digest.update(buf)
+                CRC = zlib.crc32(buf, CRC) & 0xffffffff
+                if cmpr:
+                    buf = cmpr.compress(buf)
+                compress_size += len(buf)
+                self.fp.write(buf)
+        if cmpr:
+            buf = cmpr.flush()
+            compress_size += len(buf)
+            self.fp.write(buf)
+
+        zinfo.CRC = CRC
+        zinfo.file_size = file_size
+        zinfo.compress_size = compress_size
+        fmt = '<LLQQ' if zip64 else '<LLLL'
+        self.fp.write(struct.pack(fmt, zipfile._DD_SIGNATURE, CRC,
+                                  compress_size, file_size))
+        self.filelist.append(zinfo)
+        self.NameToInfo[zinfo.filename] = zinfo
+        self.bytes_read += file_size
+        return digest.hexdigest()
+
 
 def collect_config_file(zf):
     config_file_path = os.path.join(config.SECUREDROP_ROOT, "config.py")
     zf.write(config_file_path)
 
 
-def collect_securedrop_data_root(zf):
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for buf in iter(lambda: fp.read(CHUNK_SIZE), ''):
+            digest.update(buf)
+    return digest.hexdigest()
+
+
+def load_manifest(path):
+    """Return the manifest of the last backup, or None if there isn't one."""
+    try:
+        with open(path) as fp:
+            return json.load(fp)
+    except IOError:
+        return None
+
+
+def save_manifest(manifest, path):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as fp:
+        os.chmod(tmp_path, 0600)
+        json.dump(manifest, fp)
+    os.rename(tmp_path, path)
+
+
+def collect_securedrop_data_root(zf, previous=None):
+    """Archive the data root, and return the manifest describing it.
+
+    If `previous` (the manifest of the last backup) is given, only archive
+    files that are new or changed since then. Unchanged files are detected by
+    size and mtime, or failing that by content hash, since mtimes of stored
+    submissions are normalized whenever a source submits something new."""
+    previous_files = previous["files"] if previous else {}
+    previous_paths_by_hash = dict((entry["sha256"], path)
+                                  for path, entry in previous_files.items())
+    manifest = {
+        "incremental": previous is not None,
+        "created": datetime.utcnow().strftime("%Y-%m-%d--%H-%M-%S"),
+        # The backup this one is an increment of, so restores can check that
+        # increments are applied in order
+        "parent": previous["created"] if previous else None,
+        "files": {},
+        "copies": {},
+        "deleted": [],
+    }
+
     # The store and key dirs are shared between both interfaces
     for root, dirs, files in os.walk(config.SECUREDROP_DATA_ROOT):
         for name in files:
-            zf.write(os.path.join(root, name))
+            path = os.path.join(root, name)
+            st = os.stat(path)
+            entry = {"size": st.st_size, "mtime": int(st.st_mtime)}
+            prev = previous_files.get(path)
+
+            if (prev and prev["size"] == entry["size"] and
+                    prev["mtime"] == entry["mtime"]):
+                entry["sha256"] = prev["sha256"]
+            elif prev is None and previous is None:
+                entry["sha256"] = zf.write(path)
+            else:
+                entry["sha256"] = hash_file(path)
+                if prev and prev["sha256"] == entry["sha256"]:
+                    pass
+                elif entry["sha256"] in previous_paths_by_hash:
+                    manifest["copies"][path] = \
+                        previous_paths_by_hash[entry["sha256"]]
+                else:
+                    zf.write(path)
+            manifest["files"][path] = entry
+
+    manifest["deleted"] = sorted(set(previous_files) -
+                                 set(manifest["files"]))
+    zf.writestr(MANIFEST_ARCNAME, json.dumps(manifest))
+    return manifest
 
 
 def collect_custom_header_image(zf):
@@ -56,27 +254,62 @@ def collect_tor_files(zf):
     zf.write(TOR_CONFIG)
 
 
-def encrypt_zip_file(zf_fn):
-    # Encrypt the backup zip file with the application's gpg public key
-    gpg = gnupg.GPG(binary='gpg2', homedir=config.GPG_KEY_DIR)
-    e_fn = '{}.gpg'.format(zf_fn)
+def open_encrypted_output(e_fn):
+    """Start gpg encrypting its stdin to `e_fn` with the application's public
+    key, and return the process."""
+    return subprocess.Popen(['gpg2', '--homedir', config.GPG_KEY_DIR,
+                             '--batch', '--yes', '--trust-model', 'always',
+                             '--encrypt', '--recipient', config.JOURNALIST_KEY,
+                             '--output', e_fn],
+                            stdin=subprocess.PIPE)
 
-    stream = open(zf_fn, "rb")
-    gpg.encrypt_file(stream, config.JOURNALIST_KEY, always_trust='True',
-                     output=e_fn)
+
+def get_args():
+    parser = ArgumentParser(prog=__file__,
+                            description="Back up a SecureDrop 0.3 app server")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only archive files in the data root that have "
+                             "changed since the last backup")
+    parser.add_argument("--manifest", default=DEFAULT_MANIFEST_PATH,
+                        help="manifest of the last backup (default: %(default)s)")
+    return parser
 
 
 def main():
+    args = get_args().parse_args()
+
+    previous = None
+    if args.incremental:
+        previous = load_manifest(args.manifest)
+        if previous is None:
+            sys.stderr.write("No previous manifest found at {}, making a "
+                             "full backup\n".format(args.manifest))
+
     # name append a timestamp to the sd-backup zip filename
     dt = str(datetime.utcnow().strftime("%Y-%m-%d--%H-%M-%S"))
-    zf_fn = 'sd-backup-{}.zip'.format(dt)
-    with zipfile.ZipFile(zf_fn, 'w') as zf:
+    e_fn = 'sd-backup-{}{}.zip.gpg'.format(dt, "-incr" if previous else "")
+
+    start = time.time()
+    gpg = open_encrypted_output(e_fn)
+    with StreamingZipFile(gpg.stdin) as zf:
         collect_config_file(zf)
-        collect_securedrop_data_root(zf)
+        manifest = collect_securedrop_data_root(zf, previous)
         collect_custom_header_image(zf)
         collect_tor_files(zf)
-    encrypt_zip_file(zf_fn)
-    print zf_fn
+    gpg.stdin.close()
+    if gpg.wait() != 0:
+        sys.exit("gpg2 exited with status {}".format(gpg.returncode))
+    elapsed = time.time() - start
+
+    # Only record the new manifest once the backup has been written, so a
+    # failed backup doesn't become the base for the next increment
+    save_manifest(manifest, args.manifest)
+
+    # Report throughput on stderr, since the Ansible playbook reads the
+    # backup filename from stdout
+    sys.stderr.write("Backed up {} bytes in {:.1f}s ({:.1f} MB/s)\n".format(
+        zf.bytes_read, elapsed, zf.bytes_read / (elapsed or 1) / 2**20))
+    print e_fn
 
 if __name__ == "__main__":
     main()
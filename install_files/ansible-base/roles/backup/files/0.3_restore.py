@@ -5,21 +5,73 @@ This script and decrypted backup zip should be copied to the App server
 and run by the anisble plabook. When run (as root), it restores the 0.3
 backup file.
 
-python 0.3_restore.py sd-backup-TIMESTAMP.zip
+python 0.3_restore.py sd-backup-TIMESTAMP.zip [sd-backup-TIMESTAMP-incr.zip ...]
+
+To restore from incremental backups, pass the full backup followed by each
+of the increments made after it, in the order they were made.
+
+The store and keys are extracted by several threads at once (see -j), and
+every restored file in the data root is checked against the SHA-256 recorded
+in the backup's manifest.
 
 """
 
 import sys
 import os
 import re
+import errno
+import hashlib
+import json
+import pwd
+import threading
+import time
 import zipfile
 import subprocess
 import shutil
+from argparse import ArgumentParser
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 from operator import itemgetter
 import calendar
 import traceback
 
+# Name of the manifest written into the backup archive by 0.3_collect.py
+MANIFEST_ARCNAME = "sd-backup-manifest.json"
+
+# Size of the chunks copied out of the archive
+CHUNK_SIZE = 64 * 1024
+
+# Default number of members to extract at once
+DEFAULT_JOBS = 4
+
+
+class Progress(object):
+    """Prints how much of `total` bytes has been restored, and an estimate of
+    the time remaining, at most every `interval` seconds."""
+
+    def __init__(self, total, interval=10):
+        self.total = total
+        self.done = 0
+        self.interval = interval
+        self.start = self.last_report = time.time()
+        self.lock = threading.Lock()
+
+    def update(self, nbytes):
+        with self.lock:
+            self.done += nbytes
+            now = time.time()
+            if now - self.last_report >= self.interval:
+                self.last_report = now
+                self.report(now)
+
+    def report(self, now=None):
+        elapsed = (now or time.time()) - self.start
+        rate = self.done / elapsed if elapsed else 0
+        eta = (self.total - self.done) / rate if rate else 0
+        print "  {:.1f}/{:.1f} MB ({:.1f} MB/s, {:.0f}s remaining)".format(
+            self.done / 2.0**20, self.total / 2.0**20, rate / 2**20, eta)
+        sys.stdout.flush()
+
 
 def replace_prefix(path, p1, p2):
     """
@@ -37,18 +89,44 @@ def replace_prefix(path, p1, p2):
     return os.path.join(p2, path)
 
 
-def extract_to_path(archive, member, path, user):
+def makedirs(path):
+    """Create `path` and any missing parents, tolerating another thread
+    creating them at the same time."""
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def chown(paths, user):
+    """Change the owner and group of each of `paths` to `user`."""
+    pw = pwd.getpwnam(user)
+    for path in paths:
+        os.chown(path, pw.pw_uid, pw.pw_gid)
+
+
+def extract_member(archive, member, path, progress=None):
     """
     Extract from the zip archive `archive` the member `member` and write it to
-    `path`, preserving file metadata and chown'ing the file using `user`
+    `path`, preserving file metadata. Returns the SHA-256 hex digest of the
+    extracted file.
     """
     # Create all upper directories if necessary
     upperdirs = os.path.dirname(path)
     if upperdirs and not os.path.exists(upperdirs):
-        os.makedirs(upperdirs)
+        makedirs(upperdirs)
 
+    digest = hashlib.sha256()
     with archive.open(member) as source, file(path, "wb") as target:
-        shutil.copyfileobj(source, target)
+        while True:
+            buf = source.read(CHUNK_SIZE)
+            if not buf:
+                break
+            digest.update(buf)
+            target.write(buf)
+            if progress:
+                progress.update(len(buf))
 
     # Update the timestamps as well (as best we can, thanks, conversion to
     # localtime). This only actually works if the .zip was created on a
@@ -59,8 +137,73 @@ def extract_to_path(archive, member, path, user):
         timestamp = calendar.timegm(member.date_time)
         os.utime(path, (timestamp, timestamp))
 
-    ug = "{}:{}".format(user, user)
-    subprocess.call(['chown', '-R', ug, path])
+    return digest.hexdigest()
+
+
+def extract_to_path(archive, member, path, user):
+    """
+    Extract from the zip archive `archive` the member `member` and write it to
+    `path`, preserving file metadata and chown'ing the file using `user`.
+    Returns the SHA-256 hex digest of the extracted file.
+    """
+    digest = extract_member(archive, member, path)
+    chown([path], user)
+    return digest
+
+
+def extract_members(zf, members, user, manifest=None, jobs=DEFAULT_JOBS):
+    """
+    Extract `members`, a list of (ZipInfo, path) pairs, from the zip archive
+    `zf` using `jobs` threads, each reading from its own handle on the
+    archive, then chown the extracted files using `user`.
+
+    If `manifest` is given, check each extracted file against the SHA-256
+    recorded for its path, and raise an exception if any don't match.
+    """
+    if not members:
+        return
+
+    progress = Progress(sum(member.file_size for member, _ in members))
+    local = threading.local()
+    archives = []
+
+    def extract((member, path)):
+        if not hasattr(local, 'archive'):
+            local.archive = zipfile.ZipFile(zf.filename, 'r')
+            archives.append(local.archive)
+        return extract_member(local.archive, member, path, progress)
+
+    pool = ThreadPool(jobs)
+    try:
+        digests = pool.map(extract, members)
+    finally:
+        pool.close()
+        pool.join()
+        for archive in archives:
+            archive.close()
+    progress.report()
+
+    chown([path for _, path in members], user)
+
+    if manifest:
+        verify(zip([path for _, path in members], digests), manifest)
+
+
+def verify(digests, manifest):
+    """
+    Check that each of `digests`, a list of (path, SHA-256 hex digest) pairs,
+    matches the digest recorded for that path in `manifest`.
+    """
+    mismatched = [path for path, digest in digests
+                  if path in manifest["files"] and
+                  manifest["files"][path]["sha256"] != digest]
+    for path in mismatched:
+        print "!!  Checksum mismatch for {}".format(path)
+    if mismatched:
+        raise ValueError("{} restored file(s) don't match the backup "
+                         "manifest".format(len(mismatched)))
+    print "  Verified {} file(s) against the backup manifest".format(
+        len(digests))
 
 
 def restore_config_file(zf):
@@ -73,32 +216,98 @@ def restore_config_file(zf):
                             "/var/www/securedrop/config.py", "www-data")
 
 
-def restore_securedrop_root(zf):
+def restore_securedrop_root(zf, manifest=None, jobs=DEFAULT_JOBS):
     print "* Migrating directories from SECUREDROP_ROOT..."
 
     # Restore the original source directories and key files
+    members = []
     for zi in zf.infolist():
         if "var/lib/securedrop/store" in zi.filename:
-            extract_to_path(zf, zi,
-                            replace_prefix(zi.filename,
-                                           "var/lib/securedrop/store",
-                                           "/var/lib/securedrop/store"),
-                            "www-data")
+            members.append((zi, replace_prefix(zi.filename,
+                                               "var/lib/securedrop/store",
+                                               "/var/lib/securedrop/store")))
         elif "var/lib/securedrop/keys" in zi.filename:
             # TODO: is it a bad idea to migrate the random_seed from the
             # previous installation?
-            extract_to_path(zf, zi,
-                            replace_prefix(zi.filename,
-                                           "var/lib/securedrop/keys",
-                                           "/var/lib/securedrop/keys"),
-                            "www-data")
+            members.append((zi, replace_prefix(zi.filename,
+                                               "var/lib/securedrop/keys",
+                                               "/var/lib/securedrop/keys")))
+    extract_members(zf, members, "www-data", manifest, jobs)
+
 
+def restore_database(zf, manifest=None):
+    # An incremental backup won't contain the database if it hasn't changed
+    if "var/lib/securedrop/db.sqlite" not in zf.namelist():
+        return
 
-def restore_database(zf):
     print "* Migrating database..."
 
-    extract_to_path(zf, "var/lib/securedrop/db.sqlite",
-                    "/var/lib/securedrop/db.sqlite", "www-data")
+    digest = extract_to_path(zf, "var/lib/securedrop/db.sqlite",
+                             "/var/lib/securedrop/db.sqlite", "www-data")
+    if manifest:
+        verify([("/var/lib/securedrop/db.sqlite", digest)], manifest)
+
+
+def read_manifest(zf):
+    """
+    Return the manifest of the data root stored in the backup, or None if the
+    backup was made before 0.3_collect.py started writing manifests.
+    """
+    try:
+        return json.loads(zf.read(MANIFEST_ARCNAME))
+    except KeyError:
+        return None
+
+
+def check_backup_order(manifests):
+    """
+    Check that `manifests` (of the backups given on the command line, in
+    order) describe a full backup followed by its increments.
+    """
+    if any(manifest is None for manifest in manifests[1:]):
+        raise ValueError("Only backups with manifests can be restored "
+                         "incrementally")
+    if manifests[0] and manifests[0]["incremental"]:
+        raise ValueError("The first backup must be a full backup")
+    for previous, manifest in zip(manifests, manifests[1:]):
+        if not manifest["incremental"]:
+            raise ValueError("Backup {} is not an increment".format(
+                manifest["created"]))
+        if manifest["parent"] != previous["created"]:
+            raise ValueError("Backup {} is an increment of {}, not {}".format(
+                manifest["created"], manifest["parent"], previous["created"]))
+
+
+def restore_copies(manifest):
+    """
+    Recreate files whose content was already in an earlier backup, by copying
+    them from where that content was restored. This must happen before the
+    increment's own files are extracted, since they may overwrite the source
+    of a copy.
+    """
+    if not manifest["copies"]:
+        return
+    print "* Restoring files copied since the previous backup..."
+
+    for path, source in sorted(manifest["copies"].items()):
+        upperdirs = os.path.dirname(path)
+        if upperdirs and not os.path.exists(upperdirs):
+            os.makedirs(upperdirs)
+        shutil.copy2(source, path)
+    chown(manifest["copies"].keys(), "www-data")
+
+
+def restore_deletions(manifest):
+    """
+    Remove files that were deleted since the previous backup.
+    """
+    if not manifest["deleted"]:
+        return
+    print "* Removing files deleted since the previous backup..."
+
+    for path in manifest["deleted"]:
+        if os.path.exists(path):
+            os.remove(path)
 
 
 def restore_custom_header_image(zf):
@@ -126,19 +335,17 @@ def restore_tor_files(zf):
 
     print "* Migrating source and journalist interface .onion..."
 
+    members = []
     for zi in zf.infolist():
         if "var/lib/tor/services/source" in zi.filename:
-            extract_to_path(zf, zi,
-                            replace_prefix(zi.filename,
-                                           "var/lib/tor/services/source",
-                                           "/var/lib/tor/services/source"),
-                            "debian-tor")
+            members.append((zi, replace_prefix(zi.filename,
+                                               "var/lib/tor/services/source",
+                                               "/var/lib/tor/services/source")))
         elif "var/lib/tor/services/journalist" in zi.filename:
-            extract_to_path(zf, zi,
-                            replace_prefix(zi.filename,
-                                           "var/lib/tor/services/journalist",
-                                           "/var/lib/tor/services/journalist"),
-                            "debian-tor")
+            members.append((zi, replace_prefix(zi.filename,
+                                               "var/lib/tor/services/journalist",
+                                               "/var/lib/tor/services/journalist")))
+    extract_members(zf, members, "debian-tor")
 
     # Reload Tor to trigger registering the old Tor Hidden Services
     # reloading Tor compared to restarting tor will not break the current tor
@@ -146,21 +353,49 @@ def restore_tor_files(zf):
     subprocess.call(['service', 'tor', 'reload'])
 
 
+def restore(zf, manifest, jobs=DEFAULT_JOBS):
+    if manifest and manifest["incremental"]:
+        restore_copies(manifest)
+    restore_config_file(zf)
+    restore_securedrop_root(zf, manifest, jobs)
+    restore_database(zf, manifest)
+    restore_custom_header_image(zf)
+    restore_tor_files(zf)
+    if manifest and manifest["incremental"]:
+        restore_deletions(manifest)
+
+
+def get_args():
+    parser = ArgumentParser(
+        prog="0.3_restore.py",
+        description="Restore a SecureDrop 0.3 backup created by "
+                    "0.3_collect.py")
+    parser.add_argument("filename",
+                        help="path to a SecureDrop 0.3 backup .zip file")
+    parser.add_argument("increments", nargs="*", metavar="increment",
+                        help="paths to incremental backups made after "
+                             "<filename>, in order")
+    parser.add_argument("-j", "--jobs", type=int, default=DEFAULT_JOBS,
+                        help="number of files to extract at once "
+                             "(default: %(default)s)")
+    return parser
+
+
 def main():
-    if len(sys.argv) <= 1:
-        print ("Usage: 0.3_restore.py <filename>\n\n"
-               "    <filename>\tPath to a SecureDrop 0.3 backup .zip file"
-               "created by 0.3_collect.py")
-        sys.exit(1)
+    args = get_args().parse_args()
 
     try:
-        zf_fn = sys.argv[1]
-        with zipfile.ZipFile(zf_fn, 'r') as zf:
-            restore_config_file(zf)
-            restore_securedrop_root(zf)
-            restore_database(zf)
-            restore_custom_header_image(zf)
-            restore_tor_files(zf)
+        zf_fns = [args.filename] + args.increments
+        manifests = []
+        for zf_fn in zf_fns:
+            with zipfile.ZipFile(zf_fn, 'r') as zf:
+                manifests.append(read_manifest(zf))
+        check_backup_order(manifests)
+
+        for zf_fn, manifest in zip(zf_fns, manifests):
+            print "* Restoring {}...".format(zf_fn)
+            with zipfile.ZipFile(zf_fn, 'r') as zf:
+                restore(zf, manifest, args.jobs)
     except:
         print "\n!!! Something went wrong, please file an issue.\n"
         print traceback.format_exc()
@@ -1,6 +1,7 @@
 #!/usr/bin/python2.7
 
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 import os
 import shutil
 import sqlite3
@@ -9,6 +10,9 @@ import sys
 import tarfile
 import traceback
 
+# Number of srm processes to run at once when cleaning up deleted sources
+CLEANUP_JOBS = 4
+
 
 def backup_app():
     tar_fn = 'backup-app-{}.tar.bz2'.format(datetime.now().strftime("%Y-%m-%d--%H-%M-%S"))
@@ -47,19 +51,33 @@ def cleanup_deleted_sources(store_dir, c):
     the store_dir, but no corresponding Source entry in the database.
 
     See https://github.com/freedomofpress/securedrop/pull/944 for context.
+
+    This loads every filesystem_id from the database with a single query and
+    diffs it against a single scan of the store_dir, and then deletes the
+    orphaned directories in parallel.
     """
-    for source_dir in os.listdir(store_dir):
+    filesystem_ids = set(row[0] for row in
+                         c.execute("SELECT filesystem_id FROM sources"))
+    orphans = [source_dir for source_dir in os.listdir(store_dir)
+               if source_dir not in filesystem_ids]
+
+    def cleanup(source_dir):
         try:
-            source = c.execute("SELECT * FROM sources WHERE filesystem_id=?",
-                (source_dir,)).fetchone()
-            if not source:
-                print "Deleting source with no db entry ('{}')...".format(source_dir)
-                secure_unlink(os.path.join(store_dir, source_dir))
+            print "Deleting source with no db entry ('{}')...".format(source_dir)
+            secure_unlink(os.path.join(store_dir, source_dir))
         except Exception as e:
             print "\n!!  Error occurred cleaning up deleted sources for source {}".format(source_dir)
             print "Source had {} submissions".format(len(os.listdir(os.path.join(store_dir, source_dir))))
             print traceback.format_exc()
 
+    if orphans:
+        pool = ThreadPool(min(CLEANUP_JOBS, len(orphans)))
+        try:
+            pool.map(cleanup, orphans)
+        finally:
+            pool.close()
+            pool.join()
+
 
 def get_db_connection():
     db_path = "/var/lib/securedrop/db.sqlite"
@@ -3,20 +3,53 @@
 This script should be copied to a running SecureDrop 0.3 instance, along with
 the output of `0.2.1_collect.py`. When run (as root), it migrates all of the
 information from the 0.2.1 instance to create a matching 0.3 instance.
+
+The database is migrated in batches of sources, and progress is recorded in a
+checkpoint file after each batch. If the migration is interrupted, running the
+script again with the same backup resumes from the last completed batch.
 """
 
 import sys
 import os
 import re
+import json
 import tarfile
 import subprocess
 import sqlite3
 import shutil
+import time
 from datetime import datetime
 from operator import itemgetter
 import calendar
 import traceback
 
+# Number of sources migrated (and committed) at a time
+BATCH_SIZE = 500
+
+# Records the progress of the database migration so it can be resumed
+CHECKPOINT_FN = "/var/lib/securedrop-0.3-migration.json"
+
+SECUREDROP_DATA_ROOT = "/var/lib/securedrop"
+STORE_DIR = os.path.join(SECUREDROP_DATA_ROOT, "store")
+DB_FN = os.path.join(SECUREDROP_DATA_ROOT, "db.sqlite")
+
+
+def load_checkpoint():
+    try:
+        with open(CHECKPOINT_FN) as f:
+            return json.load(f)
+    except IOError:
+        return None
+
+
+def save_checkpoint(checkpoint):
+    tmp_fn = CHECKPOINT_FN + ".tmp"
+    with open(tmp_fn, "w") as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_fn, CHECKPOINT_FN)
+
 
 def migrate_config_file(backup):
     print "* Migrating values from old config file..."
@@ -65,8 +98,8 @@ def extract_file_to(tar, src, dst):
 
 def migrate_securedrop_root(backup):
     print "* Migrating directories from SECUREDROP_ROOT..."
-    extract_tree_to(backup, "var/securedrop/", "/var/lib/securedrop")
-    subprocess.call(['chown', '-R', 'www-data:www-data', "/var/lib/securedrop"])
+    extract_tree_to(backup, "var/securedrop/", SECUREDROP_DATA_ROOT)
+    subprocess.call(['chown', '-R', 'www-data:www-data', SECUREDROP_DATA_ROOT])
 
 
 def migrate_database(backup):
@@ -92,7 +125,7 @@ def migrate_database(backup):
     # stored in the database, since they are already known and should not be
     # generated from the filesystem id
     already_processed = set([source[0] for source in sources])
-    for fs_id in os.listdir("/var/lib/securedrop/store"):
+    for fs_id in os.listdir(STORE_DIR):
         if fs_id in already_processed:
             continue
         sources.append((fs_id, displayid(fs_id)))
@@ -115,56 +148,72 @@ def migrate_database(backup):
     else:
         arbitrary_journalist = Journalist.query.all()[0]
 
-    # Back up current database just in case
-    shutil.copy("/var/lib/securedrop/db.sqlite",
-                "/var/lib/securedrop/db.sqlite.bak")
+    # Back up current database just in case. If we're resuming, the database
+    # has already been backed up and partially migrated.
+    checkpoint = load_checkpoint()
+    if checkpoint is None:
+        shutil.copy(DB_FN, DB_FN + ".bak")
+        checkpoint = {"done": 0, "pending": None}
+        save_checkpoint(checkpoint)
 
     # Copied from db.py to compute filesystem-safe journalist filenames
     def journalist_filename(s):
         valid_chars = 'abcdefghijklmnopqrstuvwxyz1234567890-_'
         return ''.join([c for c in s.lower().replace(' ', '_') if c in valid_chars])
 
-    # Migrate rows to new database with SQLAlchemy ORM
-    for source in sources:
-        migrated_source = Source(source[0], source[1])
-        source_dir = os.path.join("/var/lib/securedrop/store", source[0])
+    def plan_source(source):
+        """Return the row for `source` and the rows for its submissions and
+        replies, and the file operations needed to migrate its store
+        directory."""
+        source_dir = os.path.join(STORE_DIR, source[0])
 
         # It appears that there was a bug in 0.2.1 where sources with changed
         # names were not always successfully removed from the database. Skip
         # any sources that didn't have files copied for them, they were deleted
         # and are in the database erroneously.
         if not os.path.isdir(source_dir):
-            continue
+            return None
 
-        # Can infer "flagged" state by looking for _FLAG files in store
-        if "_FLAG" in os.listdir(source_dir):
-            # Mark the migrated source as flagged
-            migrated_source.flagged = True
-            # Delete the _FLAG file
-            os.remove(os.path.join(source_dir, "_FLAG"))
+        source_row = dict(filesystem_id=source[0],
+                          journalist_designation=source[1],
+                          flagged=False)
+        removes = []
 
         # Sort the submissions by the date of submission so we can infer the
         # correct interaction_count for the new filenames later, and so we can
         # set source.last_updated to the time of the most recently uploaded
-        # submission in the store now.
+        # submission in the store now. We stat each file once, for both its
+        # mtime and its size.
         submissions = []
         replies = []
         for fn in os.listdir(source_dir):
+            # Can infer "flagged" state by looking for _FLAG files in store
+            if fn == "_FLAG":
+                # Mark the migrated source as flagged, and delete the _FLAG file
+                source_row["flagged"] = True
+                removes.append(os.path.join(source_dir, fn))
+                continue
             append_to = submissions
             if fn.startswith('reply-'):
                 append_to = replies
-            append_to.append((fn, os.path.getmtime(os.path.join(source_dir, fn))))
+            st = os.stat(os.path.join(source_dir, fn))
+            append_to.append((fn, st.st_mtime, st.st_size))
 
         # Sort by submission time
         submissions.sort(key=itemgetter(1))
         replies.sort(key=itemgetter(1))
 
+        # Every row needs a value, since the rows of a batch are inserted with
+        # one statement. Sources with no submissions get the time of the
+        # migration, like the column's default, which might be a little
+        # confusing, but it's the best we can do.
         if len(submissions) > 0:
-            migrated_source.last_updated = datetime.utcfromtimestamp(submissions[-1][1])
+            last_updated = datetime.utcfromtimestamp(submissions[-1][1])
         else:
-            # The source will have the default .last_updated of utcnow(), which
-            # might be a little confusing, but it's the best we can do.
-            pass
+            last_updated = datetime.utcnow()
+        # Rows are saved in the checkpoint as JSON, so this is a string until
+        # the rows are inserted
+        source_row["last_updated"] = str(last_updated)
 
         # Since the concept of "pending" is introduced in 0.3, it's tricky to
         # figure out how to set this value. We can't distinguish between sources
@@ -178,59 +227,144 @@ def migrate_database(backup):
         # in the list, and sources who are active can probably be expected to
         # log back in relatively soon and so will automatially reappear once
         # they submit something new.
-        if len(submissions + replies) == 0:
-            migrated_source.pending = True
-        else:
-            migrated_source.pending = False
+        source_row["pending"] = len(submissions + replies) == 0
 
         # Set source.interaction_count to the number of current submissions for
         # each source. This is not technicially correct, but since we can't
         # know how many submissions have been deleted it will give us a
         # reasonable, monotonically increasing basis for future increments to
         # the interaction_count.
-        migrated_source.interaction_count = len(submissions) + len(replies)
-
-        # Add and commit the source to the db so they will have a primary key
-        # assigned to use with the ForeignKey relationship with their
-        # submissions
-        db_session.add(migrated_source)
-        db_session.commit()
+        source_row["interaction_count"] = len(submissions) + len(replies)
 
         # Combine everything into one list, sorted by date, so we can
         # correctly set the interaction counts for each file.
         everything = submissions + replies
         everything.sort(key=itemgetter(1))
+        submission_rows = []
+        reply_rows = []
+        renames = []
         for count, item in enumerate(everything):
             # Rename the file to fit the new file naming scheme used by 0.3
-            fn = item[0]
+            fn, _, size = item
 
             if fn.startswith('reply-'):
                 new_fn = "{0}-{1}-reply.gpg".format(count+1, journalist_filename(source[1]))
+                # Replies are linked to the journalist when the rows are
+                # inserted
+                reply_rows.append(dict(filesystem_id=source[0],
+                                       filename=new_fn, size=size,
+                                       interaction_index=count+1))
             else:
                 new_fn = "{0}-{1}-{2}".format(count+1, journalist_filename(source[1]), "msg.gpg" if fn.endswith("msg.gpg") else "doc.zip.gpg")
-
-            # Move to the new filename
-            os.rename(os.path.join(source_dir, fn),
-                      os.path.join(source_dir, new_fn))
-
-            # Add a database entry for this item
-            db_entry = None
-
-            if fn.startswith('reply-'):
-                migrated_reply = Reply(arbitrary_journalist, migrated_source, new_fn)
-                db_entry = migrated_reply
-            else:
-                migrated_submission = Submission(migrated_source, new_fn)
                 # Assume that all submissions that are being migrated
                 # have already been downloaded
-                migrated_submission.downloaded = True
-                db_entry = migrated_submission
-
-            db_session.add(db_entry)
-            db_session.commit()
+                submission_rows.append(dict(filesystem_id=source[0],
+                                            filename=new_fn, size=size,
+                                            downloaded=True,
+                                            interaction_index=count+1))
+
+            renames.append((os.path.join(source_dir, fn),
+                            os.path.join(source_dir, new_fn)))
+
+        return source_row, submission_rows, reply_rows, renames, removes
+
+    def plan_batch(batch):
+        plan = {"sources": [], "submissions": [], "replies": [],
+                "renames": [], "removes": []}
+        for source in batch:
+            planned = plan_source(source)
+            if planned is None:
+                continue
+            for key, value in zip(("sources", "submissions", "replies",
+                                   "renames", "removes"), planned):
+                if key == "sources":
+                    plan[key].append(value)
+                else:
+                    plan[key].extend(value)
+        return plan
+
+    def apply_file_operations(plan):
+        # These may have already been (partly) applied before the migration
+        # was interrupted, so skip any that are already done.
+        for src, dst in plan["renames"]:
+            if os.path.exists(src):
+                os.rename(src, dst)
+        for fn in plan["removes"]:
+            if os.path.exists(fn):
+                os.remove(fn)
+
+    def insert_rows(plan):
+        """Insert the rows for a batch with one statement per table, and
+        commit. Returns the number of rows inserted."""
+        filesystem_ids = [row["filesystem_id"] for row in plan["sources"]]
+        if not filesystem_ids:
+            return 0
+        # If the batch was committed before the migration was interrupted,
+        # there's nothing left to do
+        if Source.query.filter(
+                Source.filesystem_id.in_(filesystem_ids)).count():
+            return 0
+
+        for row in plan["sources"]:
+            row["last_updated"] = datetime.strptime(
+                row["last_updated"].split('.')[0], "%Y-%m-%d %H:%M:%S")
+        db_session.execute(Source.__table__.insert(), plan["sources"])
+        source_ids = dict(db_session.query(Source.filesystem_id, Source.id)
+                                    .filter(Source.filesystem_id.in_(filesystem_ids)))
+
+        submission_rows = [dict(source_id=source_ids[row["filesystem_id"]],
+                                filename=row["filename"], size=row["size"],
+                                downloaded=row["downloaded"],
+                                interaction_index=row["interaction_index"])
+                           for row in plan["submissions"]]
+        reply_rows = [dict(source_id=source_ids[row["filesystem_id"]],
+                           journalist_id=arbitrary_journalist.id,
+                           filename=row["filename"], size=row["size"],
+                           interaction_index=row["interaction_index"])
+                      for row in plan["replies"]]
+        if submission_rows:
+            db_session.execute(Submission.__table__.insert(), submission_rows)
+        if reply_rows:
+            db_session.execute(Reply.__table__.insert(), reply_rows)
+        db_session.commit()
+        return len(plan["sources"]) + len(submission_rows) + len(reply_rows)
+
+    # Migrate rows to new database in batches. Each batch's plan is saved in
+    # the checkpoint before any files are renamed, so an interrupted batch can
+    # be finished exactly as planned when the migration is resumed.
+    sources.sort(key=itemgetter(0))
+    start = time.time()
+    migrated_rows = 0
+    if checkpoint["pending"]:
+        print "  Resuming interrupted migration at source {} of {}".format(
+            checkpoint["done"], len(sources))
+    while True:
+        plan = checkpoint["pending"]
+        if plan is None:
+            batch = sources[checkpoint["done"]:checkpoint["done"] + BATCH_SIZE]
+            if not batch:
+                break
+            plan = plan_batch(batch)
+            checkpoint["pending"] = plan
+            checkpoint["batch_size"] = len(batch)
+            save_checkpoint(checkpoint)
+
+        apply_file_operations(plan)
+        migrated_rows += insert_rows(plan)
+
+        checkpoint["done"] += checkpoint["batch_size"]
+        checkpoint["pending"] = None
+        save_checkpoint(checkpoint)
+
+        elapsed = time.time() - start
+        print "  Migrated {} of {} sources ({:.0f} rows/sec)".format(
+            min(checkpoint["done"], len(sources)), len(sources),
+            migrated_rows / elapsed if elapsed else 0)
+
+    os.remove(CHECKPOINT_FN)
 
     # chown the database file to the securedrop user
-    subprocess.call(['chown', 'www-data:www-data', "/var/lib/securedrop/db.sqlite"])
+    subprocess.call(['chown', 'www-data:www-data', DB_FN])
 
 
 def migrate_custom_header_image(backup):
@@ -279,8 +413,12 @@ def main():
     try:
         backup_fn = sys.argv[1]
         with tarfile.open(backup_fn, 'r:*') as backup:
-            migrate_config_file(backup)
-            migrate_securedrop_root(backup)
+            # If we're resuming an interrupted database migration, the config
+            # and store have already been migrated, and extracting the store
+            # again would undo the renaming of migrated files.
+            if load_checkpoint() is None:
+                migrate_config_file(backup)
+                migrate_securedrop_root(backup)
             migrate_database(backup)
             migrate_custom_header_image(backup)
             migrate_tor_files(backup)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""Checks that the store and the database agree with each other.
+
+Bugs in earlier versions could delete a source from the database without
+deleting its store directory (and vice versa), so this compares the two and
+securely wipes anything in the store that the database doesn't know about.
+"""
+import os
+import subprocess
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+import config
+import store
+from db import db_session, Source, Submission, Reply
+
+# Number of srm processes to run at once when wiping orphans
+WIPE_JOBS = 4
+
+Report = namedtuple('Report', ['orphaned_dirs', 'orphaned_files',
+                               'missing_dirs', 'missing_files'])
+
+
+def check():
+    """Compare the store with the database, using one query per table and a
+    single scan of the store. Returns a `Report` of:
+
+    * orphaned_dirs: store directories with no `Source` row
+    * orphaned_files: files in a source's directory with no `Submission` or
+      `Reply` row
+    * missing_dirs: filesystem ids of sources with no store directory
+    * missing_files: paths of submissions and replies whose file is missing
+    """
+    filesystem_ids = set(fid for (fid,) in
+                         db_session.query(Source.filesystem_id))
+    filenames = set(db_session.query(Source.filesystem_id, Submission.filename)
+                              .join(Submission.source))
+    filenames.update(db_session.query(Source.filesystem_id, Reply.filename)
+                               .join(Reply.source))
+
+    orphaned_dirs = []
+    orphaned_files = []
+    stored = set()
+    source_dirs = set(os.listdir(config.STORE_DIR))
+    for source_dir in sorted(source_dirs):
+        if source_dir not in filesystem_ids:
+            orphaned_dirs.append(os.path.join(config.STORE_DIR, source_dir))
+            continue
+        for filename in sorted(os.listdir(os.path.join(config.STORE_DIR,
+                                                       source_dir))):
+            stored.add((source_dir, filename))
+            if (source_dir, filename) not in filenames:
+                orphaned_files.append(
+                    os.path.join(config.STORE_DIR, source_dir, filename))
+
+    missing_dirs = filesystem_ids - source_dirs
+    missing_files = [os.path.join(config.STORE_DIR, fid, filename)
+                     for fid, filename in sorted(filenames - stored)
+                     if fid not in missing_dirs]
+    return Report(orphaned_dirs, orphaned_files, sorted(missing_dirs),
+                  missing_files)
+
+
+def _wipe(path):
+    """Securely delete `path`, returning the error if it couldn't be."""
+    try:
+        store.secure_unlink(path, recursive=os.path.isdir(path))
+    except (store.PathException, subprocess.CalledProcessError,
+            OSError) as e:
+        return str(e)
+    return None
+
+
+def wipe(paths, jobs=WIPE_JOBS):
+    """Securely delete `paths` (files or directories in the store), running
+    up to `jobs` deletions at once. If some of the paths can't be deleted
+    (for example because their names aren't valid store filenames), the rest
+    still are, and then `store.DeletionException` is raised."""
+    if not paths:
+        return
+    pool = ThreadPool(min(jobs, len(paths)))
+    try:
+        errors = pool.map(_wipe, paths)
+    finally:
+        pool.close()
+        pool.join()
+    failures = dict((path, error) for path, error in zip(paths, errors)
+                    if error is not None)
+    if failures:
+        raise store.DeletionException(failures)
+
+
+def wipe_orphans(report=None, jobs=WIPE_JOBS):
+    """Securely delete the orphaned directories and files in `report` (by
+    default, a fresh `check()`). Returns the report, or raises
+    `store.DeletionException` like `wipe`."""
+    if report is None:
+        report = check()
+    wipe(report.orphaned_dirs + report.orphaned_files, jobs)
+    return report
@@ -1,7 +1,14 @@
 # -*- coding: utf-8 -*-
+import contextlib
+import fcntl
 import os
+import re
 import subprocess
+import tempfile
+import threading
 from base64 import b32encode
+from collections import OrderedDict
+from hashlib import sha256
 
 from Crypto.Random import random
 import gnupg
@@ -9,6 +16,7 @@ from gnupg._util import _is_stream, _make_binary_stream
 import scrypt
 
 import config
+from metrics import timed
 import store
 
 # to fix gpg error #78 on production
@@ -40,7 +48,49 @@ def do_runtime_tests():
     except subprocess.CalledProcessError:
         pass
 
-do_runtime_tests()
+
+class _Lazy(object):
+
+    """Stands in for the value returned by `factory`, which is only called
+    when the value is first used. Creating the GPG instance runs gpg2, and
+    loading the wordlists reads them from disk, so they're left until they're
+    needed (or until `warm_up` is called) to speed up startup."""
+
+    def __init__(self, factory):
+        object.__setattr__(self, '_factory', factory)
+        object.__setattr__(self, '_value', None)
+        object.__setattr__(self, '_lock', threading.Lock())
+
+    def _get(self):
+        if object.__getattribute__(self, '_value') is None:
+            with object.__getattribute__(self, '_lock'):
+                if object.__getattribute__(self, '_value') is None:
+                    object.__setattr__(
+                        self, '_value',
+                        object.__getattribute__(self, '_factory')())
+        return object.__getattribute__(self, '_value')
+
+    def __getattr__(self, name):
+        return getattr(_Lazy._get(self), name)
+
+    def __setattr__(self, name, value):
+        setattr(_Lazy._get(self), name, value)
+
+    def __nonzero__(self):
+        return bool(_Lazy._get(self))
+
+    def __len__(self):
+        return len(_Lazy._get(self))
+
+    def __getitem__(self, index):
+        return _Lazy._get(self)[index]
+
+    def __iter__(self):
+        return iter(_Lazy._get(self))
+
+    def __contains__(self, item):
+        return item in _Lazy._get(self)
+
 
 # HACK: use_agent=True is used to avoid logging noise.
 #
@@ -54,11 +104,59 @@ do_runtime_tests()
 # The best solution here would be to avoid passing either --use-agent
 # or --no-use-agent to gpg2, and I have filed an issue upstream to
 # address this: https://github.com/isislovecruft/python-gnupg/issues/96
-gpg = gnupg.GPG(binary='gpg2', homedir=config.GPG_KEY_DIR, use_agent=True)
+def _make_gpg(homedir):
+    return gnupg.GPG(binary='gpg2', homedir=homedir, use_agent=True)
+
 
-words = file(config.WORD_LIST).read().split('\n')
-nouns = file(config.NOUNS).read().split('\n')
-adjectives = file(config.ADJECTIVES).read().split('\n')
+# The shared keyring only holds the journalist key, and the reply keypairs of
+# sources that were generated before reply keypairs got their own keyrings
+gpg = _Lazy(lambda: _make_gpg(config.GPG_KEY_DIR))
+
+# Each source's reply keypair is kept in its own small keyring, along with a
+# copy of the journalist's public key, so the cost of a gpg operation doesn't
+# depend on how many sources have reply keypairs. The keyrings are sharded
+# into subdirectories to keep directory listings short.
+SOURCE_KEYRINGS_DIR = os.path.join(config.GPG_KEY_DIR, 'sources')
+
+# Number of source keyrings to keep GPG instances around for, since creating
+# one runs gpg2 to check its version
+SOURCE_GPG_CACHE_SIZE = 128
+
+# Lock file for changes to the reply keypairs. The apps, the worker and
+# manage.py all change them, so this is locked with flock rather than a
+# threading.Lock.
+KEYRING_LOCK_FN = os.path.join(config.GPG_KEY_DIR, '.keyring.lock')
+
+# Number of times `compact_keyrings` copies the shared keyring before giving
+# up, if it keeps changing while it's being copied
+COMPACT_ATTEMPTS = 3
+
+_source_gpgs = OrderedDict()
+_source_gpgs_lock = threading.Lock()
+
+
+def load_wordlist(path):
+    """Return the words in the file at `path` as a tuple, in file order,
+    without blank lines or duplicates."""
+    with open(path) as f:
+        return tuple(OrderedDict.fromkeys(
+            line.strip() for line in f if line.strip()))
+
+
+words = _Lazy(lambda: load_wordlist(config.WORD_LIST))
+nouns = _Lazy(lambda: load_wordlist(config.NOUNS))
+adjectives = _Lazy(lambda: load_wordlist(config.ADJECTIVES))
+
+
+def warm_up():
+    """Run the runtime tests, start gpg, export the journalist's public key
+    and load the wordlists now, instead of when they're first needed. The
+    apps' `warm_up` functions call this, e.g. before a pre-fork server forks
+    its workers."""
+    do_runtime_tests()
+    for value in (gpg, words, nouns, adjectives):
+        _Lazy._get(value)
+    journalist_pubkey()
 
 
 class CryptoException(Exception):
@@ -93,6 +191,7 @@ def display_id():
     return ' '.join([random.choice(adjectives), random.choice(nouns)])
 
 
+@timed('scrypt')
 def hash_codename(codename, salt=SCRYPT_ID_PEPPER):
     """
     >>> hash_codename('Hello, world!')
@@ -101,9 +200,62 @@ def hash_codename(codename, salt=SCRYPT_ID_PEPPER):
     return b32encode(scrypt.hash(clean(codename), salt, **SCRYPT_PARAMS))
 
 
+def source_keyring_dir(name):
+    """Return the directory of the keyring for the source with filesystem id
+    `name`. The directory name is derived from a hash of `name` to keep the
+    path short enough for gpg-agent's socket."""
+    digest = sha256(name).hexdigest()
+    return os.path.join(SOURCE_KEYRINGS_DIR, digest[:2], digest[2:32])
+
+
+def source_gpg(name, create=False):
+    """Return a GPG instance for the keyring of the source with filesystem id
+    `name`, or None if the source doesn't have a keyring and `create` is
+    False."""
+    homedir = source_keyring_dir(name)
+    with _source_gpgs_lock:
+        keyring = _source_gpgs.pop(homedir, None)
+        if not os.path.isdir(homedir):
+            if not create:
+                return None
+            os.makedirs(homedir, 0700)
+            keyring = None
+        if keyring is None:
+            keyring = _make_gpg(homedir)
+        _source_gpgs[homedir] = keyring
+        while len(_source_gpgs) > SOURCE_GPG_CACHE_SIZE:
+            _source_gpgs.popitem(last=False)
+        return keyring
+
+
+def _keyring_for(name):
+    """Return the GPG instance whose keyring holds the reply keypair of the
+    source with filesystem id `name`."""
+    return source_gpg(name) or gpg
+
+
+_journalist_pubkey = None
+
+
+def journalist_pubkey():
+    """Return the journalist's public key, ASCII-armored. It's only exported
+    once, since it doesn't change while the app is running. If the export is
+    empty (e.g. the key hasn't been imported yet), it's tried again next
+    time."""
+    global _journalist_pubkey
+    if not _journalist_pubkey:
+        _journalist_pubkey = gpg.export_keys(config.JOURNALIST_KEY)
+    return _journalist_pubkey
+
+
+def _import_journalist_key(keyring):
+    keyring.import_keys(journalist_pubkey())
+
+
+@timed('gpg')
 def genkeypair(name, secret):
     """
-    >>> if not gpg.list_keys(hash_codename('randomid')):
+    >>> if not getkey(hash_codename('randomid')):
     ...     genkeypair(hash_codename('randomid'), 'randomid').type
     ... else:
     ...     u'P'
@@ -111,35 +263,284 @@ def genkeypair(name, secret):
     """
     name = clean(name)
     secret = hash_codename(secret, salt=SCRYPT_GPG_PEPPER)
-    return gpg.gen_key(gpg.gen_key_input(
+    keyring = source_gpg(name, create=True)
+    _import_journalist_key(keyring)
+    return keyring.gen_key(keyring.gen_key_input(
         key_type=GPG_KEY_TYPE, key_length=GPG_KEY_LENGTH,
         passphrase=secret,
         name_email=name
     ))
 
 
+@contextlib.contextmanager
+def keyring_lock():
+    """Hold the lock on changes to the reply keypairs, across processes."""
+    with open(KEYRING_LOCK_FN, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
 def delete_reply_keypair(source_id):
-    key = getkey(source_id)
-    # If this source was never flagged for review, they won't have a reply
-    # keypair
-    if not key:
+    delete_reply_keypairs([source_id])
+
+
+def delete_reply_keypairs(source_ids):
+    """Delete the reply keypairs of the sources with filesystem ids
+    `source_ids`, skipping sources that don't have one. Keypairs in the
+    shared keyring are all deleted with a single gpg2 run for the secret keys
+    and another for the public keys."""
+    with keyring_lock():
+        _delete_reply_keypairs(source_ids)
+
+
+def _delete_reply_keypairs(source_ids):
+    legacy_keys = []
+    for source_id in source_ids:
+        homedir = source_keyring_dir(source_id)
+        if os.path.isdir(homedir):
+            # The source's keyring only holds their keypair and a copy of the
+            # journalist's public key, so we can just delete the whole thing
+            with _source_gpgs_lock:
+                _source_gpgs.pop(homedir, None)
+            subprocess.check_call(['srm', '-r', homedir])
+            continue
+        # If this source was never flagged for review, they won't have a reply
+        # keypair
+        key = _legacy_key_index().get(source_id)
+        if key:
+            legacy_keys.append((source_id, key))
+
+    if not legacy_keys:
         return
-    # The private key needs to be deleted before the public key can be deleted
-    # http://pythonhosted.org/python-gnupg/#deleting-keys
-    gpg.delete_keys(key, True)  # private key
-    gpg.delete_keys(key)  # public key
-    # TODO: srm?
+    fingerprints = [key for _, key in legacy_keys]
+    # The private keys need to be deleted before the public keys can be
+    # deleted http://pythonhosted.org/python-gnupg/#deleting-keys
+    gpg.delete_keys(fingerprints, True)  # private keys
+    gpg.delete_keys(fingerprints)  # public keys
+    for source_id, _ in legacy_keys:
+        _forget_legacy_key(source_id)
 
 
-def getkey(name):
-    for key in gpg.list_keys():
-        for uid in key['uids']:
-            if name in uid:
-                return key['fingerprint']
-    return None
+_KEYRING_FILES = ('pubring.gpg', 'secring.gpg', 'trustdb.gpg')
 
 
-def encrypt(plaintext, fingerprints, output=None):
+def _keyring_size(homedir):
+    return sum(os.path.getsize(os.path.join(homedir, fn))
+               for fn in _KEYRING_FILES
+               if os.path.exists(os.path.join(homedir, fn)))
+
+
+def _shared_key_lists():
+    return (set(key['fingerprint'] for key in gpg.list_keys()),
+            set(key['fingerprint'] for key in gpg.list_keys(secret=True)))
+
+
+def _compact_shared_keyring():
+    """Copy the shared keyring into a fresh one and move it into place,
+    unless the shared keyring changed while it was being copied. Returns
+    whether it was moved into place."""
+    global _legacy_keys
+    public_keys, secret_keys = _shared_key_lists()
+
+    # Build the new keyring in GPG_KEY_DIR, so it's on the same filesystem
+    # and can be moved into place with atomic renames
+    homedir = tempfile.mkdtemp(prefix='.compact-', dir=config.GPG_KEY_DIR)
+    try:
+        compacted = _make_gpg(homedir)
+        if public_keys:
+            compacted.import_keys(gpg.export_keys(' '.join(public_keys)))
+        if secret_keys:
+            compacted.import_keys(gpg.export_keys(' '.join(secret_keys),
+                                                  secret=True))
+        compacted_keys = (
+            set(key['fingerprint'] for key in compacted.list_keys()),
+            set(key['fingerprint'] for key in compacted.list_keys(secret=True)))
+        if compacted_keys != (public_keys, secret_keys):
+            raise CryptoException("compacted keyring doesn't match the "
+                                  "shared keyring")
+        # The copy is made without holding the lock, so deleting reply
+        # keypairs isn't held up by it. If any were deleted in the meantime
+        # the copy would bring them back, so it's only moved into place if
+        # the shared keyring still holds the same keys.
+        with keyring_lock():
+            if _shared_key_lists() != compacted_keys:
+                return False
+            with _legacy_keys_lock:
+                for fn in _KEYRING_FILES:
+                    if os.path.exists(os.path.join(homedir, fn)):
+                        os.rename(os.path.join(homedir, fn),
+                                  os.path.join(config.GPG_KEY_DIR, fn))
+                _legacy_keys = None
+        return True
+    finally:
+        # Whatever is left may include copies of the secret keys
+        subprocess.check_call(['srm', '-r', homedir])
+
+
+def compact_keyrings(attempts=COMPACT_ATTEMPTS):
+    """Rewrite the shared keyring so it only takes up as much space as the
+    keys it still holds, and remove empty source keyring shards. Returns the
+    sizes in bytes of the shared keyring before and after compaction.
+
+    gpg2 leaves the space of deleted keys in the keyring files, so after many
+    reply keypairs have been deleted from the shared keyring, every gpg2 run
+    still has to read through them. The keys are exported into a fresh
+    keyring, which is then moved into place. If the shared keyring keeps
+    changing while it's being copied, CryptoException is raised after
+    `attempts` copies."""
+    size_before = _keyring_size(config.GPG_KEY_DIR)
+    for _ in range(attempts):
+        if _compact_shared_keyring():
+            break
+    else:
+        raise CryptoException("the shared keyring kept changing while it was "
+                              "being compacted")
+
+    # Remove the shards that no longer hold any source keyrings
+    if os.path.isdir(SOURCE_KEYRINGS_DIR):
+        for shard in os.listdir(SOURCE_KEYRINGS_DIR):
+            try:
+                os.rmdir(os.path.join(SOURCE_KEYRINGS_DIR, shard))
+            except OSError:
+                pass  # not empty
+
+    return size_before, _keyring_size(config.GPG_KEY_DIR)
+
+
+# Number of legacy reply keypairs to move into their own keyrings before
+# deleting them from the shared keyring
+MIGRATE_BATCH_SIZE = 100
+
+
+def _has_keypair(keyring, fingerprint):
+    return (fingerprint in [key['fingerprint']
+                            for key in keyring.list_keys()] and
+            fingerprint in [key['fingerprint']
+                            for key in keyring.list_keys(secret=True)])
+
+
+def _move_legacy_keypair(name, fingerprint):
+    """Copy the reply keypair with `fingerprint` of the source with
+    filesystem id `name` from the shared keyring into a keyring of its own.
+    The keyring is built next to where it belongs and then moved into place,
+    so the apps never see a source keyring without the keypair in it."""
+    homedir = source_keyring_dir(name)
+    if os.path.isdir(homedir):
+        # Moved by an earlier run that didn't get as far as deleting it from
+        # the shared keyring
+        if not _has_keypair(source_gpg(name), fingerprint):
+            raise CryptoException("keyring of {} doesn't hold its reply "
+                                  "keypair".format(name))
+        return
+    shard = os.path.dirname(homedir)
+    if not os.path.isdir(shard):
+        os.makedirs(shard, 0700)
+    tmp_homedir = tempfile.mkdtemp(prefix='.migrate-', dir=shard)
+    try:
+        keyring = _make_gpg(tmp_homedir)
+        _import_journalist_key(keyring)
+        keyring.import_keys(gpg.export_keys(fingerprint))
+        keyring.import_keys(gpg.export_keys(fingerprint, secret=True))
+        if not _has_keypair(keyring, fingerprint):
+            raise CryptoException("couldn't copy the reply keypair of "
+                                  "{}".format(name))
+        os.rename(tmp_homedir, homedir)
+    finally:
+        if os.path.isdir(tmp_homedir):
+            subprocess.check_call(['srm', '-r', tmp_homedir])
+
+
+def migrate_legacy_keypairs(batch_size=MIGRATE_BATCH_SIZE):
+    """Move the reply keypairs in the shared keyring into keyrings of their
+    own, so gpg operations for those sources stop depending on how many
+    there are. Each batch of keypairs is deleted from the shared keyring, in
+    one gpg2 run for the secret keys and another for the public keys, once
+    they've all been copied and verified. It's safe to run again after an
+    interruption. Returns the number of keypairs moved.
+
+    This is run when the package is upgraded (see `./manage.py
+    migrate-reply-keypairs`); run `compact_keyrings` afterwards to reclaim
+    the space in the shared keyring."""
+    # Only reply keypairs have their secret key in the shared keyring; the
+    # journalist's public key stays where it is
+    secret_keys = set(key['fingerprint']
+                      for key in gpg.list_keys(secret=True))
+    legacy_keys = sorted((name, fingerprint) for name, fingerprint
+                         in _legacy_key_index().items()
+                         if fingerprint in secret_keys and
+                         fingerprint != config.JOURNALIST_KEY)
+    moved = 0
+    for i in range(0, len(legacy_keys), batch_size):
+        batch = legacy_keys[i:i + batch_size]
+        # Hold the lock so a keypair can't be deleted while it's being
+        # copied, which would leave the copy behind
+        with keyring_lock():
+            secret_keys = _shared_key_lists()[1]
+            batch = [(name, fingerprint) for name, fingerprint in batch
+                     if fingerprint in secret_keys]
+            if not batch:
+                continue
+            for name, fingerprint in batch:
+                _move_legacy_keypair(name, fingerprint)
+            fingerprints = [fingerprint for _, fingerprint in batch]
+            gpg.delete_keys(fingerprints, True)  # private keys
+            gpg.delete_keys(fingerprints)  # public keys
+            for name, _ in batch:
+                _forget_legacy_key(name)
+        moved += len(batch)
+    return moved
+
+
+_legacy_keys = None
+_legacy_keys_lock = threading.Lock()
+
+
+def _legacy_key_index():
+    """Return a dict of the uid emails (source filesystem ids) of the keys
+    in the shared keyring to their fingerprints. This is built once per
+    process, since new reply keypairs are never added to the shared
+    keyring."""
+    global _legacy_keys
+    with _legacy_keys_lock:
+        if _legacy_keys is None:
+            keys = {}
+            for key in gpg.list_keys():
+                for uid in key['uids']:
+                    match = re.search(r'<([^>]*)>', uid)
+                    if match:
+                        keys[match.group(1)] = key['fingerprint']
+            _legacy_keys = keys
+        return _legacy_keys
+
+
+def _forget_legacy_key(name):
+    with _legacy_keys_lock:
+        if _legacy_keys is not None:
+            _legacy_keys.pop(name, None)
+
+
+@timed('gpg')
+def getkey(name):
+    keyring = source_gpg(name)
+    if keyring is not None:
+        for key in keyring.list_keys():
+            for uid in key['uids']:
+                if name in uid:
+                    return key['fingerprint']
+        return None
+    # Sources flagged before reply keypairs got their own keyrings have their
+    # keypair in the shared keyring
+    return _legacy_key_index().get(name)
+
+
+@timed('gpg')
+def encrypt(plaintext, fingerprints, output=None, sid=None):
+    """Encrypt `plaintext` to `fingerprints`. If `sid` is given, the keys are
+    looked up in the keyring of the source with that filesystem id, which is
+    needed to encrypt to their reply key."""
     # Verify the output path
     if output:
         store.verify(output)
@@ -154,27 +555,45 @@ def encrypt(plaintext, fingerprints, output=None):
     if not _is_stream(plaintext):
         plaintext = _make_binary_stream(plaintext, "utf_8")
 
-    out = gpg.encrypt(plaintext,
-                      *fingerprints,
-                      output=output,
-                      always_trust=True,
-                      armor=False)
+    keyring = _keyring_for(sid) if sid else gpg
+    out = keyring.encrypt(plaintext,
+                          *fingerprints,
+                          output=output,
+                          always_trust=True,
+                          armor=False)
+    if not out.ok and keyring is not gpg and config.JOURNALIST_KEY in fingerprints:
+        # The journalist key may have changed since the source's keyring was
+        # created
+        _import_journalist_key(keyring)
+        plaintext.seek(0)
+        out = keyring.encrypt(plaintext,
+                              *fingerprints,
+                              output=output,
+                              always_trust=True,
+                              armor=False)
     if out.ok:
         return out.data
     else:
         raise CryptoException(out.stderr)
 
 
-def decrypt(secret, ciphertext):
-    """
+@timed('gpg')
+def decrypt(secret, ciphertext, sid=None):
+    """Decrypt `ciphertext` with the reply key of the source with codename
+    `secret`. Pass the source's filesystem id as `sid` if it's known, to
+    avoid hashing the codename again to find their keyring.
+
     >>> key = genkeypair('randomid', 'randomid')
     >>> decrypt('randomid', 'randomid',
     ...   encrypt('randomid', 'Goodbye, cruel world!')
     ... )
     'Goodbye, cruel world!'
     """
+    if sid is None:
+        sid = hash_codename(secret)
     hashed_codename = hash_codename(secret, salt=SCRYPT_GPG_PEPPER)
-    return gpg.decrypt(ciphertext, passphrase=hashed_codename).data
+    return _keyring_for(sid).decrypt(
+        ciphertext, passphrase=hashed_codename).data
 
 if __name__ == "__main__":
     import doctest
@@ -1,7 +1,9 @@
 import os
 import datetime
+import time
 import base64
 import binascii
+import hmac
 
 # Find the best implementation available on this platform
 try:
@@ -9,22 +11,22 @@ try:
 except:
     from StringIO import StringIO
 
-from sqlalchemy import create_engine, ForeignKey
+from sqlalchemy import (create_engine, ForeignKey, Index, bindparam, func,
+                        inspect, literal, select, union_all)
 from sqlalchemy.orm import scoped_session, sessionmaker, relationship, backref
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import Column, Integer, String, Boolean, DateTime, Binary
 from sqlalchemy.orm.exc import MultipleResultsFound, NoResultFound
+from redis.exceptions import RedisError
 
 import scrypt
-import pyotp
-
-import qrcode
-# Using svg because it doesn't require additional dependencies
-import qrcode.image.svg
+# pyotp and qrcode are only needed for logging in and setting up two-factor
+# authentication, so they're imported when first used, to speed up startup
 
 import config
 import crypto_util
 import store
+import worker
 
 LOGIN_HARDENING = True
 # Unfortunately, the login hardening measures mess with the tests in
@@ -122,9 +124,67 @@ class Source(Base):
         collection = []
         collection.extend(self.submissions)
         collection.extend(self.replies)
-        collection.sort(key=lambda x: int(x.filename.split('-')[0]))
+        collection.sort(key=lambda x: x.interaction_index)
         return collection
 
+    def collection_page(self, page, per_page):
+        """Return page `page` (counting from 1) of `collection`, with
+        `per_page` submissions and replies per page. Only the submissions and
+        replies on the page are loaded."""
+        items = union_all(
+            select([literal('submission').label('type'),
+                    Submission.id.label('id'),
+                    Submission.interaction_index.label('interaction_index')])
+            .where(Submission.source_id == self.id),
+            select([literal('reply').label('type'),
+                    Reply.id.label('id'),
+                    Reply.interaction_index.label('interaction_index')])
+            .where(Reply.source_id == self.id)).alias('items')
+        rows = db_session.execute(
+            select([items.c.type, items.c.id])
+            .order_by(items.c.interaction_index, items.c.type, items.c.id)
+            .limit(per_page).offset((page - 1) * per_page)).fetchall()
+
+        loaded = {}
+        for type_, model in (('submission', Submission), ('reply', Reply)):
+            ids = [id for row_type, id in rows if row_type == type_]
+            if ids:
+                for item in model.query.filter(model.id.in_(ids)):
+                    loaded[(type_, item.id)] = item
+        return [loaded[(type_, id)] for type_, id in rows]
+
+    def collection_items(self, filenames):
+        """Return the submissions and replies in this source's collection
+        that are named in `filenames`, sorted like `collection`. Only those
+        submissions and replies are loaded."""
+        items = []
+        if filenames:
+            for model in (Submission, Reply):
+                items.extend(model.query.filter(
+                    model.source_id == self.id,
+                    model.filename.in_(filenames)))
+        items.sort(key=lambda x: x.interaction_index)
+        return items
+
+    def collection_totals(self):
+        """Return the number of submissions and replies in this source's
+        collection and their total size in bytes, as a dict with 'count' and
+        'size' keys."""
+        totals = {'count': 0, 'size': 0}
+        for model in (Submission, Reply):
+            count, size = db_session.query(
+                func.count(model.id), func.coalesce(func.sum(model.size), 0)
+            ).filter(model.source_id == self.id).one()
+            totals['count'] += count
+            totals['size'] += size
+        return totals
+
+
+def interaction_index(filename):
+    """Return the interaction count that a submission or reply filename
+    starts with."""
+    return int(filename.split('-')[0])
+
 
 class Submission(Base):
     __tablename__ = 'submissions'
@@ -138,11 +198,18 @@ class Submission(Base):
     filename = Column(String(255), nullable=False)
     size = Column(Integer, nullable=False)
     downloaded = Column(Boolean, default=False)
+    # The source's interaction count when this was submitted, which orders
+    # the source's collection
+    interaction_index = Column(Integer)
+
+    __table_args__ = (Index('ix_submissions_source_id_interaction_index',
+                            'source_id', 'interaction_index'),)
 
     def __init__(self, source, filename):
         self.source_id = source.id
         self.filename = filename
         self.size = os.stat(store.path(source.filesystem_id, filename)).st_size
+        self.interaction_index = interaction_index(filename)
 
     def __repr__(self):
         return '<Submission %r>' % (self.filename)
@@ -167,12 +234,19 @@ class Reply(Base):
 
     filename = Column(String(255), nullable=False)
     size = Column(Integer, nullable=False)
+    # The source's interaction count when this was sent, which orders the
+    # source's collection
+    interaction_index = Column(Integer)
+
+    __table_args__ = (Index('ix_replies_source_id_interaction_index',
+                            'source_id', 'interaction_index'),)
 
     def __init__(self, journalist, source, filename):
         self.journalist_id = journalist.id
         self.source_id = source.id
         self.filename = filename
         self.size = os.stat(store.path(source.filesystem_id, filename)).st_size
+        self.interaction_index = interaction_index(filename)
 
     def __repr__(self):
         return '<Reply %r>' % (self.filename)
@@ -226,6 +300,40 @@ class InvalidPasswordLength(Exception):
             return "Password too long (len={})".format(self.pw_len)
 
 
+# Expected OTP codes, keyed by (secret, counter). For TOTP the counter is the
+# time step, so the same codes are reused by every verification within a step.
+_otp_codes_cache = {}
+_OTP_CODES_CACHE_SIZE = 4096
+
+
+def _random_base32():
+    import pyotp
+    return pyotp.random_base32()
+
+
+def _expected_otp_codes(otp, counters):
+    """Return the codes generated by the pyotp.OTP `otp` for each of
+    `counters`."""
+    if len(_otp_codes_cache) > _OTP_CODES_CACHE_SIZE:
+        _otp_codes_cache.clear()
+    codes = []
+    for counter in counters:
+        key = (otp.secret, counter)
+        if key not in _otp_codes_cache:
+            _otp_codes_cache[key] = otp.generate_otp(counter)
+        codes.append(_otp_codes_cache[key])
+    return codes
+
+
+def _token_matches(token, code):
+    """Compare a user-supplied token to an expected OTP code in constant
+    time"""
+    try:
+        return hmac.compare_digest(str(token), str(code))
+    except UnicodeEncodeError:
+        return False
+
+
 class Journalist(Base):
     __tablename__ = "journalists"
     id = Column(Integer, primary_key=True)
@@ -234,7 +342,7 @@ class Journalist(Base):
     pw_hash = Column(Binary(256))
     is_admin = Column(Boolean)
 
-    otp_secret = Column(String(16), default=pyotp.random_base32)
+    otp_secret = Column(String(16), default=_random_base32)
     is_totp = Column(Boolean, default=True)
     hotp_counter = Column(Integer, default=0)
     last_token = Column(String(6))
@@ -283,7 +391,7 @@ class Journalist(Base):
         return self._scrypt_hash(password, self.pw_salt) == self.pw_hash
 
     def regenerate_totp_shared_secret(self):
-        self.otp_secret = pyotp.random_base32()
+        self.otp_secret = _random_base32()
 
     def set_hotp_secret(self, otp_secret):
         self.is_totp = False
@@ -296,14 +404,20 @@ class Journalist(Base):
 
     @property
     def totp(self):
+        import pyotp
         return pyotp.TOTP(self.otp_secret)
 
     @property
     def hotp(self):
+        import pyotp
         return pyotp.HOTP(self.otp_secret)
 
     @property
     def shared_secret_qrcode(self):
+        import qrcode
+        # Using svg because it doesn't require additional dependencies
+        import qrcode.image.svg
+
         uri = self.totp.provisioning_uri(
             self.username,
             issuer_name="SecureDrop")
@@ -332,7 +446,19 @@ class Journalist(Base):
         """Strips from authentication tokens the whitespace that many clients add for readability"""
         return ''.join(token.split())
 
+    # Number of TOTP time steps before and after the current one to accept,
+    # to compensate for clock skew between the client and the server. The
+    # total valid window is 1:30s.
+    _TOTP_VALID_WINDOW = 1
+    # Number of HOTP counter values to look ahead, in case the user generated
+    # tokens without using them
+    _HOTP_LOOKAHEAD = 20
+
     def verify_token(self, token):
+        """Check `token` against the journalist's TOTP or HOTP secret.
+
+        This updates `last_token` (and `hotp_counter` for HOTP) but doesn't
+        commit them; the caller is responsible for saving the changes."""
         token = self._format_token(token)
 
         # Only allow each authentication token to be used once. This
@@ -341,44 +467,62 @@ class Journalist(Base):
             raise BadTokenException("previously used token {}".format(token))
         else:
             self.last_token = token
-            db_session.commit()
 
         if self.is_totp:
-            # Also check the given token against the previous and next
-            # valid tokens, to compensate for potential time skew
-            # between the client and the server. The total valid
-            # window is 1:30s.
-            return self.totp.verify(token, valid_window=1)
+            totp = self.totp
+            now = totp.timecode(datetime.datetime.now())
+            counters = range(now - self._TOTP_VALID_WINDOW,
+                             now + self._TOTP_VALID_WINDOW + 1)
+            return any(_token_matches(token, code)
+                       for code in _expected_otp_codes(totp, counters))
         else:
-            for counter_val in range(
-                    self.hotp_counter,
-                    self.hotp_counter + 20):
-                if self.hotp.verify(token, counter_val):
+            counters = range(self.hotp_counter,
+                             self.hotp_counter + self._HOTP_LOOKAHEAD)
+            codes = _expected_otp_codes(self.hotp, counters)
+            for counter_val, code in zip(counters, codes):
+                if _token_matches(token, code):
                     self.hotp_counter = counter_val + 1
-                    db_session.commit()
                     return True
             return False
 
+    _LOGIN_ATTEMPT_PERIOD = 60  # seconds
+    _MAX_LOGIN_ATTEMPTS_PER_PERIOD = 5
+
     @classmethod
-    def throttle_login(cls, user):
-        _LOGIN_ATTEMPT_PERIOD = 60  # seconds
-        _MAX_LOGIN_ATTEMPTS_PER_PERIOD = 5
+    def _record_login_attempt(cls, user):
+        """Record a login attempt for `user` and return the number of attempts
+        they have made within the last `_LOGIN_ATTEMPT_PERIOD` seconds.
+
+        Attempts are kept in a short, per-user list in Redis so the cost of
+        this check does not depend on how many attempts have ever been made.
+        If Redis is unavailable we fall back to the login attempt table."""
+        now = time.time()
+        key = 'journalist_login_attempts:{}'.format(user.id)
+        try:
+            pipe = worker.redis.pipeline()
+            pipe.lpush(key, now)
+            # We never need more than one attempt past the threshold to decide
+            # whether to throttle
+            pipe.ltrim(key, 0, cls._MAX_LOGIN_ATTEMPTS_PER_PERIOD)
+            pipe.expire(key, cls._LOGIN_ATTEMPT_PERIOD)
+            pipe.lrange(key, 0, -1)
+            attempts = pipe.execute()[-1]
+        except RedisError:
+            return JournalistLoginAttempt.record(user, cls._LOGIN_ATTEMPT_PERIOD)
+        return len([t for t in attempts
+                    if float(t) > now - cls._LOGIN_ATTEMPT_PERIOD])
 
+    @classmethod
+    def throttle_login(cls, user):
         # Record the login attempt...
-        login_attempt = JournalistLoginAttempt(user)
-        db_session.add(login_attempt)
-        db_session.commit()
+        attempts_within_period = cls._record_login_attempt(user)
 
         # ...and reject it if they have exceeded the threshold
-        login_attempt_period = datetime.datetime.utcnow() - \
-            datetime.timedelta(seconds=_LOGIN_ATTEMPT_PERIOD)
-        attempts_within_period = JournalistLoginAttempt.query.filter(
-            JournalistLoginAttempt.timestamp > login_attempt_period).all()
-        if len(attempts_within_period) > _MAX_LOGIN_ATTEMPTS_PER_PERIOD:
+        if attempts_within_period > cls._MAX_LOGIN_ATTEMPTS_PER_PERIOD:
             raise LoginThrottledException(
                 "throttled ({} attempts in last {} seconds)".format(
-                    len(attempts_within_period),
-                    _LOGIN_ATTEMPT_PERIOD))
+                    attempts_within_period,
+                    cls._LOGIN_ATTEMPT_PERIOD))
 
     @classmethod
     def login(cls, username, password, token):
@@ -391,10 +535,15 @@ class Journalist(Base):
         if LOGIN_HARDENING:
             cls.throttle_login(user)
 
-        if not user.verify_token(token):
-            raise BadTokenException("invalid token")
-        if not user.valid_password(password):
-            raise WrongPasswordException("invalid password")
+        try:
+            if not user.verify_token(token):
+                raise BadTokenException("invalid token")
+            if not user.valid_password(password):
+                raise WrongPasswordException("invalid password")
+            user.last_access = datetime.datetime.utcnow()
+        finally:
+            # Save the used token, HOTP counter and access time together
+            db_session.commit()
         return user
 
 
@@ -405,13 +554,72 @@ class JournalistLoginAttempt(Base):
     passwords or two factor tokens."""
     __tablename__ = "journalist_login_attempt"
     id = Column(Integer, primary_key=True)
-    timestamp = Column(DateTime, default=datetime.datetime.utcnow)
+    timestamp = Column(DateTime, default=datetime.datetime.utcnow,
+                       index=True)
     journalist_id = Column(Integer, ForeignKey('journalists.id'))
 
     def __init__(self, journalist):
         self.journalist_id = journalist.id
 
+    @classmethod
+    def record(cls, journalist, period):
+        """Store a login attempt for `journalist` and return the number of
+        attempts they have made in the last `period` seconds."""
+        db_session.add(cls(journalist))
+        db_session.commit()
+        since = datetime.datetime.utcnow() - \
+            datetime.timedelta(seconds=period)
+        return cls.query.filter(cls.journalist_id == journalist.id,
+                                cls.timestamp > since).count()
+
+    @classmethod
+    def prune(cls, period=Journalist._LOGIN_ATTEMPT_PERIOD):
+        """Delete login attempts that are too old to affect throttling.
+        Returns the number of rows deleted."""
+        cutoff = datetime.datetime.utcnow() - \
+            datetime.timedelta(seconds=period)
+        deleted = cls.query.filter(cls.timestamp <= cutoff).delete(
+            synchronize_session=False)
+        db_session.commit()
+        return deleted
+
 
 # Declare (or import) models before init_db
 def init_db():
     Base.metadata.create_all(bind=engine)
+
+
+def _create_missing_indexes(table, bind=engine):
+    """Create `table`'s indexes that the database doesn't have yet, like
+    CREATE INDEX IF NOT EXISTS (which MySQL doesn't support)."""
+    existing = [index['name'] for index in
+                inspect(bind).get_indexes(table.name)]
+    for index in table.indexes:
+        if index.name not in existing:
+            index.create(bind=bind)
+
+
+def migrate_db(bind=engine):
+    """Bring an existing database up to date with the models. `init_db` only
+    creates missing tables, so columns that were added to existing tables
+    are added (and filled in) here, along with their indexes. This is run
+    when the package is installed or upgraded, before the apps start."""
+    Base.metadata.create_all(bind=bind)
+    for table in (Submission.__table__, Reply.__table__):
+        columns = [column['name'] for column in
+                   inspect(bind).get_columns(table.name)]
+        if 'interaction_index' not in columns:
+            bind.execute('ALTER TABLE {} ADD COLUMN interaction_index '
+                         'INTEGER'.format(table.name))
+        rows = bind.execute(
+            select([table.c.id, table.c.filename])
+            .where(table.c.interaction_index == None)).fetchall()
+        if rows:
+            bind.execute(
+                table.update().where(table.c.id == bindparam('row_id'))
+                .values(interaction_index=bindparam('index')),
+                [{'row_id': id, 'index': interaction_index(filename)}
+                 for id, filename in rows])
+        _create_missing_indexes(table, bind)
+    # The timestamp index that pruning old login attempts relies on
+    _create_missing_indexes(JournalistLoginAttempt.__table__, bind)
@@ -3,20 +3,30 @@ import sys
 import os
 from datetime import datetime
 import functools
+import itertools
+import threading
+import time
 
 from flask import (Flask, request, render_template, send_file, redirect, flash,
-                   url_for, g, abort, session)
+                   url_for, g, abort, session, jsonify, has_app_context)
 from flask_wtf.csrf import CsrfProtect
-from flask_assets import Environment
+from flask_assets import Environment, Bundle
+from redis.exceptions import RedisError
+from werkzeug.datastructures import ContentRange
+from werkzeug.http import parse_date
+from sqlalchemy import event
 from sqlalchemy.orm.exc import MultipleResultsFound, NoResultFound
 from sqlalchemy.exc import IntegrityError
 
 import config
 import version
 import crypto_util
+import metrics
 import store
+import static_files
+import template_cache
 import template_filters
-from db import (db_session, Source, Journalist, Submission, Reply,
+from db import (db_session, engine, Source, Journalist, Submission, Reply,
                 SourceStar, get_one_or_else, NoResultFound,
                 WrongPasswordException, BadTokenException,
                 LoginThrottledException, InvalidPasswordLength)
@@ -24,9 +34,19 @@ import worker
 
 app = Flask(__name__, template_folder=config.JOURNALIST_TEMPLATES_DIR)
 app.config.from_object(config.JournalistInterfaceFlaskConfig)
+metrics.init_app(app, engine, getattr(config, 'REQUEST_METRICS', False))
 CsrfProtect(app)
 
+template_cache.init_app(app)
+
 assets = Environment(app)
+assets.register('journalist_css', Bundle(
+    'css/normalize.css', 'css/journalist.css', 'css/font-awesome.css',
+    filters='cssmin', output='gen/journalist.%(version)s.css'))
+assets.register('journalist_js', Bundle(
+    'js/libs/jquery-2.1.4.min.js', 'js/journalist.js',
+    filters='jsmin', output='gen/journalist.%(version)s.js'))
+static_files.init_app(app, assets)
 
 app.jinja_env.globals['version'] = version.__version__
 if getattr(config, 'CUSTOM_HEADER_IMAGE', None):
@@ -46,9 +66,118 @@ def shutdown_session(exception=None):
     db_session.remove()
 
 
+# Journalist records change rarely, so instead of querying for them on every
+# request we keep detached copies for a short time. Any change to a journalist
+# clears this process's cache and, once committed, bumps a generation counter
+# in Redis (see `invalidate_journalist_cache`), so the other processes drop
+# their copies on their next request rather than serving revoked admin rights
+# or 2FA secrets. If Redis can't be reached, nothing is served from the cache.
+JOURNALIST_CACHE_TTL = 30  # seconds
+JOURNALIST_CACHE_GENERATION_KEY = 'journalist_cache_generation'
+# The tests recreate the database between test cases, so a cached journalist
+# could outlive the row it was loaded from.
+if os.environ.get('SECUREDROP_ENV') == 'test':
+    JOURNALIST_CACHE_TTL = 0
+_journalist_cache = {}
+_journalist_cache_lock = threading.Lock()
+
+
+def _journalist_cache_generation():
+    """Return the current generation of the journalist cache, or None if it
+    can't be read from Redis."""
+    try:
+        return worker.redis.get(JOURNALIST_CACHE_GENERATION_KEY) or '0'
+    except RedisError:
+        return None
+
+
+def _cached_journalist_data(key, load):
+    """Return the value cached under `key`, calling `load` to (re)populate the
+    cache if it is missing, expired or from an older generation."""
+    now = time.time()
+    generation = _journalist_cache_generation()
+    if generation is None:
+        return load()
+    with _journalist_cache_lock:
+        expires, cached_generation, value = _journalist_cache.get(
+            key, (0, None, None))
+    if expires > now and cached_generation == generation:
+        return value
+
+    value = load()
+    with _journalist_cache_lock:
+        _journalist_cache[key] = (now + JOURNALIST_CACHE_TTL, generation,
+                                  value)
+    return value
+
+
+@event.listens_for(db_session, 'before_flush')
+def invalidate_journalist_cache(session, flush_context=None, instances=None):
+    """Clear the journalist cache whenever a journalist is added, changed, or
+    deleted, and remember to tell the other processes once the change is
+    committed."""
+    if any(isinstance(obj, Journalist)
+           for obj in itertools.chain(session.new, session.dirty,
+                                      session.deleted)):
+        session.info['journalists_changed'] = True
+        with _journalist_cache_lock:
+            _journalist_cache.clear()
+
+
+@event.listens_for(db_session, 'after_commit')
+def bump_journalist_cache_generation(session):
+    """Make every process drop its cached journalists after a change to them
+    is committed."""
+    if session.info.pop('journalists_changed', False):
+        with _journalist_cache_lock:
+            _journalist_cache.clear()
+        try:
+            worker.redis.incr(JOURNALIST_CACHE_GENERATION_KEY)
+        except RedisError:
+            # The other processes will pick up the change when their copies
+            # expire
+            app.logger.warning("Couldn't invalidate the journalist cache of "
+                               "other processes")
+
+
+@event.listens_for(db_session, 'after_rollback')
+def forget_journalist_changes(session):
+    session.info.pop('journalists_changed', None)
+
+
+def get_journalist(uid):
+    """Return the Journalist with id `uid` attached to the current database
+    session, or None if there is no such journalist."""
+    def load():
+        user = Journalist.query.get(uid)
+        if user:
+            db_session.expunge(user)
+        return user
+
+    user = _cached_journalist_data(('journalist', uid), load)
+    if user:
+        # Each request gets its own copy of the cached (detached) journalist
+        return db_session.merge(user, load=False)
+    return None
+
+
+def get_journalist_usernames():
+    """Return the usernames of all journalists, sorted by username. Each entry
+    has a `username` attribute."""
+    return _cached_journalist_data(
+        'usernames',
+        lambda: db_session.query(Journalist.username)
+                          .order_by(Journalist.username)
+                          .all())
+
+
 def get_source(sid):
     """Return a Source object, representing the database row, for the source
     with id `sid`"""
+    # Reuse the source loaded by setup_g for this request, if any
+    if has_app_context() and g.get('sid') == sid and g.get('source'):
+        return g.source
+
     source = None
     query = Source.query.filter(Source.filesystem_id == sid)
     source = get_one_or_else(query, app.logger, abort)
@@ -61,7 +190,7 @@ def setup_g():
     """Store commonly used values in Flask's special g object"""
     uid = session.get('uid', None)
     if uid:
-        g.user = Journalist.query.get(uid)
+        g.user = get_journalist(uid)
 
     if request.method == 'POST':
         sid = request.form.get('sid')
@@ -130,11 +259,6 @@ def login():
             app.logger.info("Successful login for '{}' with token {}".format(
                 request.form['username'], request.form['token']))
 
-            # Update access metadata
-            user.last_access = datetime.utcnow()
-            db_session.add(user)
-            db_session.commit()
-
             session['uid'] = user.id
             return redirect(url_for('index'))
 
@@ -154,6 +278,15 @@ def admin_index():
     return render_template("admin.html", users=users)
 
 
+@app.route('/admin/metrics')
+@admin_required
+def admin_metrics():
+    """Time spent handling requests to each page of both interfaces, broken
+    down by scrypt, gpg, SQL, store and template rendering time. Only
+    recorded if REQUEST_METRICS is set in config.py."""
+    return jsonify(metrics.snapshot())
+
+
 @app.route('/admin/add', methods=('GET', 'POST'))
 @admin_required
 def admin_add_user():
@@ -211,7 +344,9 @@ def admin_new_user_two_factor():
 
     if request.method == 'POST':
         token = request.form['token']
-        if user.verify_token(token):
+        verified = user.verify_token(token)
+        db_session.commit()
+        if verified:
             flash(
                 "Two factor token successfully verified for user {}!".format(
                     user.username),
@@ -341,7 +476,9 @@ def account_new_two_factor():
 
     if request.method == 'POST':
         token = request.form['token']
-        if user.verify_token(token):
+        verified = user.verify_token(token)
+        db_session.commit()
+        if verified:
             flash(
                 "Two factor token successfully verified!",
                 "notification")
@@ -431,7 +568,7 @@ def index():
             Submission.query.filter_by(source_id=source.id,
                                        downloaded=False).all())
 
-    journalists = Journalist.query.order_by(Journalist.username).all()
+    journalists = get_journalist_usernames()
 
     return render_template('index.html', unstarred=unstarred, starred=starred, journalists=journalists)
 
@@ -453,26 +590,69 @@ def change_assignment(sid):
 
     return redirect(url_for('index'))
 
+
+# Number of submissions and replies shown per page of a collection
+COLLECTION_PAGE_SIZE = 100
+
+
 @app.route('/col/<sid>')
 @login_required
 def col(sid):
     source = get_source(sid)
     source.has_key = crypto_util.getkey(sid)
-    return render_template("col.html", sid=sid, source=source)
+    totals = source.collection_totals()
+    num_pages = max(1, -(-totals['count'] // COLLECTION_PAGE_SIZE))
+    page = min(max(request.args.get('page', 1, type=int), 1), num_pages)
+    return render_template("col.html", sid=sid, source=source,
+                           docs=source.collection_page(page,
+                                                       COLLECTION_PAGE_SIZE),
+                           totals=totals, page=page, num_pages=num_pages)
 
 
-def delete_collection(source_id):
-    # Delete the source's collection of submissions
-    job = worker.enqueue(store.delete_source_directory, source_id)
+# Collections are deleted by one job for each group of at most this many
+# sources, or of sources whose submissions and replies add up to at most this
+# many bytes, so every job can finish well within the bulk queue's timeout.
+# Larger collections get a job of their own.
+DELETE_BATCH_SOURCES = 20
+DELETE_BATCH_BYTES = 2 * 1024 ** 3
 
-    # Delete the source's reply keypair
-    crypto_util.delete_reply_keypair(source_id)
 
-    # Delete their entry in the db
+def delete_collection(source_id):
     source = get_source(source_id)
-    db_session.delete(source)
+    return delete_collections([source])[0]
+
+
+def delete_batches(sources):
+    """Split `sources` into the groups whose collections are deleted by one
+    job, as lists of filesystem ids."""
+    batches = []
+    batch, batch_size = [], 0
+    for source in sources:
+        size = source.collection_totals()['size']
+        if batch and (len(batch) == DELETE_BATCH_SOURCES or
+                      batch_size + size > DELETE_BATCH_BYTES):
+            batches.append(batch)
+            batch, batch_size = [], 0
+        batch.append(source.filesystem_id)
+        batch_size += size
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def delete_collections(sources):
+    """Delete the collections of `sources`, with a job deleting the reply
+    keypairs and submissions of each group of them from `delete_batches`,
+    and one commit. Returns the jobs."""
+    # Delete the sources' reply keypairs and collections of submissions
+    jobs = [worker.enqueue(store.delete_source_directories, batch)
+            for batch in delete_batches(sources)]
+
+    # Delete their entries in the db
+    for source in sources:
+        db_session.delete(source)
     db_session.commit()
-    return job
+    return jobs
 
 
 @app.route('/col/process', methods=('POST',))
@@ -496,13 +676,17 @@ def col_process():
     return method(cols_selected)
 
 
+def selected_submissions(cols_selected):
+    """Query the submissions of the sources in `cols_selected`, without
+    loading the sources' collections."""
+    return Submission.query.join(Source).filter(
+        Source.filesystem_id.in_(cols_selected))
+
+
 def col_download_unread(cols_selected):
     """Download all unread submissions from all selected sources."""
-    submissions = []
-    for sid in cols_selected:
-        id = Source.query.filter(Source.filesystem_id == sid).one().id
-        submissions += Submission.query.filter(Submission.downloaded == False,
-                                               Submission.source_id == id).all()
+    submissions = selected_submissions(cols_selected).filter(
+        Submission.downloaded == False).all()
     if submissions == []:
         flash("No unread submissions in collections selected!", "error")
         return redirect(url_for('index'))
@@ -511,11 +695,7 @@ def col_download_unread(cols_selected):
 
 def col_download_all(cols_selected):
     """Download all submissions from all selected sources."""
-    submissions = []
-    for sid in cols_selected:
-        id = Source.query.filter(Source.filesystem_id == sid).one().id
-        submissions += Submission.query.filter(Submission.source_id == id).all()
-    return download("all", submissions)
+    return download("all", selected_submissions(cols_selected).all())
 
 
 def col_star(cols_selected):
@@ -551,8 +731,8 @@ def col_delete(cols_selected):
     if len(cols_selected) < 1:
         flash("No collections selected to delete!", "error")
     else:
-        for source_id in cols_selected:
-            delete_collection(source_id)
+        delete_collections(Source.query.filter(
+            Source.filesystem_id.in_(cols_selected)).all())
         flash("%s %s deleted" % (
             len(cols_selected),
             "collection" if len(cols_selected) == 1 else "collections"
@@ -561,6 +741,78 @@ def col_delete(cols_selected):
     return redirect(url_for('index'))
 
 
+# Size of the chunks in which partial responses are read and sent
+SEND_FILE_CHUNK_SIZE = 64 * 1024
+
+
+def _read_file_range(filename, start, stop):
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            chunk = f.read(min(SEND_FILE_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def send_file_ranged(filename, **kwargs):
+    """Like `send_file`, but also handles conditional requests
+    (If-Modified-Since), and byte range requests with If-Range, so an
+    interrupted download can be resumed. When X-Sendfile is used, the web
+    server handles range requests itself.
+
+    The files are validated by their Last-Modified date only: the production
+    vhost removes ETags (see the app role's journalist.conf), so clients
+    never get one to send back."""
+    # send_file only handles conditional requests when it adds an ETag
+    response = send_file(filename, add_etags=False, **kwargs)
+    response = response.make_conditional(request)
+    if response.status_code == 304:
+        # Some servers ignore the 304 status code for X-Sendfile
+        response.headers.pop('X-Sendfile', None)
+    # Let the browser keep a copy, but make it check whether the copy is
+    # still current before using it
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.cache_control.max_age = None
+    response.headers.pop('Expires', None)
+    response.accept_ranges = 'bytes'
+    # A request for several ranges is answered with the whole file, which
+    # RFC 7233 allows for any range request
+    if (response.status_code != 200 or app.use_x_sendfile or
+            request.range is None or len(request.range.ranges) != 1):
+        return response
+
+    # Only send part of the file if it hasn't changed since the client got
+    # the rest of it
+    if_range = request.headers.get('If-Range')
+    if if_range:
+        date = parse_date(if_range)
+        if (date is None or response.last_modified is None or
+                response.last_modified > date):
+            return response
+
+    length = os.path.getsize(filename)
+    byte_range = request.range.range_for_length(length)
+    response.close()
+    if byte_range is None:
+        response.status_code = 416
+        response.response = []
+        response.content_range = ContentRange('bytes', None, None, length)
+        response.content_length = 0
+        return response
+
+    start, stop = byte_range
+    response.status_code = 206
+    response.response = _read_file_range(filename, start, stop)
+    response.content_range = ContentRange('bytes', start, stop, length)
+    response.content_length = stop - start
+    return response
+
+
 @app.route('/col/<sid>/<fn>')
 @login_required
 def download_single_submission(sid, fn):
@@ -574,8 +826,11 @@ def download_single_submission(sid, fn):
         db_session.commit()
     except NoResultFound as e:
         app.logger.error("Could not mark " + fn + " as downloaded: %s" % (e,))
+    else:
+        store.delete_unread_archive(sid)
 
-    return send_file(store.path(sid, fn), mimetype="application/pgp-encrypted")
+    return send_file_ranged(store.path(sid, fn),
+                            mimetype="application/pgp-encrypted")
 
 
 @app.route('/reply', methods=('POST',))
@@ -586,7 +841,7 @@ def reply():
                                           g.source.journalist_filename)
     crypto_util.encrypt(request.form['msg'],
                         [crypto_util.getkey(g.sid), config.JOURNALIST_KEY],
-                        output=store.path(g.sid, filename))
+                        output=store.path(g.sid, filename), sid=g.sid)
     reply = Reply(g.user, g.source, filename)
     db_session.add(reply)
     db_session.commit()
@@ -601,7 +856,9 @@ def generate_code():
     original_journalist_designation = g.source.journalist_designation
     g.source.journalist_designation = crypto_util.display_id()
 
-    for item in g.source.collection:
+    for item in itertools.chain(
+            Submission.query.filter(Submission.source_id == g.source.id),
+            Reply.query.filter(Reply.source_id == g.source.id)):
         item.filename = store.rename_submission(
             g.sid,
             item.filename,
@@ -626,7 +883,10 @@ def download_unread_sid(sid):
         flash("No unread submissions for this source!")
         return redirect(url_for('col', sid=sid))
     source = get_source(sid)
-    return download(source.journalist_filename, submissions)
+    # Use the archive pre-built by the worker, if it's up to date
+    zf = store.take_unread_archive(sid, source.journalist_filename,
+                                   [s.filename for s in submissions])
+    return download(source.journalist_filename, submissions, zf=zf)
 
 
 @app.route('/bulk', methods=('POST',))
@@ -635,8 +895,7 @@ def bulk():
     action = request.form['action']
 
     doc_names_selected = request.form.getlist('doc_names_selected')
-    selected_docs = [doc for doc in g.source.collection
-                     if doc.filename in doc_names_selected]
+    selected_docs = g.source.collection_items(doc_names_selected)
     if selected_docs == []:
         if action == 'download':
             flash("No collections selected to download!", "error")
@@ -663,11 +922,12 @@ def confirm_bulk_delete(sid, items_selected):
 
 
 def bulk_delete(sid, items_selected):
+    worker.enqueue(store.secure_unlink_many,
+                   [store.path(sid, item.filename) for item in items_selected])
     for item in items_selected:
-        item_path = store.path(sid, item.filename)
-        worker.enqueue(store.secure_unlink, item_path)
         db_session.delete(item)
     db_session.commit()
+    store.delete_unread_archive(sid)
 
     flash(
         "Submission{} deleted.".format(
@@ -676,7 +936,7 @@ def bulk_delete(sid, items_selected):
     return redirect(url_for('col', sid=sid))
 
 
-def download(zip_basename, submissions):
+def download(zip_basename, submissions, zf=None):
     """Send client contents of zipfile *zip_basename*-<timestamp>.zip
     containing *submissions*. The zipfile, being a
     :class:`tempfile.NamedTemporaryFile`, is stored on disk only
@@ -686,23 +946,30 @@ def download(zip_basename, submissions):
 
     :param list submissions: A list of :class:`db.Submission`s to 
                              include in the zipfile.
+
+    :param file zf: An already built zipfile of *submissions*, if any.
     """
     # Mark the submissions that are about to be downloaded as such
     for submission in submissions:
         submission.downloaded = True
     db_session.commit()
 
-    filenames = [store.path(submission.source.filesystem_id,
-                            submission.filename)
-                 for submission in submissions]
-
-    zf = store.get_bulk_archive(filenames,
-                                zip_directory=zip_basename)
+    # The pre-built archives of their unread submissions are out of date now
+    for sid in set(submission.source.filesystem_id
+                   for submission in submissions):
+        store.delete_unread_archive(sid)
+
+    if zf is None:
+        filenames = [store.path(submission.source.filesystem_id,
+                                submission.filename)
+                     for submission in submissions]
+        zf = store.get_bulk_archive(filenames,
+                                    zip_directory=zip_basename)
     attachment_filename = "{}--{}.zip".format(
         zip_basename, datetime.utcnow().strftime("%Y-%m-%d--%H-%M-%S"))
-    return send_file(zf.name, mimetype="application/zip",
-                     attachment_filename=attachment_filename,
-                     as_attachment=True)
+    return send_file_ranged(zf.name, mimetype="application/zip",
+                            attachment_filename=attachment_filename,
+                            as_attachment=True)
 
 
 @app.route('/flag', methods=('POST',))
@@ -714,6 +981,17 @@ def flag():
                            codename=g.source.journalist_designation)
 
 
+def warm_up():
+    """Do the work that's otherwise left until the first request needs it:
+    the runtime tests, starting gpg, compiling the templates and building the
+    asset bundles. Pre-fork servers should call this before forking, so their
+    workers start ready."""
+    crypto_util.warm_up()
+    template_cache.compile_templates(app)
+    with app.test_request_context():
+        render_template('login.html')
+
+
 def write_pidfile():
     pid = str(os.getpid())
     with open(config.JOURNALIST_PIDFILE, 'w') as fp:
@@ -722,5 +1000,6 @@ def write_pidfile():
 
 if __name__ == "__main__":
     write_pidfile()
+    warm_up()
     debug = getattr(config, 'env', 'prod') != 'prod'
     app.run(debug=debug, host='0.0.0.0', port=8081)
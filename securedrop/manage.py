@@ -11,8 +11,9 @@ from sqlalchemy.orm.exc import NoResultFound
 
 from getpass import getpass
 from argparse import ArgumentParser
-from db import db_session, Journalist
-from management import run
+from db import db_session, Journalist, JournalistLoginAttempt
+from management import run, populate, worker_metrics
+import worker
 
 # We need to import config in each function because we're running the tests
 # directly, so it's important to set the environment correctly, depending on
@@ -44,9 +45,12 @@ def _start_test_rqworker(config):
 
     if not worker_running:
         tmp_logfile = open("/tmp/test_rqworker.log", "w")
+        # worker was imported before SECUREDROP_ENV was set to 'test', so
+        # name the test queues here
+        test_queues = [worker.TEST_QUEUE_PREFIX + name
+                       for name, _ in worker.QUEUES]
         subprocess.Popen(
-            [
-                "rqworker", "test",
+            ["rqworker"] + test_queues + [
                 "-P", config.SECUREDROP_ROOT,
                 "--pid", TEST_WORKER_PIDFILE,
             ],
@@ -221,11 +225,101 @@ def clean_tmp():
         # Thanks to http://stackoverflow.com/a/120948/1093000
         return [os.path.join(d, f) for f in os.listdir(d)]
 
+    import store
     for path in listdir_fullpath(config.TEMP_DIR):
+        # Pre-built archives of unread submissions are removed when they
+        # go out of date
+        if os.path.basename(path).startswith(store.UNREAD_ARCHIVE_PREFIX):
+            continue
         if not file_in_use(path):
             os.remove(path)
 
 
+def prune_login_attempts():
+    """Delete journalist login attempts that are too old to count towards
+    login throttling, so the table doesn't grow without bound. This is
+    intended to be run as an automated cron job."""
+    deleted = JournalistLoginAttempt.prune()
+    print "Pruned {} login attempt(s)".format(deleted)
+
+
+def compact_keyrings():
+    """Rewrite the shared GPG keyring to reclaim the space left by deleted
+    reply keypairs. This is intended to be run as an automated cron job."""
+    import crypto_util
+    size_before, size_after = crypto_util.compact_keyrings()
+    print "Compacted keyring from {} to {} bytes".format(size_before,
+                                                         size_after)
+
+
+def migrate_reply_keypairs():
+    """Move the reply keypairs in the shared GPG keyring into keyrings of
+    their own, then compact the shared keyring. This is run when the package
+    is upgraded."""
+    import crypto_util
+    moved = crypto_util.migrate_legacy_keypairs()
+    print "Moved {} reply keypair(s) into their own keyrings".format(moved)
+    if moved:
+        compact_keyrings()
+
+
+def precompile():
+    """Compile the templates and build the asset bundles of both apps, so
+    they don't have to be at runtime, and gzip the static files. This is run
+    when the package is built."""
+    import source
+    import journalist
+    import static_files
+    import template_cache
+    # Start from scratch, so no outdated bundles are left in static/gen/
+    shutil.rmtree(os.path.join(source.app.static_folder, 'gen'),
+                  ignore_errors=True)
+    for app_module in (source, journalist):
+        template_cache.compile_templates(app_module.app)
+        for bundle in app_module.assets:
+            bundle.build(force=True)
+        print "Compiled {} templates and built {} asset bundles for {}".format(
+            len(app_module.app.jinja_env.list_templates()),
+            len(app_module.assets), app_module.app.name)
+    print "Gzipped {} static files".format(
+        static_files.compress(source.app.static_folder))
+
+
+def check_consistency():
+    """Compare the store with the database, and offer to securely delete any
+    directories and files in the store that the database doesn't know
+    about."""
+    import consistency
+    import store
+    report = consistency.check()
+
+    for path in report.orphaned_dirs:
+        print "Source directory with no database entry: {}".format(path)
+    for path in report.orphaned_files:
+        print "File with no submission or reply entry: {}".format(path)
+    for filesystem_id in report.missing_dirs:
+        print "Source with no store directory: {}".format(filesystem_id)
+    for path in report.missing_files:
+        print "Submission or reply with no file: {}".format(path)
+
+    orphans = report.orphaned_dirs + report.orphaned_files
+    if not orphans:
+        print "No orphaned directories or files found"
+        return
+    answer = raw_input("Securely delete {} orphaned directories and "
+                       "files? (y/N): ".format(len(orphans)))
+    if answer.lower() in ("y", "yes"):
+        try:
+            consistency.wipe_orphans(report)
+        except store.DeletionException as e:
+            for path, error in sorted(e.failures.items()):
+                print "Couldn't delete {}: {}".format(path, error)
+            print "Deleted {} of {} orphaned directories and files".format(
+                len(orphans) - len(e.failures), len(orphans))
+            sys.exit(1)
+        print "Deleted {} orphaned directories and files".format(len(orphans))
+
+
 def get_args():
     parser = ArgumentParser(prog=__file__,
                             description='A tool to help admins manage and devs hack')
@@ -253,14 +347,50 @@ def get_args():
     clean_tmp_subparser = subparsers.add_parser('clean-tmp', help='Cleanup the SecureDrop temp directory')
     clean_tmp_subparser.set_defaults(func=clean_tmp)
 
+    prune_login_attempts_subparser = subparsers.add_parser('prune-login-attempts', help='Delete expired journalist login attempts')
+    prune_login_attempts_subparser.set_defaults(func=prune_login_attempts)
+
+    populate_subparser = subparsers.add_parser('populate', help='Add synthetic sources, submissions and replies for scale testing')
+    populate_subparser.add_argument('--sources', type=int, default=100, help='number of sources to add (default: 100)')
+    populate_subparser.add_argument('--submissions', type=int, default=10, help='average number of submissions per source (default: 10)')
+    populate_subparser.add_argument('--replies', type=int, default=1, help='average number of replies per source (default: 1)')
+    populate_subparser.add_argument('--min-size', type=int, default=512, help='smallest file size in bytes (default: 512)')
+    populate_subparser.add_argument('--max-size', type=int, default=1024 * 1024, help='largest file size in bytes (default: 1 MiB)')
+    populate_subparser.add_argument('--doc-ratio', type=float, default=0.3, help='fraction of submissions that are documents (default: 0.3)')
+    populate_subparser.add_argument('--flagged-ratio', type=float, default=0.1, help='fraction of sources that are flagged (default: 0.1)')
+    populate_subparser.add_argument('--starred-ratio', type=float, default=0.1, help='fraction of sources that are starred (default: 0.1)')
+    populate_subparser.add_argument('--unread-ratio', type=float, default=0.5, help='fraction of submissions that are unread (default: 0.5)')
+    populate_subparser.add_argument('--encrypt', action='store_true', help='encrypt the files with gpg instead of filling them with placeholder bytes')
+    populate_subparser.add_argument('--batch-size', type=int, default=500, help='number of sources to add per transaction (default: 500)')
+    populate_subparser.add_argument('--seed', type=int, help='random seed, to generate the same dataset again')
+    populate_subparser.set_defaults(func=populate)
+
+    worker_metrics_subparser = subparsers.add_parser('worker-metrics', help='Serve the worker queue depth and job metrics on localhost')
+    worker_metrics_subparser.add_argument('--port', type=int, default=9181, help='port to listen on (default: 9181)')
+    worker_metrics_subparser.set_defaults(func=worker_metrics)
+
+    compact_keyrings_subparser = subparsers.add_parser('compact-keyrings', help='Reclaim space left in the GPG keyring by deleted keys')
+    compact_keyrings_subparser.set_defaults(func=compact_keyrings)
+
+    migrate_reply_keypairs_subparser = subparsers.add_parser('migrate-reply-keypairs', help='Move reply keypairs from the shared GPG keyring into per-source keyrings')
+    migrate_reply_keypairs_subparser.set_defaults(func=migrate_reply_keypairs)
+
+    precompile_subparser = subparsers.add_parser('precompile', help='Compile the templates and build the asset bundles ahead of time')
+    precompile_subparser.set_defaults(func=precompile)
+
+    check_consistency_subparser = subparsers.add_parser('check-consistency', help='Find (and optionally delete) store files with no database entries')
+    check_consistency_subparser.set_defaults(func=check_consistency)
+
     return parser
 
 
 if __name__ == "__main__":  # pragma: no cover
     try:
-        args = get_args().parse_args()
-        # calling like this works because all functions take zero arguments
-        args.func()
+        args = vars(get_args().parse_args())
+        # calling like this works because all functions take zero arguments,
+        # except for those whose subcommands have options
+        func = args.pop('func')
+        func(**args)
     except KeyboardInterrupt:
         print  # So our prompt appears on a nice new line
         exit(1)
@@ -1 +1,3 @@
 from run import run
+from populate import populate
+from worker_metrics import worker_metrics
@@ -0,0 +1,157 @@
+from base64 import b32encode
+import datetime
+import math
+import os
+import random
+import time
+
+import config
+import crypto_util
+from db import db_session, Source, Submission, Reply, SourceStar, Journalist
+import store
+
+__all__ = ['populate']
+
+# Size of the block of random bytes that placeholder ciphertext is cut from,
+# since generating random bytes for every file would take most of the run time
+PLACEHOLDER_BLOCK_SIZE = 1024 * 1024
+
+
+def random_bytes(rng, size):
+    """Return `size` random bytes drawn from `rng`, a `random.Random`."""
+    if size <= 0:
+        return ''
+    return ('%0*x' % (2 * size, rng.getrandbits(8 * size))).decode('hex')
+
+
+def placeholder(block, size):
+    """Return `size` bytes of stand-in ciphertext cut from `block`."""
+    chunks = [block] * (size // len(block))
+    chunks.append(block[:size % len(block)])
+    return ''.join(chunks)
+
+
+def random_count(rng, mean):
+    """Return a random count that averages to `mean`."""
+    if mean <= 0:
+        return 0
+    return rng.randint(0, 2 * mean)
+
+
+def random_size(rng, min_size, max_size):
+    """Return a random file size between `min_size` and `max_size`, spread
+    evenly over orders of magnitude, since most submissions are small."""
+    size = math.exp(rng.uniform(math.log(min_size), math.log(max_size)))
+    return min(max(int(round(size)), min_size), max_size)
+
+
+def random_display_id(rng):
+    """Like `crypto_util.display_id`, but drawn from `rng`."""
+    return ' '.join([rng.choice(crypto_util.adjectives),
+                     rng.choice(crypto_util.nouns)])
+
+
+def write_file(sid, filename, contents, encrypt):
+    path = store.path(sid, filename)
+    if encrypt:
+        crypto_util.encrypt(contents, config.JOURNALIST_KEY, path)
+    else:
+        with open(path, 'wb') as f:
+            f.write(contents)
+    return os.path.getsize(path)
+
+
+def populate(sources=100, submissions=10, replies=1, min_size=512,
+             max_size=1024 * 1024, doc_ratio=0.3, flagged_ratio=0.1,
+             starred_ratio=0.1, unread_ratio=0.5, encrypt=False,
+             batch_size=500, seed=None):
+    """Add `sources` synthetic sources to the database and store, with an
+    average of `submissions` submissions and `replies` replies each.
+
+    Rows are inserted in batches of `batch_size` sources, with one statement
+    per table. Unless `encrypt` is True, the files are filled with
+    placeholder bytes instead of being encrypted with gpg. The sources'
+    codenames are never generated, so nobody can log in as them, and they
+    don't have reply keypairs.
+
+    Everything is drawn from a `random.Random` seeded with `seed`, so the
+    same seed gives the same sources, files and rows again (apart from the
+    timestamps, which are relative to now, and the ciphertext gpg writes
+    when `encrypt` is True)."""
+    rng = random.Random(seed)
+    block = random_bytes(rng, PLACEHOLDER_BLOCK_SIZE)
+    journalist = Journalist.query.first()
+    journalist_id = journalist.id if journalist else None
+
+    start = time.time()
+    num_rows = 0
+    for batch_start in range(0, sources, batch_size):
+        source_rows = []
+        files = []
+        for _ in range(min(batch_size, sources - batch_start)):
+            sid = b32encode(random_bytes(rng, 60))
+            source = Source(sid, random_display_id(rng))
+            os.mkdir(store.path(sid))
+
+            kinds = ['reply'] * random_count(rng, replies)
+            kinds += ['submission'] * (random_count(rng, submissions) or 1)
+            rng.shuffle(kinds)
+            for index, kind in enumerate(kinds, 1):
+                if kind == 'reply':
+                    suffix = 'reply.gpg'
+                elif rng.random() < doc_ratio:
+                    suffix = 'doc.gz.gpg'
+                else:
+                    suffix = 'msg.gpg'
+                filename = '{}-{}-{}'.format(index, source.journalist_filename,
+                                             suffix)
+                size = random_size(rng, min_size, max_size)
+                if encrypt:
+                    contents = random_bytes(rng, size)
+                else:
+                    contents = placeholder(block, size)
+                size = write_file(sid, filename, contents, encrypt)
+                files.append((sid, kind, filename, size, index))
+
+            source_rows.append(dict(
+                filesystem_id=sid,
+                journalist_designation=source.journalist_designation,
+                flagged=rng.random() < flagged_ratio,
+                pending=False,
+                interaction_count=len(kinds),
+                last_updated=datetime.datetime.utcnow() -
+                datetime.timedelta(seconds=rng.randint(0, 90 * 86400))))
+
+        db_session.execute(Source.__table__.insert(), source_rows)
+        source_ids = dict(db_session.query(Source.filesystem_id, Source.id)
+                          .filter(Source.filesystem_id.in_(
+                              [row['filesystem_id'] for row in source_rows])))
+
+        submission_rows = []
+        reply_rows = []
+        for sid, kind, filename, size, index in files:
+            row = dict(source_id=source_ids[sid], filename=filename,
+                       size=size, interaction_index=index)
+            if kind == 'reply':
+                row['journalist_id'] = journalist_id
+                reply_rows.append(row)
+            else:
+                row['downloaded'] = rng.random() >= unread_ratio
+                submission_rows.append(row)
+        star_rows = [dict(source_id=source_ids[row['filesystem_id']],
+                          starred=True)
+                     for row in source_rows
+                     if rng.random() < starred_ratio]
+        for table, rows in ((Submission.__table__, submission_rows),
+                            (Reply.__table__, reply_rows),
+                            (SourceStar.__table__, star_rows)):
+            if rows:
+                db_session.execute(table.insert(), rows)
+        db_session.commit()
+
+        num_rows += (len(source_rows) + len(submission_rows) +
+                     len(reply_rows) + len(star_rows))
+        elapsed = time.time() - start
+        print "Added {} of {} sources ({:.0f} rows/sec)".format(
+            batch_start + len(source_rows), sources,
+            num_rows / elapsed if elapsed else 0)
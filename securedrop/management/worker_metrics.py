@@ -0,0 +1,34 @@
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+import worker
+
+__all__ = ['worker_metrics']
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = worker.metrics_text()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes happen every few seconds, so don't fill the logs with them
+        pass
+
+
+def worker_metrics(port=9181):
+    """Serve the worker's metrics at http://127.0.0.1:<port>/metrics, for a
+    local Prometheus (or anything else that reads its text format)."""
+    server = HTTPServer(('127.0.0.1', port), MetricsHandler)
+    print "Serving worker metrics at http://127.0.0.1:{}/metrics".format(port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
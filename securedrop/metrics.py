@@ -0,0 +1,182 @@
+"""Break down where the time goes while handling a request.
+
+The expensive parts of handling a request (scrypt, gpg, SQL, the store and
+template rendering) are timed separately. Time spent in a nested timer is
+only counted towards the innermost one, so for example the gpg time while
+saving a file submission isn't also counted as store time.
+
+Only endpoint names and timings are recorded, never arguments or URLs, so
+nothing here can identify a source.
+"""
+import collections
+import contextlib
+import functools
+import time
+
+from flask import g, has_app_context, request
+import jinja2
+from redis.exceptions import RedisError
+from sqlalchemy import event
+
+import worker
+
+# Totals for each app and endpoint are kept in Redis, in a hash named like
+# "request_metrics:source:submit", so they include requests handled by every
+# process of both apps
+KEY_PREFIX = 'request_metrics:'
+
+
+class RequestTimings(object):
+
+    """The time spent in each category while handling one request."""
+
+    def __init__(self):
+        self.start = time.time()
+        self.totals = collections.defaultdict(float)
+        # Time spent in nested timers, for each timer that is running
+        self._nested = []
+
+    def add(self, category, elapsed, nested=0.0):
+        self.totals[category] += elapsed - nested
+        if self._nested:
+            self._nested[-1] += elapsed
+
+
+def current_timings():
+    """Return the RequestTimings for the current request, or None if there
+    isn't a request being timed."""
+    if has_app_context():
+        return g.get('request_timings')
+
+
+@contextlib.contextmanager
+def timer(category):
+    timings = current_timings()
+    if timings is None:
+        yield
+        return
+    timings._nested.append(0.0)
+    start = time.time()
+    try:
+        yield
+    finally:
+        timings.add(category, time.time() - start, timings._nested.pop())
+
+
+def timed(category):
+    """Decorator that counts the time spent in the function towards
+    `category`."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(category):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class TimedTemplate(jinja2.Template):
+
+    def render(self, *args, **kwargs):
+        with timer('template'):
+            return super(TimedTemplate, self).render(*args, **kwargs)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('query_start', []).append(time.time())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    start = conn.info['query_start'].pop()
+    timings = current_timings()
+    if timings is not None:
+        timings.add('sql', time.time() - start)
+
+
+def _handle_error(context):
+    query_start = context.connection.info.get('query_start')
+    if query_start:
+        query_start.pop()
+
+
+def server_timing(timings, total):
+    """Format `timings` as a Server-Timing header, in milliseconds."""
+    return ', '.join('{};dur={:.1f}'.format(category, seconds * 1000)
+                     for category, seconds in
+                     sorted(timings.items()) + [('total', total)])
+
+
+def init_app(app, engine, record=False):
+    """Time the requests `app` handles.
+
+    If `record` is True, the timings are added to the totals in Redis.
+    Outside of production (i.e. when `app.debug` or `app.testing` is set),
+    each response also has a Server-Timing header with its own timings.
+    Call this before registering any other `before_request` functions, so
+    they are timed too.
+    """
+    if not (record or app.debug or app.testing):
+        return
+
+    app.jinja_env.template_class = TimedTemplate
+    for name, listener in (('before_cursor_execute', _before_cursor_execute),
+                           ('after_cursor_execute', _after_cursor_execute),
+                           ('handle_error', _handle_error)):
+        # Both apps share an engine when they're imported by the tests
+        if not event.contains(engine, name, listener):
+            event.listen(engine, name, listener)
+
+    @app.before_request
+    def start_request_timings():
+        g.request_timings = RequestTimings()
+
+    @app.after_request
+    def finish_request_timings(response):
+        timings = g.pop('request_timings', None)
+        if timings is None or request.endpoint is None:
+            return response
+        total = time.time() - timings.start
+        if app.debug or app.testing:
+            response.headers['Server-Timing'] = server_timing(timings.totals,
+                                                              total)
+        if record:
+            key = '{}{}:{}'.format(KEY_PREFIX, app.name, request.endpoint)
+            pipe = worker.redis.pipeline(transaction=False)
+            pipe.hincrby(key, 'requests', 1)
+            pipe.hincrbyfloat(key, 'total', total)
+            for category, seconds in timings.totals.items():
+                pipe.hincrbyfloat(key, category, seconds)
+            try:
+                pipe.execute()
+            except RedisError as e:
+                app.logger.warning("Couldn't record request metrics: "
+                                   "{}".format(e))
+        return response
+
+
+def snapshot():
+    """Return the recorded totals for each app and endpoint, with the total
+    and mean time spent in each category."""
+    metrics = collections.defaultdict(dict)
+    for key in worker.redis.scan_iter(KEY_PREFIX + '*'):
+        app_name, endpoint = key[len(KEY_PREFIX):].split(':', 1)
+        values = worker.redis.hgetall(key)
+        requests = int(values.pop('requests', 0))
+        if not requests:
+            continue
+        metrics[app_name][endpoint] = dict(
+            requests=requests,
+            seconds=dict((category, float(seconds))
+                         for category, seconds in values.items()),
+            mean_ms=dict((category, float(seconds) * 1000 / requests)
+                         for category, seconds in values.items()))
+    return metrics
+
+
+def reset():
+    """Forget the recorded totals."""
+    keys = list(worker.redis.scan_iter(KEY_PREFIX + '*'))
+    if keys:
+        worker.redis.delete(*keys)
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Serve the source or journalist interface with a pool of forked workers.
+
+The parent process imports the app and warms it up (see the apps'
+`warm_up`) before it forks the workers, so they share its compiled
+templates, wordlists, gpg instance and journalist key export copy-on-write,
+and none of them handles its first request cold:
+
+    ./prefork.py source --port 8080 --workers 4
+
+Send the parent SIGHUP to reload the code without dropping connections: it
+re-executes itself on the same listening socket, forks new workers, and then
+asks the old ones to finish the request they're handling and exit. SIGTERM
+or SIGINT stops the server the same way.
+"""
+from argparse import ArgumentParser
+import errno
+import gc
+import importlib
+import os
+import signal
+import sys
+import time
+
+from werkzeug.serving import make_server
+
+APPS = {'source': 8080, 'journalist': 8081}
+
+# Environment variables that pass the listening socket and the old workers on
+# to the parent process after it re-executes itself
+LISTEN_FD_ENV = 'SECUREDROP_PREFORK_FD'
+OLD_WORKERS_ENV = 'SECUREDROP_PREFORK_OLD_WORKERS'
+
+# How often idle processes check whether they've been signaled, in seconds
+POLL_INTERVAL = 1
+
+
+def log(message):
+    print >>sys.stderr, '[prefork {}] {}'.format(os.getpid(), message)
+
+
+def run_worker(server):
+    """Handle requests until SIGTERM, then exit. Never returns."""
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(1))
+    # Ctrl+C and reloads are for the parent to handle
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    server.timeout = POLL_INTERVAL
+    try:
+        while not stopping:
+            server.handle_request()
+    finally:
+        os._exit(0)
+
+
+def kill(pid, signum=signal.SIGTERM):
+    try:
+        os.kill(pid, signum)
+    except OSError as e:
+        if e.errno != errno.ESRCH:
+            raise
+
+
+def serve(app_name, host, port, num_workers):
+    listen_fd = os.environ.pop(LISTEN_FD_ENV, None)
+    old_workers = set(int(pid) for pid in
+                      os.environ.pop(OLD_WORKERS_ENV, '').split(',') if pid)
+
+    module = importlib.import_module(app_name)
+    server = make_server(host, port, module.app,
+                         fd=int(listen_fd) if listen_fd else None)
+    module.warm_up()
+    # Leave as little garbage as possible for the workers to collect, since
+    # collecting it would copy the pages it's on
+    gc.collect()
+
+    workers = set()
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            run_worker(server)
+        workers.add(pid)
+
+    signals = []
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP,
+                   signal.SIGCHLD):
+        signal.signal(signum, lambda signum, frame: signals.append(signum))
+
+    for _ in range(num_workers):
+        spawn()
+    log('Serving {} on http://{}:{}/ with {} workers'.format(
+        app_name, host, server.server_address[1], num_workers))
+    # The new workers are ready, so the old ones can finish up
+    for pid in old_workers:
+        kill(pid)
+
+    stopping = False
+    while workers or old_workers:
+        while not signals:
+            time.sleep(POLL_INTERVAL)
+        signum = signals.pop(0)
+
+        if signum == signal.SIGCHLD:
+            while True:
+                try:
+                    pid, status = os.waitpid(-1, os.WNOHANG)
+                except OSError as e:
+                    if e.errno != errno.ECHILD:
+                        raise
+                    break
+                if not pid:
+                    break
+                old_workers.discard(pid)
+                if pid in workers:
+                    workers.discard(pid)
+                    if not stopping:
+                        log('Worker {} exited with status {}, replacing '
+                            'it'.format(pid, status))
+                        spawn()
+        elif signum == signal.SIGHUP and not stopping:
+            log('Reloading')
+            os.environ[LISTEN_FD_ENV] = str(server.fileno())
+            os.environ[OLD_WORKERS_ENV] = ','.join(
+                str(pid) for pid in workers | old_workers)
+            os.execv(sys.executable, [sys.executable] + sys.argv)
+        elif signum in (signal.SIGTERM, signal.SIGINT) and not stopping:
+            log('Stopping')
+            stopping = True
+            for pid in workers | old_workers:
+                kill(pid)
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('app', choices=sorted(APPS))
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int,
+                        help='port to listen on (default: 8080 for the '
+                             'source interface, 8081 for the journalist '
+                             'interface)')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='number of worker processes (default: 4)')
+    args = parser.parse_args()
+    serve(args.app, args.host, args.port or APPS[args.app], args.workers)
+
+
+if __name__ == "__main__":
+    main()
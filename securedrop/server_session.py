@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""Server-side sessions for Flask.
+
+Flask's default sessions are stored in a signed cookie, so every request has
+to deserialize and verify the whole session, and a session can't be revoked
+once it has been issued. The session interface here keeps the session data on
+the server, keyed by a random session id that is the only thing stored in the
+cookie. Values that shouldn't be kept on the server at all can be kept in a
+second, signed cookie instead (see `ServerSideSessionInterface`).
+"""
+import base64
+import hashlib
+import os
+import threading
+import time
+
+from flask.sessions import (SessionInterface, SessionMixin,
+                            session_json_serializer)
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from werkzeug.datastructures import CallbackDict
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+
+    def __init__(self, initial=None, session_id=None, new=False):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.session_id = session_id
+        self.new = new
+        self.modified = False
+        # The id the session had before `regenerate`, to delete from the store
+        self.previous_session_id = None
+        # Whether the request had a cookie with client-side values
+        self.had_client_values = False
+
+    def regenerate(self):
+        """Move the session to a new id, so that an id that was known before
+        (for example, one an attacker planted before the user logged in)
+        can't be used any more."""
+        if not self.new and self.previous_session_id is None:
+            self.previous_session_id = self.session_id
+        self.session_id = ServerSideSessionInterface._gen_session_id()
+        self.new = True
+        self.modified = True
+
+
+class RedisSessionStore(object):
+
+    """Keeps serialized sessions in Redis, which expires them after `ttl`
+    seconds without being saved."""
+
+    def __init__(self, redis, prefix='session:'):
+        self.redis = redis
+        self.prefix = prefix
+
+    def get(self, session_id):
+        return self.redis.get(self.prefix + session_id)
+
+    def set(self, session_id, value, ttl):
+        self.redis.setex(self.prefix + session_id, value, ttl)
+
+    def delete(self, session_id):
+        self.redis.delete(self.prefix + session_id)
+
+    def clear(self):
+        for key in self.redis.scan_iter(self.prefix + '*'):
+            self.redis.delete(key)
+
+
+class MemorySessionStore(object):
+
+    """Keeps serialized sessions in a dict in this process. This is only meant
+    to be a stand-in for Redis for tests and development, since sessions are
+    not shared between processes."""
+
+    def __init__(self):
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def get(self, session_id):
+        with self.lock:
+            value, expires = self.sessions.get(session_id, (None, None))
+            if expires is not None and expires < time.time():
+                del self.sessions[session_id]
+                return None
+            return value
+
+    def set(self, session_id, value, ttl):
+        with self.lock:
+            self.sessions[session_id] = (value, time.time() + ttl)
+
+    def delete(self, session_id):
+        with self.lock:
+            self.sessions.pop(session_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.sessions.clear()
+
+
+class ServerSideSessionInterface(SessionInterface):
+
+    """Stores sessions in `store` (see `RedisSessionStore` and
+    `MemorySessionStore`). Sessions expire after `ttl` seconds of
+    inactivity.
+
+    The values of `client_keys` are kept in a separate cookie, signed with
+    the app's secret key, instead of in the store. They're only used while
+    the session is still in the store, so they can still be revoked."""
+
+    serializer = session_json_serializer
+    client_cookie_suffix = '_c'
+    client_salt = 'server-side-session-client-values'
+
+    def __init__(self, store, ttl=60 * 60 * 24, client_keys=()):
+        self.store = store
+        self.ttl = ttl
+        self.client_keys = frozenset(client_keys)
+
+    @staticmethod
+    def _gen_session_id():
+        return base64.urlsafe_b64encode(os.urandom(32)).rstrip('=')
+
+    def _client_serializer(self, app):
+        return URLSafeTimedSerializer(
+            app.secret_key, salt=self.client_salt, serializer=self.serializer,
+            signer_kwargs=dict(key_derivation='hmac',
+                               digest_method=hashlib.sha1))
+
+    def _client_cookie_name(self, app):
+        return app.session_cookie_name + self.client_cookie_suffix
+
+    def _open_client_values(self, app, request):
+        value = request.cookies.get(self._client_cookie_name(app))
+        if not value:
+            return None
+        try:
+            values = self._client_serializer(app).loads(value)
+        except BadSignature:
+            return None
+        return dict((key, values[key]) for key in self.client_keys
+                    if key in values)
+
+    def open_session(self, app, request):
+        session_id = request.cookies.get(app.session_cookie_name)
+        client_values = self._open_client_values(app, request)
+        if session_id:
+            value = self.store.get(session_id)
+            if value is not None:
+                try:
+                    session = ServerSideSession(self.serializer.loads(value),
+                                                session_id=session_id)
+                except ValueError:
+                    pass
+                else:
+                    if client_values:
+                        session.update(client_values)
+                        session.modified = False
+                    session.had_client_values = client_values is not None
+                    return session
+        session = ServerSideSession(session_id=self._gen_session_id(),
+                                    new=True)
+        session.had_client_values = client_values is not None
+        return session
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.previous_session_id is not None:
+            self.store.delete(session.previous_session_id)
+
+        client_values = dict((key, value) for key, value in session.items()
+                             if key in self.client_keys)
+        if client_values and (session.modified or session.new):
+            response.set_cookie(
+                self._client_cookie_name(app),
+                self._client_serializer(app).dumps(client_values),
+                expires=self.get_expiration_time(app, session),
+                httponly=True, domain=domain, path=path,
+                secure=self.get_cookie_secure(app))
+        elif not client_values and session.had_client_values:
+            response.delete_cookie(self._client_cookie_name(app),
+                                   domain=domain, path=path)
+
+        if not session:
+            if not session.new:
+                self.store.delete(session.session_id)
+            if session.modified:
+                response.delete_cookie(app.session_cookie_name,
+                                       domain=domain, path=path)
+            return
+
+        # Saving also refreshes the session's expiration time
+        self.store.set(session.session_id,
+                       self.serializer.dumps(dict(
+                           (key, value) for key, value in session.items()
+                           if key not in self.client_keys)),
+                       self.ttl)
+        if session.new:
+            response.set_cookie(app.session_cookie_name, session.session_id,
+                                expires=self.get_expiration_time(app, session),
+                                httponly=self.get_cookie_httponly(app),
+                                domain=domain, path=path,
+                                secure=self.get_cookie_secure(app))
+
+    def revoke(self, session_id):
+        """End the session with id `session_id`."""
+        self.store.delete(session_id)
+
+    def revoke_all(self):
+        """End every session."""
+        self.store.clear()
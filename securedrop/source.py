@@ -9,18 +9,25 @@ import operator
 from flask import (Flask, request, render_template, session, redirect, url_for,
                    flash, abort, g, send_file, Markup)
 from flask_wtf.csrf import CsrfProtect
-from flask_assets import Environment
+from flask_assets import Environment, Bundle
 
+from redis import Redis
 from sqlalchemy.orm.exc import MultipleResultsFound, NoResultFound
 from sqlalchemy.exc import IntegrityError
 
 import config
 import version
 import crypto_util
+import metrics
 import store
+import static_files
+import template_cache
 import template_filters
-from db import db_session, Source, Submission, Reply, get_one_or_else
+from db import db_session, engine, Source, Submission, Reply, get_one_or_else
 from request_that_secures_file_uploads import RequestThatSecuresFileUploads
+from server_session import (ServerSideSessionInterface, RedisSessionStore,
+                            MemorySessionStore)
+import worker
 from jinja2 import evalcontextfilter
 
 import logging
@@ -31,8 +38,40 @@ log = logging.getLogger('source')
 app = Flask(__name__, template_folder=config.SOURCE_TEMPLATES_DIR)
 app.request_class = RequestThatSecuresFileUploads
 app.config.from_object(config.SourceInterfaceFlaskConfig)
+metrics.init_app(app, engine, getattr(config, 'REQUEST_METRICS', False))
+
+# Have the worker keep an archive of each source's unread submissions ready
+# for journalists to download
+PREBUILD_UNREAD_ARCHIVES = getattr(config, 'PREBUILD_UNREAD_ARCHIVES', False)
+
+# Optionally keep sessions on the server. The 'memory' store is only suitable
+# for tests and development, since it isn't shared between processes. Either
+# way the codename is never kept on the server: it stays in a signed cookie in
+# the source's browser, and the server only keeps the filesystem id.
+session_store = getattr(config, 'SOURCE_SESSION_STORE', 'cookie')
+if session_store == 'redis':
+    # Sessions get their own Redis instance if there's one configured, which
+    # (unlike the worker's) shouldn't write anything to disk
+    session_redis_port = getattr(config, 'SOURCE_SESSION_REDIS_PORT', None)
+    app.session_interface = ServerSideSessionInterface(
+        RedisSessionStore(Redis(port=session_redis_port)
+                          if session_redis_port else worker.redis,
+                          prefix='source_session:'),
+        client_keys=('codename',))
+elif session_store == 'memory':
+    app.session_interface = ServerSideSessionInterface(
+        MemorySessionStore(), client_keys=('codename',))
+
+template_cache.init_app(app)
 
 assets = Environment(app)
+assets.register('source_css', Bundle(
+    'css/normalize.css', 'css/source.css', 'css/font-awesome.css',
+    filters='cssmin', output='gen/source.%(version)s.css'))
+assets.register('source_js', Bundle(
+    'js/libs/jquery-2.1.4.min.js', 'js/source.js',
+    filters='jsmin', output='gen/source.%(version)s.js'))
+static_files.init_app(app, assets)
 
 # The default CSRF token expiration is 1 hour. Since large uploads can
 # take longer than an hour over Tor, we increase the valid window to 24h.
@@ -90,7 +129,11 @@ def setup_g():
     # serving a static resource that won't need to access these common values.
     if logged_in():
         g.codename = session['codename']
-        g.sid = crypto_util.hash_codename(g.codename)
+        # Only derive the filesystem id once per session, instead of on every
+        # request
+        if 'sid' not in session:
+            session['sid'] = crypto_util.hash_codename(g.codename)
+        g.sid = session['sid']
         try:
             g.source = Source.query.filter(Source.filesystem_id == g.sid).one()
         except MultipleResultsFound as e:
@@ -104,6 +147,7 @@ def setup_g():
                 (e,))
             del session['logged_in']
             del session['codename']
+            session.pop('sid', None)
             return redirect(url_for('index'))
         g.loc = store.path(g.sid)
 
@@ -187,6 +231,8 @@ def create():
     else:
         os.mkdir(store.path(sid))
 
+    regenerate_session()
+    session['sid'] = sid
     session['logged_in'] = True
     return redirect(url_for('lookup'))
 
@@ -222,7 +268,7 @@ def lookup():
         try:
             reply.decrypted = crypto_util.decrypt(
                 g.codename,
-                file(reply_path).read()).decode('utf-8')
+                file(reply_path).read(), sid=g.sid).decode('utf-8')
         except UnicodeDecodeError:
             app.logger.error("Could not decode reply %s" % reply.filename)
         else:
@@ -330,6 +376,12 @@ def submit():
     db_session.commit()
     normalize_timestamps(g.sid)
 
+    if PREBUILD_UNREAD_ARCHIVES:
+        worker.enqueue(store.update_unread_archive, g.sid, journalist_filename,
+                       [submission.filename
+                        for submission in g.source.submissions
+                        if not submission.downloaded])
+
     return redirect(url_for('lookup'))
 
 
@@ -364,11 +416,13 @@ def batch_delete():
 
 
 def valid_codename(codename):
+    """Return the filesystem id of the source with `codename`, or None if
+    there isn't one."""
     # Ignore codenames that are too long to avoid DoS
     if len(codename) > Source.MAX_CODENAME_LEN:
         app.logger.info(
                 "Ignored attempted login because the codename was too long.")
-        return False
+        return None
 
     try:
         filesystem_id = crypto_util.hash_codename(codename)
@@ -379,15 +433,25 @@ def valid_codename(codename):
         abort(500)
 
     source = Source.query.filter_by(filesystem_id=filesystem_id).first()
-    return source is not None
+    return filesystem_id if source is not None else None
+
+
+def regenerate_session():
+    """Give a server-side session a new id when the source logs in, so an id
+    that was known before can't be used to act as them (session fixation).
+    Cookie sessions are rewritten anyway."""
+    if hasattr(session, 'regenerate'):
+        session.regenerate()
 
 
 @app.route('/login', methods=('GET', 'POST'))
 def login():
     if request.method == 'POST':
         codename = request.form['codename'].strip()
-        if valid_codename(codename):
-            session.update(codename=codename, logged_in=True)
+        sid = valid_codename(codename)
+        if sid:
+            regenerate_session()
+            session.update(codename=codename, sid=sid, logged_in=True)
             return redirect(url_for('lookup', from_login='1'))
         else:
             app.logger.info(
@@ -423,8 +487,7 @@ def tor2web_warning():
 
 @app.route('/journalist-key')
 def download_journalist_pubkey():
-    journalist_pubkey = crypto_util.gpg.export_keys(config.JOURNALIST_KEY)
-    return send_file(StringIO(journalist_pubkey),
+    return send_file(StringIO(crypto_util.journalist_pubkey()),
                      mimetype="application/pgp-keys",
                      attachment_filename=config.JOURNALIST_KEY + ".asc",
                      as_attachment=True)
@@ -445,6 +508,17 @@ def internal_error(error):
     return render_template('error.html'), 500
 
 
+def warm_up():
+    """Do the work that's otherwise left until the first request needs it:
+    the runtime tests, starting gpg, loading the wordlists, compiling the
+    templates and building the asset bundles. Pre-fork servers should call
+    this before forking, so their workers start ready."""
+    crypto_util.warm_up()
+    template_cache.compile_templates(app)
+    with app.test_request_context():
+        render_template('index.html')
+
+
 def write_pidfile():
     pid = str(os.getpid())
     with open(config.SOURCE_PIDFILE, 'w') as fp:
@@ -452,5 +526,6 @@ def write_pidfile():
 
 if __name__ == "__main__":
     write_pidfile()
+    warm_up()
     debug = getattr(config, 'env', 'prod') != 'prod'
     app.run(debug=debug, host='0.0.0.0', port=8080)
@@ -0,0 +1,85 @@
+"""Serve the static files so that Tor Browser downloads as little as possible.
+
+The asset bundles are built into static/gen/ with a hash of their contents in
+their filenames (like gen/source.5b13dd63.css), so browsers can cache them
+for good: a bundle that changes gets a new URL. `./manage.py precompile` also
+writes a gzipped copy next to each static file that compresses well, which
+is sent instead to clients that accept it. In production Apache does both
+(see the app role's sites-available templates); `init_app` makes Flask do the
+same for the development servers and the tests.
+"""
+import gzip
+import mimetypes
+import os
+import re
+
+from flask import current_app, request, safe_join, send_from_directory
+
+# Maps each bundle's output pattern to the hash of its last build, so the
+# bundles' URLs can be found without building them
+MANIFEST = 'json:gen/manifest.json'
+
+# Static files that compress well. The rest are images and fonts, which are
+# compressed already
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.svg')
+
+HASHED_FILENAME = re.compile(r'^gen/[^/]+\.[0-9a-f]{8}\.(css|js)$').match
+
+# One year, the longest RFC 2616 allows
+HASHED_MAX_AGE = 365 * 24 * 60 * 60
+
+
+def compress(directory):
+    """Write a gzipped copy of each compressible file under `directory` next
+    to it, as <filename>.gz, and return how many were written. Copies that
+    are up to date are left alone."""
+    written = 0
+    for root, _, filenames in os.walk(directory):
+        for filename in filenames:
+            if not filename.endswith(COMPRESSIBLE_EXTENSIONS):
+                continue
+            path = os.path.join(root, filename)
+            gz_path = path + '.gz'
+            if (os.path.exists(gz_path) and
+                    os.path.getmtime(gz_path) >= os.path.getmtime(path)):
+                continue
+            with open(path, 'rb') as f:
+                # Leave the timestamp out, so the same file always gives the
+                # same copy
+                with gzip.GzipFile(gz_path, 'wb', 9, mtime=0) as gz:
+                    gz.write(f.read())
+            written += 1
+    return written
+
+
+def send_static_file(filename):
+    """Serve a static file, gzipped if there's a gzipped copy and the client
+    accepts it, with far-future cache headers if its name has a hash."""
+    static_folder = current_app.static_folder
+    hashed = HASHED_FILENAME(filename)
+    cache_timeout = HASHED_MAX_AGE if hashed else None
+    if ('gzip' in request.headers.get('Accept-Encoding', '') and
+            os.path.isfile(safe_join(static_folder, filename + '.gz'))):
+        response = send_from_directory(
+            static_folder, filename + '.gz',
+            mimetype=mimetypes.guess_type(filename)[0],
+            cache_timeout=cache_timeout)
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = send_from_directory(static_folder, filename,
+                                       cache_timeout=cache_timeout)
+    response.vary.add('Accept-Encoding')
+    if hashed:
+        response.cache_control['immutable'] = None
+    return response
+
+
+def init_app(app, assets):
+    """Give `app`'s asset bundles (which should have "%(version)s" in their
+    output filenames) hashed URLs, and serve its static files as described
+    above."""
+    assets.manifest = MANIFEST
+    # The hash is in the filename, so it doesn't need to be in the query
+    # string too
+    assets.url_expire = False
+    app.view_functions['static'] = send_static_file
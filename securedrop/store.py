@@ -4,11 +4,15 @@ import re
 import config
 import zipfile
 import crypto_util
+from metrics import timed
 import uuid
 import tempfile
 import subprocess
 from cStringIO import StringIO
+import errno
 import gzip
+import hashlib
+import shutil
 from werkzeug import secure_filename
 
 from secure_tempfile import SecureTemporaryFile
@@ -29,6 +33,18 @@ class PathException(Exception):
     pass
 
 
+class DeletionException(Exception):
+
+    """An exception raised by `store.secure_unlink_many` when some of the paths
+    couldn't be deleted. `failures` maps each of them to the error.
+    """
+
+    def __init__(self, failures):
+        self.failures = failures
+        super(DeletionException, self).__init__(
+            "Couldn't delete {} paths: {}".format(len(failures), failures))
+
+
 def verify(p):
     """Assert that the path is absolute, normalized, inside `config.STORE_DIR`, and
     matches the filename format.
@@ -68,20 +84,123 @@ def path(*s):
     return absolute
 
 
+def _bulk_archive_digest(filenames, zip_directory):
+    # Files in the store are never modified once they're written, so their
+    # paths, sizes and mtimes identify their contents
+    digest = hashlib.sha256(zip_directory)
+    for filename in filenames:
+        st = os.stat(filename)
+        digest.update("\0{}\0{}\0{}".format(filename, st.st_size,
+                                             st.st_mtime))
+    return digest.hexdigest()
+
+
+@timed('store')
 def get_bulk_archive(filenames, zip_directory=''):
+    """Return an open file with a zip archive of `filenames`. An archive
+    of the same files is reused if it's still in `config.TEMP_DIR`, so that
+    downloading it again (or resuming an interrupted download) is cheap and
+    gets an identical file."""
+    for filename in filenames:
+        verify(filename)
+    archive_path = os.path.join(
+        config.TEMP_DIR, 'tmp_securedrop_bulk_dl_{}.zip'.format(
+            _bulk_archive_digest(filenames, zip_directory)))
+    if not os.path.exists(archive_path):
+        zip_file = tempfile.NamedTemporaryFile(prefix='tmp_securedrop_bulk_dl_',
+                                               dir=config.TEMP_DIR,
+                                               delete=False)
+        with zipfile.ZipFile(zip_file, 'w') as zip:
+            for filename in filenames:
+                zip.write(filename, arcname=os.path.join(
+                    zip_directory,
+                    os.path.basename(filename)
+                ))
+        zip_file.close()
+        os.rename(zip_file.name, archive_path)
+    return open(archive_path, 'rb')
+
+
+# Pre-built archives of unread submissions are kept in config.TEMP_DIR with
+# this prefix (see `update_unread_archive`)
+UNREAD_ARCHIVE_PREFIX = 'unread_archive_'
+
+
+def unread_archive_path(sid):
+    return os.path.join(config.TEMP_DIR,
+                        '{}{}.zip'.format(UNREAD_ARCHIVE_PREFIX, sid))
+
+
+def update_unread_archive(sid, zip_directory, filenames):
+    """Update the pre-built archive of the unread submissions of the source
+    with id `sid`, so it has `filenames` (in their store directory). If the
+    archive has no other files, the missing ones are appended to a copy of
+    it, otherwise it's rebuilt. This is meant to be run by the worker."""
+    archive_path = unread_archive_path(sid)
+    arcnames = dict((os.path.join(zip_directory, filename), filename)
+                    for filename in filenames)
+    try:
+        with zipfile.ZipFile(archive_path) as zip:
+            existing = set(zip.namelist())
+    except (IOError, zipfile.BadZipfile):
+        existing = None
+
+    zip_file = tempfile.NamedTemporaryFile(prefix='tmp_securedrop_bulk_dl_',
+                                           dir=config.TEMP_DIR,
+                                           delete=False)
+    zip_file.close()
+    try:
+        if existing is not None and existing <= set(arcnames):
+            # Work on a copy, so a download of the current archive isn't
+            # affected
+            shutil.copyfile(archive_path, zip_file.name)
+            mode = 'a'
+        else:
+            existing = set()
+            mode = 'w'
+        with zipfile.ZipFile(zip_file.name, mode) as zip:
+            for arcname in sorted(set(arcnames) - existing):
+                zip.write(path(sid, arcnames[arcname]), arcname=arcname)
+        os.rename(zip_file.name, archive_path)
+    except Exception:
+        os.remove(zip_file.name)
+        raise
+    return "success"
+
+
+def take_unread_archive(sid, zip_directory, filenames):
+    """Return an open file with the pre-built archive of the unread
+    submissions of the source with id `sid`, if it has exactly `filenames`,
+    or None. The archive is moved out of the way, since it won't be current
+    once the submissions have been downloaded."""
     zip_file = tempfile.NamedTemporaryFile(prefix='tmp_securedrop_bulk_dl_',
                                            dir=config.TEMP_DIR,
                                            delete=False)
-    with zipfile.ZipFile(zip_file, 'w') as zip:
-        for filename in filenames:
-            verify(filename)
-            zip.write(filename, arcname=os.path.join(
-                zip_directory,
-                os.path.basename(filename)
-            ))
-    return zip_file
+    zip_file.close()
+    try:
+        os.rename(unread_archive_path(sid), zip_file.name)
+        with zipfile.ZipFile(zip_file.name) as zip:
+            archived = set(zip.namelist())
+    except (OSError, IOError, zipfile.BadZipfile):
+        archived = None
+    if archived != set(os.path.join(zip_directory, filename)
+                       for filename in filenames):
+        os.remove(zip_file.name)
+        return None
+    return open(zip_file.name, 'rb')
+
 
+def delete_unread_archive(sid):
+    """Delete the pre-built archive of the unread submissions of the source
+    with id `sid`, if there is one."""
+    try:
+        os.remove(unread_archive_path(sid))
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
 
+
+@timed('store')
 def save_file_submission(sid, count, journalist_filename, filename, stream):
     sanitized_filename = secure_filename(filename)
 
@@ -117,6 +236,7 @@ def save_file_submission(sid, count, journalist_filename, filename, stream):
     return encrypted_file_name
 
 
+@timed('store')
 def save_message_submission(sid, count, journalist_filename, message):
     filename = "{0}-{1}-msg.gpg".format(count, journalist_filename)
     msg_loc = path(sid, filename)
@@ -124,6 +244,7 @@ def save_message_submission(sid, count, journalist_filename, message):
     return filename
 
 
+@timed('store')
 def rename_submission(sid, orig_filename, journalist_filename):
     check_submission_name = VALIDATE_FILENAME(orig_filename)
     if check_submission_name:
@@ -141,6 +262,7 @@ def rename_submission(sid, orig_filename, journalist_filename):
     return orig_filename
 
 
+@timed('store')
 def secure_unlink(fn, recursive=False):
     verify(fn)
     command = ['srm']
@@ -151,6 +273,55 @@ def secure_unlink(fn, recursive=False):
     return "success"
 
 
-def delete_source_directory(source_id):
-    secure_unlink(path(source_id), recursive=True)
+# Most paths to pass to one srm command, to keep it well under the limit on
+# the length of its arguments
+SRM_BATCH_SIZE = 100
+
+
+@timed('store')
+def secure_unlink_many(paths, recursive=False):
+    """Securely delete all of `paths`, with one srm command for each batch of
+    them. Paths that don't exist are skipped, so the job can be run again
+    after a partial failure. If some of the paths can't be deleted, the rest
+    still are, and then DeletionException is raised."""
+    for p in paths:
+        verify(p)
+    paths = [p for p in paths if os.path.lexists(p)]
+    failures = {}
+    for i in range(0, len(paths), SRM_BATCH_SIZE):
+        batch = paths[i:i + SRM_BATCH_SIZE]
+        command = ['srm', '-r'] if recursive else ['srm']
+        try:
+            subprocess.check_call(command + batch)
+        except subprocess.CalledProcessError:
+            # Try the ones that are left one at a time, to find which failed
+            for p in batch:
+                if not os.path.lexists(p):
+                    continue
+                try:
+                    secure_unlink(p, recursive)
+                except (subprocess.CalledProcessError, OSError) as e:
+                    failures[p] = str(e)
+    if failures:
+        log.error("Couldn't delete {} of {} paths".format(len(failures),
+                                                          len(paths)))
+        raise DeletionException(failures)
     return "success"
+
+
+@timed('store')
+def delete_source_directory(source_id):
+    return delete_source_directories([source_id])
+
+
+@timed('store')
+def delete_source_directories(source_ids):
+    """Securely delete the reply keypairs and store directories of
+    `source_ids`, as one job."""
+    # crypto_util imports this module
+    import crypto_util
+    crypto_util.delete_reply_keypairs(source_ids)
+    for source_id in source_ids:
+        delete_unread_archive(source_id)
+    return secure_unlink_many([path(source_id) for source_id in source_ids],
+                              recursive=True)
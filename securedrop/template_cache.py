@@ -0,0 +1,56 @@
+"""Keep the apps' compiled templates on disk.
+
+Jinja compiles each template to Python the first time it's used, which is
+most of the cost of the first request to every page. The compiled templates
+are written to `config.TEMPLATE_CACHE_DIR` when the package is built (see
+`./manage.py precompile`), so in production every process just loads them.
+"""
+import errno
+import os
+
+from jinja2 import FileSystemBytecodeCache
+
+import config
+
+TEMPLATE_CACHE_DIR = getattr(config, 'TEMPLATE_CACHE_DIR',
+                             os.path.join(config.SECUREDROP_ROOT,
+                                          'template_cache'))
+
+
+class BytecodeCache(FileSystemBytecodeCache):
+
+    """A bytecode cache that is keyed on the templates' paths relative to
+    `config.SECUREDROP_ROOT`, so the cache that's built with the package
+    still matches once it's installed, and that carries on without caching
+    when the directory isn't writable (as it isn't in production)."""
+
+    def get_cache_key(self, name, filename=None):
+        if filename is not None:
+            filename = os.path.relpath(filename, config.SECUREDROP_ROOT)
+        return super(BytecodeCache, self).get_cache_key(name, filename)
+
+    def dump_bytecode(self, bucket):
+        try:
+            super(BytecodeCache, self).dump_bytecode(bucket)
+        except (IOError, OSError):
+            pass
+
+
+def init_app(app, directory=TEMPLATE_CACHE_DIR):
+    app.jinja_env.bytecode_cache = BytecodeCache(directory)
+
+
+def compile_templates(app):
+    """Load all of `app`'s templates, compiling (and caching) any that aren't
+    in the cache already."""
+    cache = app.jinja_env.bytecode_cache
+    if cache is not None:
+        try:
+            os.makedirs(cache.directory)
+        except OSError as e:
+            # It can't be created in production, where it's read-only, but it
+            # was already filled in when the package was built
+            if e.errno not in (errno.EEXIST, errno.EACCES):
+                raise
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""Helpers for the performance benchmarks. Benchmarks are not collected by
+py.test; run them individually from the securedrop directory, e.g.:
+
+    PYTHONPATH=./tests python -m tests.benchmarks.generate
+    PYTHONPATH=./tests python -m tests.benchmarks.source_app --output base.json
+    PYTHONPATH=./tests python -m tests.benchmarks.source_app --baseline base.json
+    PYTHONPATH=./tests python -m tests.benchmarks.startup
+
+The suites print a JSON report. Given a baseline report saved with
+--output, they also list the benchmarks that got slower than the baseline
+by more than --tolerance, and exit with a non-zero status if there are any.
+"""
+from argparse import ArgumentParser
+import json
+import math
+import resource
+import sys
+import threading
+import time
+
+
+def percentile(samples, pct):
+    """Return the `pct`th percentile of `samples` (nearest-rank method)."""
+    ordered = sorted(samples)
+    if not ordered:
+        return None
+    rank = int(math.ceil(pct / 100.0 * len(ordered))) - 1
+    return ordered[max(0, min(rank, len(ordered) - 1))]
+
+
+def run_concurrently(make_client, request, num_requests, concurrency):
+    """Issue `num_requests` calls to `request(client)` spread across
+    `concurrency` threads, each with its own client from `make_client()`, and
+    return a report of the observed latencies (in seconds) and throughput.
+    """
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    remaining = [num_requests]
+
+    def run():
+        client = make_client()
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            start = time.time()
+            try:
+                request(client)
+            except Exception as e:
+                with lock:
+                    errors.append(repr(e))
+                continue
+            elapsed = time.time() - start
+            with lock:
+                latencies.append(elapsed)
+
+    threads = [threading.Thread(target=run) for _ in range(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.time() - start
+
+    return {
+        'requests': num_requests,
+        'concurrency': concurrency,
+        'errors': len(errors),
+        'duration': duration,
+        'throughput': len(latencies) / duration if duration else None,
+        'mean': sum(latencies) / len(latencies) if latencies else None,
+        'p50': percentile(latencies, 50),
+        'p99': percentile(latencies, 99),
+        'max': max(latencies) if latencies else None,
+    }
+
+
+def peak_rss(who=resource.RUSAGE_SELF):
+    """Return the peak resident set size of this process (or with
+    RUSAGE_CHILDREN, of its largest child process), in bytes."""
+    rss = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is in bytes on OS X, and kilobytes elsewhere
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def get_suite_args(description, benchmarks):
+    """Return an argument parser for a suite of `benchmarks` (their names)."""
+    parser = ArgumentParser(description=description)
+    parser.add_argument('-n', '--requests', type=int, default=100,
+                        help='number of requests to make per benchmark')
+    parser.add_argument('-c', '--concurrency', type=int, default=4,
+                        help='number of concurrent clients')
+    parser.add_argument('-b', '--benchmark', action='append',
+                        choices=benchmarks, dest='benchmarks',
+                        help='only run this benchmark (may be repeated)')
+    parser.add_argument('--output', help='save the report to this file')
+    parser.add_argument('--baseline',
+                        help='compare the report to one saved with --output')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='fraction by which a benchmark may be slower '
+                             'than the baseline (default: 0.2)')
+    return parser
+
+
+def run_suite(benchmarks, args):
+    """Run the `benchmarks`, a list of (name, make_client, request) tuples
+    (see `run_concurrently`), that were selected by `args`, and return a
+    report of the results and the peak RSS of the process."""
+    results = {}
+    for name, make_client, request in benchmarks:
+        if args.benchmarks and name not in args.benchmarks:
+            continue
+        results[name] = run_concurrently(make_client, request,
+                                         args.requests, args.concurrency)
+    return {'benchmarks': results, 'peak_rss': peak_rss()}
+
+
+def compare(report, baseline, tolerance):
+    """Return descriptions of how `report` is worse than `baseline`: lower
+    throughput, higher p50 or p99 latency, or higher peak RSS, by more than
+    `tolerance` (a fraction of the baseline)."""
+    regressions = []
+
+    def check(name, metric, value, base, higher_is_better=False):
+        if value is None or not base:
+            return
+        change = (value - base) / float(base)
+        if (-change if higher_is_better else change) > tolerance:
+            regressions.append('{}: {} {:.4g} vs. {:.4g} in baseline '
+                               '({:+.0%})'.format(name, metric, value, base,
+                                                  change))
+
+    for name, result in sorted(report['benchmarks'].items()):
+        base = baseline['benchmarks'].get(name)
+        if base is None:
+            continue
+        check(name, 'throughput', result.get('throughput'),
+              base.get('throughput'), higher_is_better=True)
+        for metric in ('p50', 'p99'):
+            check(name, metric, result[metric], base[metric])
+    check('suite', 'peak_rss', report['peak_rss'], baseline.get('peak_rss'))
+    return regressions
+
+
+def finish_suite(report, args):
+    """Print (and save) the suite's `report`, compare it to the baseline if
+    one was given, and return the exit status."""
+    print json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print >>sys.stderr, 'REGRESSION ' + regression
+        if regressions:
+            return 1
+    return 0
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""Benchmark the latency of the source interface's /generate endpoint under
+concurrent load.
+
+    PYTHONPATH=./tests python -m tests.benchmarks.generate -n 200 -c 8
+"""
+from argparse import ArgumentParser
+import json
+import os
+
+# Set environment variable so config.py uses a test environment
+os.environ['SECUREDROP_ENV'] = 'test'
+import source
+import utils
+
+from tests.benchmarks import run_concurrently
+
+
+def generate(client):
+    resp = client.get('/generate')
+    assert resp.status_code == 200, resp.status_code
+
+
+def get_args():
+    parser = ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('-n', '--requests', type=int, default=200,
+                        help='total number of requests to make')
+    parser.add_argument('-c', '--concurrency', type=int, default=8,
+                        help='number of concurrent clients')
+    return parser
+
+
+def main():
+    args = get_args().parse_args()
+    utils.env.setup()
+    try:
+        report = run_concurrently(source.app.test_client, generate,
+                                  args.requests, args.concurrency)
+    finally:
+        utils.env.teardown()
+    report['endpoint'] = '/generate'
+    print json.dumps(report, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
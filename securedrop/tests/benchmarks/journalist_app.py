@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""Benchmark the journalist interface: the index, collection pages,
+downloading submissions one at a time and in bulk, and replying.
+
+    PYTHONPATH=./tests python -m tests.benchmarks.journalist_app -n 50 -c 4
+"""
+import os
+import random
+import sys
+
+import mock
+
+# Set environment variable so config.py uses a test environment
+os.environ['SECUREDROP_ENV'] = 'test'
+import journalist
+import utils
+
+from tests.benchmarks import finish_suite, get_suite_args, run_suite
+
+BENCHMARKS = ('index', 'col', 'download', 'bulk', 'reply')
+
+
+class Collections(object):
+
+    """The journalist and sources that the benchmarks use."""
+
+    def __init__(self, num_sources, num_submissions):
+        self.user, self.password = utils.db_helper.init_journalist()
+        self.sources = []
+        for _ in range(num_sources):
+            source, _ = utils.db_helper.init_source()
+            submissions = utils.db_helper.submit(source, num_submissions)
+            utils.db_helper.reply(self.user, source, 1)
+            self.sources.append(
+                (source.filesystem_id,
+                 [submission.filename for submission in submissions]))
+
+    def new_client(self):
+        """Return a client that is logged in as the journalist."""
+        client = journalist.app.test_client()
+        resp = client.post('/login', data=dict(username=self.user.username,
+                                               password=self.password,
+                                               token='mocked'))
+        check(resp, 302)
+        return client
+
+    def index(self, client):
+        check(client.get('/'))
+
+    def col(self, client):
+        sid, _ = random.choice(self.sources)
+        check(client.get('/col/' + sid))
+
+    def download(self, client):
+        sid, filenames = random.choice(self.sources)
+        check(client.get('/col/{}/{}'.format(sid, random.choice(filenames))))
+
+    def bulk(self, client):
+        sid, filenames = random.choice(self.sources)
+        check(client.post('/bulk', data=dict(action='download', sid=sid,
+                                             doc_names_selected=filenames)))
+
+    def reply(self, client):
+        sid, _ = random.choice(self.sources)
+        check(client.post('/reply', data=dict(sid=sid,
+                                              msg='This is a test reply.')),
+              302)
+
+
+def check(resp, status_code=200):
+    assert resp.status_code == status_code, resp.status_code
+
+
+def main():
+    parser = get_suite_args(__doc__.strip().split('\n')[0], BENCHMARKS)
+    parser.add_argument('--sources', type=int, default=10,
+                        help='number of sources to create')
+    parser.add_argument('--submissions', type=int, default=5,
+                        help='number of submissions per source')
+    args = parser.parse_args()
+
+    utils.env.setup()
+    # Two-factor tokens can't be generated ahead of time, so skip checking
+    # them, as the tests do
+    patcher = mock.patch('db.Journalist.verify_token', return_value=True)
+    patcher.start()
+    try:
+        collections = Collections(args.sources, args.submissions)
+        report = run_suite([(name, collections.new_client,
+                             getattr(collections, name))
+                            for name in BENCHMARKS], args)
+    finally:
+        patcher.stop()
+        utils.env.teardown()
+    report['app'] = 'journalist'
+    sys.exit(finish_suite(report, args))
+
+
+if __name__ == "__main__":
+    main()
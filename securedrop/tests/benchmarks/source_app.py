@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""Benchmark the source interface: creating accounts, submitting messages and
+files of several sizes, and checking for replies.
+
+    PYTHONPATH=./tests python -m tests.benchmarks.source_app -n 50 -c 4
+"""
+from cStringIO import StringIO
+import os
+import sys
+
+# Set environment variable so config.py uses a test environment
+os.environ['SECUREDROP_ENV'] = 'test'
+import source
+import utils
+
+from tests.benchmarks import finish_suite, get_suite_args, run_suite
+
+# Sizes of the files submitted by the submit-file-* benchmarks
+FILE_SIZES = {
+    '1k': 1024,
+    '100k': 100 * 1024,
+    '1m': 1024 * 1024,
+    '10m': 10 * 1024 * 1024,
+}
+
+
+def new_client():
+    return source.app.test_client()
+
+
+def new_source_client():
+    """Return a client that is logged in as a new source."""
+    client = new_client()
+    create(client)
+    return client
+
+
+def check(resp, status_code=200):
+    assert resp.status_code == status_code, resp.status_code
+
+
+def generate(client):
+    check(client.get('/generate'))
+
+
+def create(client):
+    check(client.get('/generate'))
+    check(client.post('/create'), 302)
+
+
+def create_new(client):
+    # Each account needs a session of its own
+    create(new_client())
+
+
+def submit_message(client):
+    check(client.post('/submit', data=dict(msg='This is a test.',
+                                           fh=(StringIO(''), ''))), 302)
+
+
+def submit_file(size):
+    data = os.urandom(size)
+
+    def submit(client):
+        check(client.post('/submit', data=dict(
+            msg='', fh=(StringIO(data), 'benchmark.bin'))), 302)
+    return submit
+
+
+def lookup(client):
+    check(client.get('/lookup'))
+
+
+def get_benchmarks():
+    benchmarks = [
+        ('generate', new_client, generate),
+        ('create', new_client, create_new),
+        ('submit-message', new_source_client, submit_message),
+    ]
+    for name, size in sorted(FILE_SIZES.items(), key=lambda item: item[1]):
+        benchmarks.append(('submit-file-' + name, new_source_client,
+                           submit_file(size)))
+    benchmarks.append(('lookup', new_source_client, lookup))
+    return benchmarks
+
+
+def main():
+    benchmarks = get_benchmarks()
+    args = get_suite_args(__doc__.strip().split('\n')[0],
+                          [name for name, _, _ in benchmarks]).parse_args()
+    utils.env.setup()
+    try:
+        report = run_suite(benchmarks, args)
+    finally:
+        utils.env.teardown()
+    report['app'] = 'source'
+    sys.exit(finish_suite(report, args))
+
+
+if __name__ == "__main__":
+    main()
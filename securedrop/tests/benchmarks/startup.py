@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""Benchmark how long each app takes to start: to import, and from then to
+serve its first response, in a fresh process each time.
+
+    PYTHONPATH=./tests python -m tests.benchmarks.startup -n 10
+    PYTHONPATH=./tests python -m tests.benchmarks.startup -n 10 --warm-up
+"""
+import json
+import os
+import resource
+import subprocess
+import sys
+
+# Set environment variable so config.py uses a test environment
+os.environ['SECUREDROP_ENV'] = 'test'
+import config
+import utils
+
+from tests.benchmarks import (finish_suite, get_suite_args, peak_rss,
+                              percentile)
+
+APPS = ('source', 'journalist')
+
+# Run in each fresh process. Prints how long the stages took, in seconds.
+STARTUP = '''
+import json
+import time
+start = time.time()
+import {app}
+imported = time.time()
+if {warm_up}:
+    {app}.warm_up()
+warmed_up = time.time()
+resp = {app}.app.test_client().get('/')
+assert resp.status_code in (200, 302), resp.status_code
+print json.dumps(dict(import_time=imported - start,
+                      warm_up_time=warmed_up - imported,
+                      first_response_time=time.time() - warmed_up,
+                      total_time=time.time() - start))
+'''
+
+
+def start_app(app, warm_up):
+    """Start `app` in a fresh process, and return how long it took."""
+    output = subprocess.check_output(
+        [sys.executable, '-c', STARTUP.format(app=app, warm_up=warm_up)],
+        cwd=config.SECUREDROP_ROOT)
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def summarize(runs):
+    result = {'runs': len(runs)}
+    for stage in ('import_time', 'warm_up_time', 'first_response_time'):
+        samples = [run[stage] for run in runs]
+        result[stage] = sum(samples) / len(samples)
+    totals = [run['total_time'] for run in runs]
+    result.update(mean=sum(totals) / len(totals),
+                  p50=percentile(totals, 50), p99=percentile(totals, 99),
+                  max=max(totals))
+    return result
+
+
+def main():
+    parser = get_suite_args(__doc__.strip().split('\n')[0], APPS)
+    parser.add_argument('--warm-up', action='store_true',
+                        help="call the app's warm_up() before the first "
+                             "request, as a pre-fork server would")
+    args = parser.parse_args()
+
+    utils.env.setup()
+    try:
+        results = {}
+        for app in APPS:
+            if args.benchmarks and app not in args.benchmarks:
+                continue
+            results[app] = summarize([start_app(app, args.warm_up)
+                                      for _ in range(args.requests)])
+    finally:
+        utils.env.teardown()
+    report = {'benchmarks': results,
+              'peak_rss': max(peak_rss(),
+                              peak_rss(resource.RUSAGE_CHILDREN)),
+              'warm_up': args.warm_up}
+    sys.exit(finish_suite(report, args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import unittest
+
+import mock
+
+# Set environment variable so config.py uses a test environment
+os.environ['SECUREDROP_ENV'] = 'test'
+import config
+import consistency
+from db import db_session, Source
+import store
+import utils
+
+
+class TestConsistency(unittest.TestCase):
+
+    """The set of tests for consistency.py."""
+
+    def setUp(self):
+        utils.env.setup()
+
+    def tearDown(self):
+        utils.env.teardown()
+        db_session.remove()
+
+    def test_check_consistent(self):
+        source, _ = utils.db_helper.init_source()
+        utils.db_helper.submit(source, 2)
+        self.assertEqual(consistency.check(),
+                         consistency.Report([], [], [], []))
+
+    def test_check_orphaned_dir(self):
+        orphan = os.path.join(config.STORE_DIR, 'ORPHAN')
+        os.mkdir(orphan)
+        self.assertEqual(consistency.check().orphaned_dirs, [orphan])
+
+    def test_check_orphaned_file(self):
+        source, _ = utils.db_helper.init_source()
+        submission = utils.db_helper.submit(source, 1)[0]
+        db_session.delete(submission)
+        db_session.commit()
+        report = consistency.check()
+        self.assertEqual(report.orphaned_files,
+                         [os.path.join(config.STORE_DIR, source.filesystem_id,
+                                       submission.filename)])
+        self.assertEqual(report.orphaned_dirs, [])
+
+    def test_check_missing_dir_and_files(self):
+        source, _ = utils.db_helper.init_source()
+        utils.db_helper.submit(source, 1)
+        shutil.rmtree(os.path.join(config.STORE_DIR, source.filesystem_id))
+        report = consistency.check()
+        self.assertEqual(report.missing_dirs, [source.filesystem_id])
+        # Files in a missing directory are only reported as a missing dir
+        self.assertEqual(report.missing_files, [])
+
+    def test_check_missing_file(self):
+        source, _ = utils.db_helper.init_source()
+        submission = utils.db_helper.submit(source, 1)[0]
+        path = os.path.join(config.STORE_DIR, source.filesystem_id,
+                            submission.filename)
+        os.remove(path)
+        self.assertEqual(consistency.check().missing_files, [path])
+
+    @mock.patch('store.secure_unlink')
+    def test_wipe_orphans(self, secure_unlink):
+        orphan = os.path.join(config.STORE_DIR, 'ORPHAN')
+        os.mkdir(orphan)
+        source, _ = utils.db_helper.init_source()
+        submission = utils.db_helper.submit(source, 1)[0]
+        db_session.delete(submission)
+        db_session.commit()
+        consistency.wipe_orphans()
+        secure_unlink.assert_has_calls(
+            [mock.call(orphan, recursive=True),
+             mock.call(os.path.join(config.STORE_DIR, source.filesystem_id,
+                                    submission.filename), recursive=False)],
+            any_order=True)
+        self.assertEqual(secure_unlink.call_count, 2)
+
+    @mock.patch('subprocess.check_call')
+    def test_wipe_orphans_reports_unexpected_names(self, check_call):
+        orphan = os.path.join(config.STORE_DIR, 'ORPHAN')
+        os.mkdir(orphan)
+        source, _ = utils.db_helper.init_source()
+        # A file whose name doesn't match the store's filename format, so
+        # store.verify refuses to delete it
+        unexpected = os.path.join(config.STORE_DIR, source.filesystem_id,
+                                  'unexpected')
+        with open(unexpected, 'w') as f:
+            f.write('unexpected')
+
+        with self.assertRaises(store.DeletionException) as cm:
+            consistency.wipe_orphans()
+        self.assertEqual(cm.exception.failures.keys(), [unexpected])
+        # The other orphan is still deleted
+        check_call.assert_called_once_with(['srm', '-r', orphan])
@@ -4,11 +4,15 @@
 import os
 import unittest
 
+import gnupg
+import mock
+
 # Set environment variable so config.py uses a test environment
 os.environ['SECUREDROP_ENV'] = 'test'
 
 import config
 import crypto_util
+from db import db_session
 import utils
 
 
@@ -21,6 +25,7 @@ class TestCryptoUtil(unittest.TestCase):
 
     def tearDown(self):
         utils.env.teardown()
+        db_session.remove()
 
     def test_clean(self):
         with self.assertRaises(crypto_util.CryptoException):
@@ -28,5 +33,188 @@ class TestCryptoUtil(unittest.TestCase):
         with self.assertRaises(crypto_util.CryptoException):
             crypto_util.clean('bar baz~') # tilde is not currently allowed
 
+    def test_wordlists_have_no_blank_or_duplicate_words(self):
+        for wordlist in (crypto_util.words, crypto_util.nouns,
+                         crypto_util.adjectives):
+            self.assertNotIn('', wordlist)
+            self.assertEqual(len(set(wordlist)), len(wordlist))
+
+    def test_lazy_value_is_created_on_first_use(self):
+        calls = []
+        lazy = crypto_util._Lazy(lambda: calls.append(1) or ('a', 'b'))
+        self.assertEqual(calls, [])
+        self.assertEqual(len(lazy), 2)
+        self.assertIn('a', lazy)
+        self.assertEqual(list(lazy), ['a', 'b'])
+        self.assertEqual(lazy[1], 'b')
+        self.assertEqual(lazy.index('b'), 1)
+        self.assertEqual(calls, [1])
+
+    @mock.patch('crypto_util._journalist_pubkey', None)
+    def test_journalist_pubkey_empty_export_is_not_cached(self):
+        with mock.patch('gnupg.GPG.export_keys', autospec=True,
+                        side_effect=['', 'pubkey']) as export_keys:
+            self.assertEqual(crypto_util.journalist_pubkey(), '')
+            self.assertEqual(crypto_util.journalist_pubkey(), 'pubkey')
+            self.assertEqual(crypto_util.journalist_pubkey(), 'pubkey')
+        self.assertEqual(export_keys.call_count, 2)
+
+    def test_reply_keypair_has_own_keyring(self):
+        source, codename = utils.db_helper.init_source()
+        sid = source.filesystem_id
+        fingerprint = crypto_util.getkey(sid)
+        self.assertIsNotNone(fingerprint)
+        # The shared keyring only holds the journalist key
+        self.assertEqual([key['fingerprint'] for key in crypto_util.gpg.list_keys()],
+                         [config.JOURNALIST_KEY])
+        keyring = crypto_util.source_gpg(sid)
+        self.assertEqual(
+            sorted(key['fingerprint'] for key in keyring.list_keys()),
+            sorted([fingerprint, config.JOURNALIST_KEY]))
+
+    def test_encrypt_decrypt_reply(self):
+        source, codename = utils.db_helper.init_source()
+        sid = source.filesystem_id
+        ciphertext = crypto_util.encrypt(
+            'Goodbye, cruel world!',
+            [crypto_util.getkey(sid), config.JOURNALIST_KEY], sid=sid)
+        self.assertEqual(crypto_util.decrypt(codename, ciphertext, sid=sid),
+                         'Goodbye, cruel world!')
+        self.assertEqual(crypto_util.decrypt(codename, ciphertext),
+                         'Goodbye, cruel world!')
+
+    def test_delete_reply_keypair(self):
+        source, codename = utils.db_helper.init_source()
+        sid = source.filesystem_id
+        crypto_util.delete_reply_keypair(sid)
+        self.assertIsNone(crypto_util.getkey(sid))
+        self.assertFalse(os.path.exists(crypto_util.source_keyring_dir(sid)))
+
+    def test_legacy_reply_keypair(self):
+        # Keypairs generated before sources had their own keyrings are in the
+        # shared keyring
+        sid = crypto_util.hash_codename(crypto_util.genrandomid())
+        crypto_util.gpg.gen_key(crypto_util.gpg.gen_key_input(
+            key_type=crypto_util.GPG_KEY_TYPE,
+            key_length=crypto_util.GPG_KEY_LENGTH,
+            passphrase='passphrase', name_email=sid))
+        crypto_util._legacy_keys = None
+        try:
+            fingerprint = crypto_util.getkey(sid)
+            self.assertIsNotNone(fingerprint)
+            self.assertIn(fingerprint, [key['fingerprint'] for key in
+                                        crypto_util.gpg.list_keys()])
+
+            crypto_util.delete_reply_keypair(sid)
+            self.assertIsNone(crypto_util.getkey(sid))
+            self.assertNotIn(fingerprint, [key['fingerprint'] for key in
+                                           crypto_util.gpg.list_keys()])
+        finally:
+            crypto_util._legacy_keys = None
+
+    def test_delete_reply_keypairs(self):
+        sources = [utils.db_helper.init_source()[0] for _ in range(2)]
+        legacy_sid = crypto_util.hash_codename(crypto_util.genrandomid())
+        crypto_util.gpg.gen_key(crypto_util.gpg.gen_key_input(
+            key_type=crypto_util.GPG_KEY_TYPE,
+            key_length=crypto_util.GPG_KEY_LENGTH,
+            passphrase='passphrase', name_email=legacy_sid))
+        crypto_util._legacy_keys = None
+        try:
+            sids = [source.filesystem_id for source in sources] + [legacy_sid]
+            crypto_util.delete_reply_keypairs(sids + ['no key'])
+            for sid in sids:
+                self.assertIsNone(crypto_util.getkey(sid))
+            self.assertEqual([key['fingerprint'] for key in
+                              crypto_util.gpg.list_keys()],
+                             [config.JOURNALIST_KEY])
+        finally:
+            crypto_util._legacy_keys = None
+
+    def test_migrate_legacy_keypairs(self):
+        source, _ = utils.db_helper.init_source()
+        legacy_sids = [crypto_util.hash_codename(crypto_util.genrandomid())
+                       for _ in range(3)]
+        for sid in legacy_sids:
+            crypto_util.gpg.gen_key(crypto_util.gpg.gen_key_input(
+                key_type=crypto_util.GPG_KEY_TYPE,
+                key_length=crypto_util.GPG_KEY_LENGTH,
+                passphrase='passphrase', name_email=sid))
+        crypto_util._legacy_keys = None
+        try:
+            fingerprints = dict((sid, crypto_util.getkey(sid))
+                                for sid in legacy_sids)
+            self.assertEqual(
+                crypto_util.migrate_legacy_keypairs(batch_size=2), 3)
+
+            # Only the journalist key is left in the shared keyring
+            self.assertEqual([key['fingerprint'] for key in
+                              crypto_util.gpg.list_keys()],
+                             [config.JOURNALIST_KEY])
+            for sid in legacy_sids:
+                keyring = crypto_util.source_gpg(sid)
+                self.assertIsNotNone(keyring)
+                self.assertEqual(crypto_util.getkey(sid), fingerprints[sid])
+                ciphertext = crypto_util.encrypt(
+                    'Goodbye, cruel world!',
+                    [fingerprints[sid], config.JOURNALIST_KEY], sid=sid)
+                self.assertEqual(
+                    keyring.decrypt(ciphertext, passphrase='passphrase').data,
+                    'Goodbye, cruel world!')
+            # The source that already had a keyring of its own is untouched
+            self.assertIsNotNone(crypto_util.getkey(source.filesystem_id))
+
+            # There's nothing left to move
+            crypto_util._legacy_keys = None
+            self.assertEqual(crypto_util.migrate_legacy_keypairs(), 0)
+        finally:
+            crypto_util._legacy_keys = None
+
+    def test_compact_keyrings(self):
+        source, codename = utils.db_helper.init_source()
+        crypto_util.delete_reply_keypair(source.filesystem_id)
+        crypto_util.compact_keyrings()
+        # The keys in the shared keyring survive compaction
+        self.assertEqual([key['fingerprint'] for key in
+                          crypto_util.gpg.list_keys()],
+                         [config.JOURNALIST_KEY])
+        self.assertEqual([key['fingerprint'] for key in
+                          crypto_util.gpg.list_keys(secret=True)],
+                         [config.JOURNALIST_KEY])
+        # The emptied shard is removed
+        self.assertEqual(os.listdir(crypto_util.SOURCE_KEYRINGS_DIR), [])
+
+    def test_compact_keyrings_does_not_restore_deleted_keypairs(self):
+        sid = crypto_util.hash_codename(crypto_util.genrandomid())
+        crypto_util.gpg.gen_key(crypto_util.gpg.gen_key_input(
+            key_type=crypto_util.GPG_KEY_TYPE,
+            key_length=crypto_util.GPG_KEY_LENGTH,
+            passphrase='passphrase', name_email=sid))
+        crypto_util._legacy_keys = None
+        fingerprint = crypto_util.getkey(sid)
+        export_keys = gnupg.GPG.export_keys
+        deleted = []
+
+        def export_and_delete(keyring, keyids, secret=False, subkeys=False):
+            # Delete the keypair, as the journalist app would, once the
+            # compaction has copied it
+            exported = export_keys(keyring, keyids, secret, subkeys)
+            if secret and not deleted:
+                crypto_util.delete_reply_keypair(sid)
+                deleted.append(sid)
+            return exported
+
+        try:
+            with mock.patch('gnupg.GPG.export_keys', autospec=True,
+                            side_effect=export_and_delete):
+                crypto_util.compact_keyrings()
+            self.assertEqual(deleted, [sid])
+            self.assertNotIn(fingerprint, [key['fingerprint'] for key in
+                                           crypto_util.gpg.list_keys(secret=True)])
+            self.assertNotIn(fingerprint, [key['fingerprint'] for key in
+                                           crypto_util.gpg.list_keys()])
+        finally:
+            crypto_util._legacy_keys = None
+
 if __name__ == "__main__":
     unittest.main(verbosity=2)
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import datetime
+import mock
+import os
+import unittest
+
+from redis.exceptions import ConnectionError
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.orm import sessionmaker
+
+# Set environment variable so config.py uses a test environment
+os.environ['SECUREDROP_ENV'] = 'test'
+import config
+from db import (db_session, engine, migrate_db, Journalist,
+                JournalistLoginAttempt, LoginThrottledException, Reply,
+                Submission)
+import utils
+import worker
+
+# The schema of databases created before migrate_db was added, which
+# package upgrades have to bring up to date.
+BASELINE_SCHEMA = [
+    """CREATE TABLE journalists (
+        id INTEGER NOT NULL, username VARCHAR(255) NOT NULL,
+        pw_salt BLOB, pw_hash BLOB, is_admin BOOLEAN, otp_secret VARCHAR(16),
+        is_totp BOOLEAN, hotp_counter INTEGER, last_token VARCHAR(6),
+        created_on DATETIME, last_access DATETIME,
+        PRIMARY KEY (id), UNIQUE (username))""",
+    """CREATE TABLE journalist_login_attempt (
+        id INTEGER NOT NULL, timestamp DATETIME, journalist_id INTEGER,
+        PRIMARY KEY (id), FOREIGN KEY(journalist_id) REFERENCES journalists (id))""",
+    """CREATE TABLE sources (
+        id INTEGER NOT NULL, filesystem_id VARCHAR(96),
+        journalist_designation VARCHAR(255) NOT NULL, flagged BOOLEAN,
+        last_updated DATETIME, journalist_id INTEGER, pending BOOLEAN,
+        interaction_count INTEGER NOT NULL,
+        PRIMARY KEY (id), UNIQUE (filesystem_id))""",
+    """CREATE TABLE replies (
+        id INTEGER NOT NULL, journalist_id INTEGER, source_id INTEGER,
+        filename VARCHAR(255) NOT NULL, size INTEGER NOT NULL,
+        PRIMARY KEY (id),
+        FOREIGN KEY(journalist_id) REFERENCES journalists (id),
+        FOREIGN KEY(source_id) REFERENCES sources (id))""",
+    """CREATE TABLE source_stars (
+        id INTEGER NOT NULL, source_id INTEGER, starred BOOLEAN,
+        PRIMARY KEY (id), FOREIGN KEY(source_id) REFERENCES sources (id))""",
+    """CREATE TABLE submissions (
+        id INTEGER NOT NULL, source_id INTEGER,
+        filename VARCHAR(255) NOT NULL, size INTEGER NOT NULL,
+        downloaded BOOLEAN,
+        PRIMARY KEY (id), FOREIGN KEY(source_id) REFERENCES sources (id))""",
+    "INSERT INTO journalists (id, username) VALUES (1, 'journalist')",
+    """INSERT INTO sources (id, filesystem_id, journalist_designation,
+        interaction_count) VALUES (1, 'fid', 'source', 3)""",
+    """INSERT INTO submissions (id, source_id, filename, size, downloaded)
+        VALUES (1, 1, '1-source-msg.gpg', 10, 0),
+               (2, 1, '3-source-doc.gz.gpg', 20, 0)""",
+    """INSERT INTO replies (id, journalist_id, source_id, filename, size)
+        VALUES (1, 1, 1, '2-source-reply.gpg', 30)""",
+]
+
+
+class TestDatabase(unittest.TestCase):
+
+    """The set of tests for db.py."""
+
+    def setUp(self):
+        utils.env.setup()
+        self.user, _ = utils.db_helper.init_journalist()
+        worker.redis.delete(
+            'journalist_login_attempts:{}'.format(self.user.id))
+
+    def tearDown(self):
+        worker.redis.delete(
+            'journalist_login_attempts:{}'.format(self.user.id))
+        utils.env.teardown()
+        db_session.remove()
+
+    def test_throttle_login(self):
+        for _ in range(Journalist._MAX_LOGIN_ATTEMPTS_PER_PERIOD):
+            Journalist.throttle_login(self.user)
+        with self.assertRaises(LoginThrottledException):
+            Journalist.throttle_login(self.user)
+
+    def test_throttle_login_is_per_user(self):
+        other_user, _ = utils.db_helper.init_journalist()
+        for _ in range(Journalist._MAX_LOGIN_ATTEMPTS_PER_PERIOD):
+            Journalist.throttle_login(self.user)
+        # This journalist's attempts don't count against another one
+        try:
+            Journalist.throttle_login(other_user)
+        except LoginThrottledException:
+            self.fail("another journalist's attempts were counted")
+        finally:
+            worker.redis.delete(
+                'journalist_login_attempts:{}'.format(other_user.id))
+
+    @mock.patch('worker.redis.pipeline', side_effect=ConnectionError)
+    def test_throttle_login_falls_back_to_db(self, mock_pipeline):
+        for _ in range(Journalist._MAX_LOGIN_ATTEMPTS_PER_PERIOD):
+            Journalist.throttle_login(self.user)
+        with self.assertRaises(LoginThrottledException):
+            Journalist.throttle_login(self.user)
+        self.assertEqual(JournalistLoginAttempt.query.count(),
+                         Journalist._MAX_LOGIN_ATTEMPTS_PER_PERIOD + 1)
+
+    def test_migrate_db_indexes_login_attempt_timestamp(self):
+        table = JournalistLoginAttempt.__table__
+        for index in table.indexes:
+            index.drop(bind=engine)
+        migrate_db()
+        self.assertEqual(
+            [index['column_names'] for index in
+             inspect(engine).get_indexes(table.name)], [['timestamp']])
+
+    def test_migrate_db_upgrades_baseline_schema(self):
+        baseline = create_engine(
+            'sqlite:///' + os.path.join(config.TEMP_DIR, 'baseline.sqlite'))
+        for statement in BASELINE_SCHEMA:
+            baseline.execute(statement)
+
+        # Running it again must not fail or change anything
+        migrate_db(baseline)
+        migrate_db(baseline)
+
+        for table in (Submission.__table__, Reply.__table__):
+            self.assertEqual(
+                sorted(index['name'] for index in
+                       inspect(baseline).get_indexes(table.name)),
+                sorted(index.name for index in table.indexes))
+        session = sessionmaker(bind=baseline)()
+        self.assertEqual(
+            [(s.filename, s.interaction_index) for s in
+             session.query(Submission).order_by(Submission.id)],
+            [('1-source-msg.gpg', 1), ('3-source-doc.gz.gpg', 3)])
+        self.assertEqual(
+            [(r.filename, r.interaction_index) for r in
+             session.query(Reply)], [('2-source-reply.gpg', 2)])
+        session.close()
+
+    def test_prune_login_attempts(self):
+        old_attempt = JournalistLoginAttempt(self.user)
+        old_attempt.timestamp = (datetime.datetime.utcnow() -
+                                 datetime.timedelta(hours=1))
+        db_session.add(old_attempt)
+        db_session.add(JournalistLoginAttempt(self.user))
+        db_session.commit()
+
+        self.assertEqual(JournalistLoginAttempt.prune(), 1)
+        self.assertEqual(JournalistLoginAttempt.query.count(), 1)
+
+    def test_verify_totp_token(self):
+        self.assertTrue(self.user.verify_token(self.user.totp.now()))
+        self.assertFalse(self.user.verify_token('abcdef'))
+        # Verification doesn't write to the database by itself
+        self.assertIn(self.user, db_session.dirty)
+
+    def test_verify_hotp_token_advances_counter(self):
+        self.user.set_hotp_secret('123456')
+        db_session.commit()
+        token = self.user.hotp.at(3)
+        self.assertTrue(self.user.verify_token(token))
+        self.assertEqual(self.user.hotp_counter, 4)
+        self.assertFalse(self.user.verify_token(token))
+
+    def test_login_saves_token_and_access_time(self):
+        user, password = utils.db_helper.init_journalist()
+        token = user.totp.now()
+        Journalist.login(user.username, password, token)
+        db_session.expire_all()
+        self.assertEqual(user.last_token, token)
+        self.assertIsNotNone(user.last_access)
+
+    def test_collection_page(self):
+        source, _ = utils.db_helper.init_source()
+        items = utils.db_helper.submit(source, 2)
+        items += utils.db_helper.reply(self.user, source, 1)
+        items += utils.db_helper.submit(source, 2)
+        self.assertEqual([item.interaction_index for item in items],
+                         range(1, 6))
+
+        self.assertEqual(source.collection_page(1, 2), items[:2])
+        self.assertEqual(source.collection_page(2, 2), items[2:4])
+        self.assertEqual(source.collection_page(3, 2), items[4:])
+        self.assertEqual(source.collection_page(4, 2), [])
+        self.assertEqual(source.collection_totals(),
+                         {'count': 5,
+                          'size': sum(item.size for item in items)})
+
+    def test_collection_items(self):
+        source, _ = utils.db_helper.init_source()
+        items = utils.db_helper.submit(source, 2)
+        items += utils.db_helper.reply(self.user, source, 2)
+        self.assertEqual(
+            source.collection_items([items[3].filename, items[0].filename,
+                                     'nonexistent']),
+            [items[0], items[3]])
+        self.assertEqual(source.collection_items([]), [])
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
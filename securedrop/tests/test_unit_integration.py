@@ -246,17 +246,31 @@ class TestIntegration(unittest.TestCase):
         # _encoding attribute it would have had it been initialized in a "C"
         # environment. See
         # https://github.com/freedomofpress/securedrop/issues/1360 for context.
+        # Replies are encrypted with the source's own keyring, so the GPG
+        # objects for those need to be patched as well.
+        make_gpg = crypto_util._make_gpg
+
+        def make_ansi_gpg(homedir):
+            gpg = make_gpg(homedir)
+            gpg._encoding = "ansi_x3.4_1968"
+            return gpg
+
         old_encoding = crypto_util.gpg._encoding
         crypto_util.gpg._encoding = "ansi_x3.4_1968"
+        crypto_util._source_gpgs.clear()
         try:
-            self.helper_test_reply("ᚠᛇᚻ᛫ᛒᛦᚦ᛫ᚠᚱᚩᚠᚢᚱ᛫ᚠᛁᚱᚪ᛫ᚷᛖᚻᚹᛦᛚᚳᚢᛗ", True)
+            with mock.patch('crypto_util._make_gpg', make_ansi_gpg):
+                self.helper_test_reply("ᚠᛇᚻ᛫ᛒᛦᚦ᛫ᚠᚱᚩᚠᚢᚱ᛫ᚠᛁᚱᚪ᛫ᚷᛖᚻᚹᛦᛚᚳᚢᛗ", True)
         finally:
             crypto_util.gpg._encoding = old_encoding
+            crypto_util._source_gpgs.clear()
 
-    def _can_decrypt_with_key(self, msg, key_fpr, passphrase=None):
+    def _can_decrypt_with_key(self, msg, key_fpr, passphrase=None,
+                              keyring=None):
         """
         Test that the given GPG message can be decrypted with the given key
-        (identified by its fingerprint).
+        (identified by its fingerprint), which is in `keyring` (by default,
+        the application's shared keyring).
         """
         # GPG does not provide a way to specify which key to use to decrypt a
         # message. Since the default keyring that we use has both the
@@ -267,8 +281,9 @@ class TestIntegration(unittest.TestCase):
         gpg = gnupg.GPG(homedir=gpg_tmp_dir)
 
         # Export the key of interest from the application's keyring
-        pubkey = self.gpg.export_keys(key_fpr)
-        seckey = self.gpg.export_keys(key_fpr, secret=True)
+        keyring = keyring or self.gpg
+        pubkey = keyring.export_keys(key_fpr)
+        seckey = keyring.export_keys(key_fpr, secret=True)
         # Import it into our isolated temporary GPG directory
         for key in (pubkey, seckey):
             gpg.import_keys(key)
@@ -372,7 +387,8 @@ class TestIntegration(unittest.TestCase):
         zf = zipfile.ZipFile(StringIO(resp.data), 'r')
         data = zf.read(zf.namelist()[0])
         self._can_decrypt_with_key(data, config.JOURNALIST_KEY)
-        self._can_decrypt_with_key(data, crypto_util.getkey(sid), codename)
+        self._can_decrypt_with_key(data, crypto_util.getkey(sid), codename,
+                                   keyring=crypto_util.source_gpg(sid))
 
         # Test deleting reply on the journalist interface
         last_reply_number = len(
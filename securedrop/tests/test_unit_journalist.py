@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 from cStringIO import StringIO
+import mock
 import os
 import random
 import time
@@ -10,6 +11,7 @@ import zipfile
 
 from flask import url_for, escape
 from flask_testing import TestCase
+from redis.exceptions import RedisError
 
 # Set environment variable so config.py uses a test environment
 os.environ['SECUREDROP_ENV'] = 'test'
@@ -18,7 +20,9 @@ import crypto_util
 from db import (db_session, InvalidPasswordLength, Journalist, Reply, Source,
                 Submission)
 import journalist
+import store
 import utils
+import worker
 
 # Smugly seed the RNG for deterministic testing
 random.seed('¯\_(ツ)_/¯')
@@ -153,6 +157,26 @@ class TestJournalistApp(TestCase):
         self.assert200(resp)
         self.assertIn("Admin Interface", resp.data)
 
+    def test_admin_metrics(self):
+        self._login_admin()
+        with mock.patch('metrics.snapshot',
+                        return_value={'source': {'lookup': {'requests': 1}}}):
+            resp = self.client.get(url_for('admin_metrics'))
+        self.assert200(resp)
+        self.assertEqual(resp.json['source']['lookup']['requests'], 1)
+
+    def test_user_cannot_see_metrics(self):
+        self._login_user()
+        resp = self.client.get(url_for('admin_metrics'))
+        self.assertRedirects(resp, url_for('index'))
+
+    def test_server_timing_header(self):
+        self._login_user()
+        resp = self.client.get(url_for('index'))
+        self.assertIn('sql;dur=', resp.headers['Server-Timing'])
+        self.assertIn('template;dur=', resp.headers['Server-Timing'])
+        self.assertIn('total;dur=', resp.headers['Server-Timing'])
+
     def test_admin_delete_user(self):
         # Verify journalist is in the database
         self.assertNotEqual(Journalist.query.get(self.user.id), None)
@@ -527,7 +551,9 @@ class TestJournalistApp(TestCase):
         source_key = crypto_util.getkey(self.source.filesystem_id)
         self.assertNotEqual(source_key, None)
 
-        journalist.delete_collection(self.source.filesystem_id)
+        job = journalist.delete_collection(self.source.filesystem_id)
+        # The key is deleted by the same job as the documents
+        utils.async.wait_for_redis_worker(job)
 
         # Source key no longer exists
         source_key = crypto_util.getkey(self.source.filesystem_id)
@@ -549,6 +575,30 @@ class TestJournalistApp(TestCase):
         # Encrypted documents no longer exist
         self.assertFalse(os.path.exists(dir_source_docs))
 
+    @mock.patch('journalist.DELETE_BATCH_SOURCES', 2)
+    def test_delete_collections_in_batches(self):
+        sources = [utils.db_helper.init_source()[0] for _ in range(3)]
+        for source in sources:
+            utils.db_helper.submit(source, 1)
+        dirs = [store.path(source.filesystem_id) for source in sources]
+
+        jobs = journalist.delete_collections(sources)
+        self.assertEqual([len(job.args[0]) for job in jobs], [2, 1])
+        for job in jobs:
+            utils.async.wait_for_redis_worker(job)
+        for source_dir in dirs:
+            self.assertFalse(os.path.exists(source_dir))
+
+    @mock.patch('journalist.DELETE_BATCH_BYTES', 1)
+    def test_delete_batches_by_size(self):
+        sources = [utils.db_helper.init_source()[0] for _ in range(3)]
+        utils.db_helper.submit(sources[0], 1)
+        # Sources with nothing to delete still fit in a batch
+        self.assertEqual(journalist.delete_batches(sources),
+                         [[sources[0].filesystem_id],
+                          [sources[1].filesystem_id,
+                           sources[2].filesystem_id]])
+
     def test_download_selected_submissions_from_source(self):
         source, _ = utils.db_helper.init_source()
         submissions = set(utils.db_helper.submit(source, 4))
@@ -658,6 +708,164 @@ class TestJournalistApp(TestCase):
             else:
                 self.assertTrue(False)
 
+    @mock.patch('journalist.COLLECTION_PAGE_SIZE', 2)
+    def test_col_is_paginated(self):
+        source, _ = utils.db_helper.init_source()
+        submissions = utils.db_helper.submit(source, 3)
+        self._login_user()
+
+        resp = self.client.get(url_for('col', sid=source.filesystem_id))
+        self.assert200(resp)
+        self.assertIn(submissions[0].filename, resp.data)
+        self.assertIn(submissions[1].filename, resp.data)
+        self.assertNotIn(submissions[2].filename, resp.data)
+        self.assertIn("Page 1 of 2", resp.data)
+
+        resp = self.client.get(url_for('col', sid=source.filesystem_id,
+                                       page=2))
+        self.assertNotIn(submissions[0].filename, resp.data)
+        self.assertIn(submissions[2].filename, resp.data)
+        self.assertIn("Page 2 of 2", resp.data)
+
+    def test_download_single_submission_range(self):
+        source, _ = utils.db_helper.init_source()
+        submission = utils.db_helper.submit(source, 1)[0]
+        with open(store.path(source.filesystem_id, submission.filename)) as f:
+            data = f.read()
+        url = url_for('download_single_submission', sid=source.filesystem_id,
+                      fn=submission.filename)
+        self._login_user()
+
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Accept-Ranges'], 'bytes')
+        # Production strips ETags, so downloads are validated by date only
+        self.assertNotIn('ETag', resp.headers)
+        last_modified = resp.headers['Last-Modified']
+
+        # Resume the download from the 10th byte
+        resp = self.client.get(url, headers={'Range': 'bytes=10-',
+                                             'If-Range': last_modified})
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp.data, data[10:])
+        self.assertEqual(resp.headers['Content-Range'],
+                         'bytes 10-{0}/{1}'.format(len(data) - 1, len(data)))
+
+        # The whole file is sent if it doesn't match If-Range
+        resp = self.client.get(url, headers={
+            'Range': 'bytes=10-',
+            'If-Range': 'Thu, 01 Jan 1970 00:00:00 GMT'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, data)
+
+        resp = self.client.get(url,
+                               headers={'If-Modified-Since': last_modified})
+        self.assertEqual(resp.status_code, 304)
+
+        resp = self.client.get(
+            url, headers={'Range': 'bytes={}-'.format(len(data))})
+        self.assertEqual(resp.status_code, 416)
+
+    def test_download_single_submission_multiple_ranges(self):
+        source, _ = utils.db_helper.init_source()
+        submission = utils.db_helper.submit(source, 1)[0]
+        with open(store.path(source.filesystem_id, submission.filename)) as f:
+            data = f.read()
+        url = url_for('download_single_submission', sid=source.filesystem_id,
+                      fn=submission.filename)
+        self._login_user()
+
+        # Requests for several ranges get the whole file, even if some of the
+        # ranges can't be satisfied
+        for ranges in ('bytes=0-4,10-14',
+                       'bytes=0-4,{}-'.format(len(data))):
+            resp = self.client.get(url, headers={'Range': ranges})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.data, data)
+            self.assertNotIn('Content-Range', resp.headers)
+
+    def test_download_archive_is_reused(self):
+        source, _ = utils.db_helper.init_source()
+        submissions = utils.db_helper.submit(source, 2)
+        self._login_user()
+        data = dict(action='download', sid=source.filesystem_id,
+                    doc_names_selected=[s.filename for s in submissions])
+        resp = self.client.post('/bulk', data=data)
+        self.assertEqual(resp.status_code, 200)
+        last_modified = resp.headers['Last-Modified']
+
+        resp = self.client.post('/bulk', data=data,
+                                headers={'Range': 'bytes=10-',
+                                         'If-Range': last_modified})
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp.headers['Last-Modified'], last_modified)
+
+    @mock.patch('journalist.JOURNALIST_CACHE_TTL', 60)
+    def test_journalist_cache_is_invalidated_by_changes(self):
+        journalist._journalist_cache.clear()
+        cached_user = journalist.get_journalist(self.user.id)
+        self.assertEqual(cached_user.username, self.user.username)
+        self.assertIn(self.user.username,
+                      [j.username for j in journalist.get_journalist_usernames()])
+
+        cached_user.username = 'renamed'
+        db_session.commit()
+
+        self.assertEqual(journalist.get_journalist(self.user.id).username,
+                         'renamed')
+        self.assertIn('renamed',
+                      [j.username for j in journalist.get_journalist_usernames()])
+
+    @mock.patch('journalist.JOURNALIST_CACHE_TTL', 60)
+    def test_journalist_cache_is_invalidated_across_processes(self):
+        journalist._journalist_cache.clear()
+        uid = self.user.id
+        self.assertFalse(journalist.get_journalist(uid).is_admin)
+
+        # Another process makes the journalist an admin. The rows are updated
+        # directly, so this process doesn't see the change...
+        db_session.execute(Journalist.__table__.update()
+                           .where(Journalist.id == uid)
+                           .values(is_admin=True))
+        db_session.commit()
+        db_session.remove()
+        self.assertFalse(journalist.get_journalist(uid).is_admin)
+        db_session.remove()
+
+        # ...until that process bumps the generation when it commits
+        generation = int(journalist._journalist_cache_generation())
+        user = Journalist.query.get(uid)
+        user.is_admin = False
+        db_session.commit()
+        self.assertEqual(int(journalist._journalist_cache_generation()),
+                         generation + 1)
+        db_session.remove()
+        self.assertFalse(journalist.get_journalist(uid).is_admin)
+
+        db_session.execute(Journalist.__table__.update()
+                           .where(Journalist.id == uid)
+                           .values(is_admin=True))
+        db_session.commit()
+        db_session.remove()
+        worker.redis.incr(journalist.JOURNALIST_CACHE_GENERATION_KEY)
+        self.assertTrue(journalist.get_journalist(uid).is_admin)
+
+    @mock.patch('journalist.JOURNALIST_CACHE_TTL', 60)
+    @mock.patch('worker.redis.get', side_effect=RedisError)
+    def test_journalist_cache_is_bypassed_without_redis(self, mock_get):
+        journalist._journalist_cache.clear()
+        uid = self.user.id
+        self.assertFalse(journalist.get_journalist(uid).is_admin)
+        db_session.execute(Journalist.__table__.update()
+                           .where(Journalist.id == uid)
+                           .values(is_admin=True))
+        db_session.commit()
+        db_session.remove()
+        self.assertTrue(journalist.get_journalist(uid).is_admin)
+
+    def test_get_journalist_nonexistent_user(self):
+        self.assertIsNone(journalist.get_journalist(self.admin.id + 1))
+
     def test_add_star_redirects_to_index(self):
         source, _ = utils.db_helper.init_source()
         self._login_user()
@@ -1,12 +1,71 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import manage
+import os
 import unittest
 
+# Set environment variable so config.py uses a test environment
+os.environ['SECUREDROP_ENV'] = 'test'
+from db import db_session, Source, Submission
+import manage
+import store
+import utils
+
 
 class TestManagePy(unittest.TestCase):
 
     def test_parse_args(self):
         # just test that the arg parser is stable
         manage.get_args()
+
+
+class TestPopulate(unittest.TestCase):
+
+    def setUp(self):
+        utils.env.setup()
+
+    def tearDown(self):
+        utils.env.teardown()
+        db_session.remove()
+
+    def test_populate(self):
+        args = vars(manage.get_args().parse_args(
+            ['populate', '--sources', '3', '--batch-size', '2',
+             '--max-size', '1024', '--unread-ratio', '1']))
+        args.pop('func')(**args)
+
+        sources = Source.query.all()
+        self.assertEqual(len(sources), 3)
+        for source in sources:
+            self.assertTrue(source.submissions)
+            for item in source.collection:
+                self.assertTrue(512 <= item.size <= 1024)
+                self.assertTrue(os.path.isfile(
+                    store.path(source.filesystem_id, item.filename)))
+        self.assertFalse(Submission.query.filter_by(downloaded=True).count())
+
+    def _populate(self, seed):
+        """Populate with `seed`, and return what was added."""
+        manage.populate(sources=3, max_size=1024, batch_size=2, seed=seed)
+        added = []
+        for source in Source.query.order_by(Source.filesystem_id):
+            items = []
+            for item in source.collection:
+                with open(store.path(source.filesystem_id,
+                                     item.filename), 'rb') as f:
+                    items.append((item.filename, f.read()))
+            added.append((source.filesystem_id,
+                          source.journalist_designation, source.flagged,
+                          bool(source.star), items))
+        return added
+
+    def test_populate_with_seed_is_reproducible(self):
+        added = self._populate(seed=1)
+        utils.env.teardown()
+        db_session.remove()
+        utils.env.setup()
+        self.assertEqual(self._populate(seed=1), added)
+        utils.env.teardown()
+        db_session.remove()
+        utils.env.setup()
+        self.assertNotEqual(self._populate(seed=2), added)
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import unittest
+
+from flask import Flask, g
+
+# Set environment variable so config.py uses a test environment
+os.environ['SECUREDROP_ENV'] = 'test'
+import metrics
+
+
+class TestMetrics(unittest.TestCase):
+
+    """The set of tests for metrics.py."""
+
+    def setUp(self):
+        self.app = Flask(__name__)
+
+    def test_nested_time_counts_towards_innermost_timer(self):
+        with self.app.test_request_context():
+            g.request_timings = metrics.RequestTimings()
+            with metrics.timer('store'):
+                time.sleep(0.01)
+                with metrics.timer('gpg'):
+                    time.sleep(0.05)
+            totals = g.request_timings.totals
+        self.assertTrue(0.05 <= totals['gpg'])
+        self.assertTrue(0.01 <= totals['store'] < 0.05)
+
+    def test_timer_without_request(self):
+        @metrics.timed('gpg')
+        def func():
+            return 'result'
+        self.assertEqual(func(), 'result')
+
+    def test_server_timing(self):
+        self.assertEqual(metrics.server_timing({'sql': 0.0012}, 0.5),
+                         'sql;dur=1.2, total;dur=500.0')
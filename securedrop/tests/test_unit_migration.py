@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from datetime import datetime
+import imp
+import mock
+import os
+import shutil
+import sqlite3
+import sys
+import tarfile
+import tempfile
+import unittest
+
+# Set environment variable so config.py uses a test environment
+os.environ['SECUREDROP_ENV'] = 'test'
+import config
+from db import db_session, init_db, Source
+import utils
+
+MIGRATION_DIR = os.path.join(config.SECUREDROP_ROOT, '..', 'migration_scripts',
+                             '0.2.1')
+sys.path.append(MIGRATION_DIR)
+migrate = imp.load_source('migrate_0_3',
+                          os.path.join(MIGRATION_DIR, '0.3_migrate.py'))
+
+
+class TestMigration(unittest.TestCase):
+
+    """The set of tests for migration_scripts/0.2.1/0.3_migrate.py."""
+
+    def setUp(self):
+        utils.env.create_directories()
+        init_db()
+        utils.db_helper.init_journalist()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmp_dir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp_dir)
+        utils.env.teardown()
+        db_session.remove()
+
+    def _make_backup(self):
+        """Make a backup of a 0.2.1 instance whose database doesn't know any
+        of the sources, like most of them."""
+        old_db = os.path.join(self.tmp_dir, 'db.sqlite')
+        conn = sqlite3.connect(old_db)
+        conn.execute('CREATE TABLE sources (filesystem_id VARCHAR(96), '
+                     'journalist_designation VARCHAR(255))')
+        conn.commit()
+        conn.close()
+        backup_fn = os.path.join(self.tmp_dir, 'backup.tar.gz')
+        with tarfile.open(backup_fn, 'w:gz') as backup:
+            backup.add(old_db,
+                       'var/chroot/document/var/www/securedrop/db.sqlite')
+        return backup_fn
+
+    def _add_source(self, filesystem_id, submission_mtimes):
+        source_dir = os.path.join(config.STORE_DIR, filesystem_id)
+        os.mkdir(source_dir)
+        for i, mtime in enumerate(submission_mtimes):
+            fn = os.path.join(source_dir, '{}-msg.gpg'.format(i))
+            with open(fn, 'w') as f:
+                f.write('ciphertext')
+            os.utime(fn, (mtime, mtime))
+
+    @mock.patch('subprocess.call')
+    def test_every_source_gets_last_updated(self, call):
+        # Sources without submissions come both before and after sources
+        # with them, within the same batch
+        self._add_source('A', [])
+        self._add_source('B', [1400000000, 1400000100])
+        self._add_source('C', [])
+        self._add_source('D', [1400000200])
+        self._add_source('E', [])
+        before = datetime.utcnow().replace(microsecond=0)
+
+        checkpoint_fn = os.path.join(self.tmp_dir, 'checkpoint.json')
+        with mock.patch.multiple(migrate, STORE_DIR=config.STORE_DIR,
+                                 DB_FN=config.DATABASE_FILE,
+                                 CHECKPOINT_FN=checkpoint_fn, BATCH_SIZE=3):
+            with tarfile.open(self._make_backup()) as backup:
+                migrate.migrate_database(backup)
+
+        sources = dict((source.filesystem_id, source)
+                       for source in Source.query.all())
+        self.assertEqual(sorted(sources), ['A', 'B', 'C', 'D', 'E'])
+        self.assertEqual(sources['B'].last_updated,
+                         datetime.utcfromtimestamp(1400000100))
+        self.assertEqual(sources['D'].last_updated,
+                         datetime.utcfromtimestamp(1400000200))
+        for filesystem_id in ('A', 'C', 'E'):
+            self.assertTrue(sources[filesystem_id].pending)
+            self.assertTrue(sources[filesystem_id].last_updated >= before)
+        self.assertFalse(os.path.exists(checkpoint_fn))
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
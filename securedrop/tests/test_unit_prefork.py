@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import Queue
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import unittest
+import urllib2
+
+# Set environment variable so config.py uses a test environment
+os.environ['SECUREDROP_ENV'] = 'test'
+import prefork
+import utils
+
+PREFORK = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                       'prefork.py')
+
+
+class TestPrefork(unittest.TestCase):
+
+    """The set of tests for prefork.py, which run it the way it's deployed,
+    in a process of its own."""
+
+    def setUp(self):
+        utils.env.setup()
+        # Let the OS pick a free port
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.port = sock.getsockname()[1]
+        sock.close()
+
+        # In a process group of its own, so tearDown can stop the workers
+        # even if the server didn't
+        self.server = subprocess.Popen(
+            [sys.executable, PREFORK, 'source', '--port', str(self.port),
+             '--workers', '2'], stderr=subprocess.PIPE, preexec_fn=os.setsid)
+        self.log = Queue.Queue()
+        reader = threading.Thread(target=self._read_log)
+        reader.daemon = True
+        reader.start()
+
+    def tearDown(self):
+        prefork.kill(-self.server.pid)
+        self.server.wait()
+        utils.env.teardown()
+
+    def _read_log(self):
+        for line in iter(self.server.stderr.readline, ''):
+            self.log.put(line)
+
+    def wait_for_log(self, text, timeout=30):
+        deadline = time.time() + timeout
+        while True:
+            line = self.log.get(timeout=max(0, deadline - time.time()))
+            if text in line:
+                return line
+
+    def get_index(self):
+        return urllib2.urlopen('http://127.0.0.1:{}/'.format(self.port),
+                               timeout=10).getcode()
+
+    def test_reload_keeps_listening_socket(self):
+        self.wait_for_log('Serving source')
+        self.assertEqual(self.get_index(), 200)
+
+        self.server.send_signal(signal.SIGHUP)
+        self.wait_for_log('Reloading')
+        self.wait_for_log('Serving source')
+        # Give the old workers time to notice they've been asked to exit, so
+        # the request is handled by a new one, on the socket it inherited
+        time.sleep(2 * prefork.POLL_INTERVAL)
+        # The server re-executed itself, rather than exiting
+        self.assertIsNone(self.server.poll())
+        self.assertEqual(self.get_index(), 200)
+
+        self.server.terminate()
+        self.assertEqual(self.server.wait(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import mock
+import unittest
+
+from flask import Flask, session
+
+from server_session import (ServerSideSessionInterface, MemorySessionStore,
+                            RedisSessionStore)
+import worker
+
+
+class TestServerSideSession(unittest.TestCase):
+
+    """The set of tests for server_session.py."""
+
+    def setUp(self):
+        self.store = MemorySessionStore()
+        self.app = Flask(__name__)
+        self.app.secret_key = 'secret key'
+        self.app.session_interface = ServerSideSessionInterface(
+            self.store, client_keys=('client_value',))
+
+        @self.app.route('/set/<value>')
+        def set_value(value):
+            session['value'] = value
+            return ''
+
+        @self.app.route('/get')
+        def get_value():
+            return session.get('value', '')
+
+        @self.app.route('/set_client/<value>')
+        def set_client_value(value):
+            session['client_value'] = value
+            return ''
+
+        @self.app.route('/get_client')
+        def get_client_value():
+            return session.get('client_value', '')
+
+        @self.app.route('/regenerate')
+        def regenerate():
+            session.regenerate()
+            return ''
+
+        @self.app.route('/clear')
+        def clear():
+            session.clear()
+            return ''
+
+        self.client = self.app.test_client()
+
+    def test_session_data_is_kept_on_server(self):
+        resp = self.client.get('/set/secret')
+        self.assertNotIn('secret', resp.headers['Set-Cookie'])
+        self.assertEqual(len(self.store.sessions), 1)
+        self.assertEqual(self.client.get('/get').data, 'secret')
+
+    def test_empty_session_is_not_stored(self):
+        resp = self.client.get('/get')
+        self.assertNotIn('Set-Cookie', resp.headers)
+        self.assertEqual(self.store.sessions, {})
+
+    def test_clear_deletes_stored_session(self):
+        self.client.get('/set/secret')
+        self.client.get('/clear')
+        self.assertEqual(self.store.sessions, {})
+        self.assertEqual(self.client.get('/get').data, '')
+
+    def test_revoke_all(self):
+        self.client.get('/set/secret')
+        self.app.session_interface.revoke_all()
+        self.assertEqual(self.client.get('/get').data, '')
+
+    def test_expired_session_is_discarded(self):
+        self.app.session_interface.ttl = -1
+        self.client.get('/set/secret')
+        self.assertEqual(self.client.get('/get').data, '')
+
+    def test_client_values_are_not_stored(self):
+        self.client.get('/set/server')
+        resp = self.client.get('/set_client/secret')
+        self.assertNotIn('secret', self.store.sessions.values()[0][0])
+        self.assertIn('session_c=', resp.headers['Set-Cookie'])
+        self.assertEqual(self.client.get('/get_client').data, 'secret')
+        self.assertEqual(self.client.get('/get').data, 'server')
+
+    def test_client_values_are_revoked_with_session(self):
+        self.client.get('/set_client/secret')
+        self.app.session_interface.revoke_all()
+        self.assertEqual(self.client.get('/get_client').data, '')
+
+    def test_tampered_client_values_are_ignored(self):
+        self.client.get('/set_client/secret')
+        self.client.set_cookie('localhost', 'session_c', 'tampered')
+        self.assertEqual(self.client.get('/get_client').data, '')
+
+    def test_regenerate(self):
+        self.client.get('/set/secret')
+        old_ids = set(self.store.sessions)
+        self.client.get('/regenerate')
+        self.assertEqual(len(self.store.sessions), 1)
+        self.assertNotEqual(set(self.store.sessions), old_ids)
+        self.assertEqual(self.client.get('/get').data, 'secret')
+
+    def test_redis_store(self):
+        redis = mock.Mock(spec=worker.redis)
+        store = RedisSessionStore(redis, prefix='test:')
+        store.set('abc', 'value', 60)
+        redis.setex.assert_called_once_with('test:abc', 'value', 60)
+        store.get('abc')
+        redis.get.assert_called_once_with('test:abc')
+        store.delete('abc')
+        redis.delete.assert_called_once_with('test:abc')
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
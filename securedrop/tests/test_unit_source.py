@@ -76,6 +76,13 @@ class TestSourceApppp(TestCase):
             })
             self.assertEqual(response.status_code, 403)
 
+    def test_generate_unique_codename_skips_taken(self):
+        source_obj, codename = utils.db_helper.init_source()
+        with patch('crypto_util.genrandomid',
+                   side_effect=[codename, 'fresh codename']):
+            self.assertEqual(source.generate_unique_codename(7),
+                             'fresh codename')
+
     def test_generate_has_login_link(self):
         """The generate page should have a link to remind people to login
            if they already have a codename, rather than create a new one.
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+from flask import Flask
+from flask_assets import Environment, Bundle
+
+# Set environment variable so config.py uses a test environment
+os.environ['SECUREDROP_ENV'] = 'test'
+import static_files
+
+
+class TestStaticFiles(unittest.TestCase):
+
+    """The set of tests for static_files.py."""
+
+    def setUp(self):
+        self.static_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.static_dir, 'css'))
+        with open(os.path.join(self.static_dir, 'css', 'a.css'), 'w') as f:
+            f.write('body { color: black; }\n' * 100)
+        with open(os.path.join(self.static_dir, 'logo.png'), 'wb') as f:
+            f.write('\x89PNG')
+
+        self.app = Flask(__name__, static_folder=self.static_dir,
+                         static_url_path='/static')
+        self.assets = Environment(self.app)
+        self.assets.register('a_css', Bundle(
+            'css/a.css', output='gen/a.%(version)s.css'))
+        static_files.init_app(self.app, self.assets)
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        shutil.rmtree(self.static_dir)
+
+    def _bundle_url(self):
+        with self.app.test_request_context():
+            return self.assets['a_css'].urls()[0]
+
+    def test_compress(self):
+        self.assertEqual(static_files.compress(self.static_dir), 1)
+        gz_path = os.path.join(self.static_dir, 'css', 'a.css.gz')
+        with gzip.open(gz_path) as f:
+            self.assertEqual(f.read(), 'body { color: black; }\n' * 100)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.static_dir, 'logo.png.gz')))
+        # Up to date copies are left alone
+        self.assertEqual(static_files.compress(self.static_dir), 0)
+
+    def test_bundle_url_is_hashed(self):
+        url = self._bundle_url()
+        self.assertRegexpMatches(url, r'^/static/gen/a\.[0-9a-f]{8}\.css$')
+
+    def test_hashed_bundle_is_cached_for_good(self):
+        response = self.client.get(self._bundle_url())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.cache_control.max_age,
+                         static_files.HASHED_MAX_AGE)
+        self.assertIn('immutable', response.headers['Cache-Control'])
+
+    def test_unhashed_file_is_not_cached_for_good(self):
+        response = self.client.get('/static/css/a.css')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('immutable',
+                         response.headers.get('Cache-Control', ''))
+
+    def test_gzipped_copy_is_sent_if_accepted(self):
+        static_files.compress(self.static_dir)
+        response = self.client.get('/static/css/a.css',
+                                   headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.mimetype, 'text/css')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+
+        response = self.client.get('/static/css/a.css')
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.data, 'body { color: black; }\n' * 100)
@@ -2,9 +2,12 @@
 # -*- coding: utf-8 -*-
 
 import os
+import subprocess
 import unittest
 import zipfile
 
+import mock
+
 import crypto_util
 # Set environment variable so config.py uses a test environment
 os.environ['SECUREDROP_ENV'] = 'test'
@@ -58,5 +61,63 @@ class TestStore(unittest.TestCase):
                                                   new_journalist_filename)
         self.assertEquals(actual_filename, expected_filename)
 
+    def test_unread_archive(self):
+        source, _ = utils.db_helper.init_source()
+        sid = source.filesystem_id
+        filenames = [s.filename for s in utils.db_helper.submit(source, 3)]
+
+        store.update_unread_archive(sid, 'unread', filenames[:2])
+        # New submissions are added to the existing archive
+        store.update_unread_archive(sid, 'unread', filenames)
+        archive = zipfile.ZipFile(store.unread_archive_path(sid))
+        self.assertEqual(sorted(archive.namelist()),
+                         [os.path.join('unread', fn) for fn in filenames])
+
+        # An archive that doesn't match the unread submissions isn't used
+        self.assertIsNone(
+            store.take_unread_archive(sid, 'unread', filenames[1:]))
+        self.assertFalse(os.path.exists(store.unread_archive_path(sid)))
+
+        # Downloaded submissions are removed from the archive
+        store.update_unread_archive(sid, 'unread', filenames)
+        store.update_unread_archive(sid, 'unread', filenames[1:])
+        zf = store.take_unread_archive(sid, 'unread', filenames[1:])
+        self.assertEqual(sorted(zipfile.ZipFile(zf).namelist()),
+                         [os.path.join('unread', fn) for fn in filenames[1:]])
+        self.assertFalse(os.path.exists(store.unread_archive_path(sid)))
+
+    def test_secure_unlink_many(self):
+        source, _ = utils.db_helper.init_source()
+        submissions = utils.db_helper.submit(source, 3)
+        paths = [store.path(source.filesystem_id, submission.filename)
+                 for submission in submissions]
+        store.secure_unlink_many(paths)
+        for path in paths:
+            self.assertFalse(os.path.exists(path))
+        # Paths that are already gone are skipped
+        self.assertEqual(store.secure_unlink_many(paths), "success")
+
+    def test_secure_unlink_many_reports_failures(self):
+        source, _ = utils.db_helper.init_source()
+        submissions = utils.db_helper.submit(source, 3)
+        paths = [store.path(source.filesystem_id, submission.filename)
+                 for submission in submissions]
+
+        def srm(command):
+            # Fail to delete the first path, but delete the others
+            for path in command[1:]:
+                if path == paths[0]:
+                    raise subprocess.CalledProcessError(1, command)
+                os.remove(path)
+
+        with mock.patch('subprocess.check_call', side_effect=srm):
+            with self.assertRaises(store.DeletionException) as cm:
+                store.secure_unlink_many(paths)
+        self.assertEqual(cm.exception.failures.keys(), [paths[0]])
+        self.assertTrue(os.path.exists(paths[0]))
+        self.assertFalse(os.path.exists(paths[1]))
+        self.assertFalse(os.path.exists(paths[2]))
+
+
 if __name__ == "__main__":
     unittest.main(verbosity=2)
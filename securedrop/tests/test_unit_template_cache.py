@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from mock import patch
+import os
+import shutil
+import tempfile
+import unittest
+
+import journalist
+import source
+import template_cache
+import utils
+
+
+class TestTemplateCache(unittest.TestCase):
+
+    """The set of tests for template_cache.py."""
+
+    def setUp(self):
+        utils.env.setup()
+        self.cache_dir = tempfile.mkdtemp()
+        self.caches = {}
+        for app in (source.app, journalist.app):
+            self.caches[app] = app.jinja_env.bytecode_cache
+            template_cache.init_app(app, self.cache_dir)
+
+    def tearDown(self):
+        for app, cache in self.caches.items():
+            app.jinja_env.bytecode_cache = cache
+            app.jinja_env.cache.clear()
+        shutil.rmtree(self.cache_dir)
+        utils.env.teardown()
+
+    def _compile_and_forget(self, app):
+        """Compile `app`'s templates into the cache, then forget them, as if
+        this were a new process."""
+        template_cache.compile_templates(app)
+        app.jinja_env.cache.clear()
+
+    def test_cache_key_is_relative_to_securedrop_root(self):
+        cache = template_cache.BytecodeCache(self.cache_dir)
+        filename = os.path.join(template_cache.config.SECUREDROP_ROOT,
+                                'source_templates', 'index.html')
+        self.assertEqual(cache.get_cache_key('index.html', filename),
+                         cache.get_cache_key(
+                             'index.html',
+                             os.path.join('source_templates', 'index.html')))
+
+    def test_compile_templates_fills_cache(self):
+        template_cache.compile_templates(source.app)
+        self.assertEqual(len(os.listdir(self.cache_dir)),
+                         len(source.app.jinja_env.list_templates()))
+
+    def test_no_compilation_after_warm_up(self):
+        for app in (source.app, journalist.app):
+            self._compile_and_forget(app)
+        with patch('jinja2.Environment.compile',
+                   side_effect=AssertionError('template was compiled')):
+            for app in (source.app, journalist.app):
+                for name in app.jinja_env.list_templates():
+                    app.jinja_env.get_template(name)
+            self.assertEqual(source.app.test_client().get('/').status_code,
+                             200)
+            self.assertEqual(
+                journalist.app.test_client().get('/login').status_code, 200)
+
+    def test_unwritable_cache_dir(self):
+        with patch('jinja2.FileSystemBytecodeCache.dump_bytecode',
+                   side_effect=IOError(13, 'Permission denied')):
+            template_cache.compile_templates(source.app)
+        self.assertEqual(os.listdir(self.cache_dir), [])
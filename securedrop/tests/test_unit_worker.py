@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import unittest
+
+import mock
+from rq import Queue
+
+# Set environment variable so config.py uses a test environment
+os.environ['SECUREDROP_ENV'] = 'test'
+import store
+import worker
+
+
+def fail():
+    raise ValueError
+
+
+class TestMetricsWorker(unittest.TestCase):
+
+    """The set of tests for MetricsWorker and metrics_text."""
+
+    def setUp(self):
+        # Use a queue of our own, so the test worker doesn't run our jobs
+        self.queue = Queue('metrics_test', connection=worker.redis)
+        self.worker = worker.MetricsWorker([self.queue],
+                                           connection=worker.redis)
+        # Don't leave the failed jobs in the failed queue
+        self.worker.push_exc_handler(lambda job, *exc_info: False)
+
+    def tearDown(self):
+        self.queue.empty()
+        for key in worker.redis.scan_iter(worker.METRICS_PREFIX + '*'):
+            worker.redis.delete(key)
+
+    def test_records_jobs(self):
+        job = self.queue.enqueue(os.getpid)
+        self.assertTrue(self.worker.perform_job(job, self.queue))
+        job = self.queue.enqueue(fail)
+        self.assertFalse(self.worker.perform_job(job, self.queue))
+
+        text = worker.metrics_text()
+        self.assertIn('securedrop_worker_job_run_seconds_count'
+                      '{function="posix.getpid"} 1', text)
+        self.assertIn('securedrop_worker_jobs_failed_total'
+                      '{function="test_unit_worker.fail"} 1', text)
+        self.assertIn('securedrop_worker_jobs_timed_out_total'
+                      '{function="test_unit_worker.fail"} 0', text)
+
+
+class TestEnqueue(unittest.TestCase):
+
+    def test_queue_names(self):
+        self.assertEqual(worker.queue_names(),
+                         ['test_high', 'test_default', 'test_bulk'])
+
+    def test_enqueue_by_job_type(self):
+        with mock.patch.object(worker.queues['bulk'], 'enqueue') as enqueue:
+            worker.enqueue(store.delete_source_directory, 'sid')
+        enqueue.assert_called_once_with(store.delete_source_directory, 'sid')
+
+    def test_enqueue_other_jobs_to_default_queue(self):
+        with mock.patch.object(worker.queues['default'],
+                               'enqueue') as enqueue:
+            worker.enqueue(os.getpid)
+        enqueue.assert_called_once_with(os.getpid)
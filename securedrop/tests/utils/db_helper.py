@@ -56,7 +56,8 @@ def reply(journalist, source, num_replies):
                                 crypto_util.getkey(source.filesystem_id),
                                 config.JOURNALIST_KEY
                             ],
-                            store.path(source.filesystem_id, fname))
+                            store.path(source.filesystem_id, fname),
+                            sid=source.filesystem_id)
         reply = db.Reply(journalist, source, fname)
         replies.append(reply)
         db.db_session.add(reply)
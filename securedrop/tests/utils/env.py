@@ -12,6 +12,7 @@ os.environ['SECUREDROP_ENV'] = 'test'
 import config
 import crypto_util
 from db import init_db
+import worker
 
 # TODO: the PID file for the redis worker is hard-coded below.  Ideally this
 # constant would be provided by a test harness.  It has been intentionally
@@ -50,8 +51,8 @@ def setup():
     crypto_util.do_runtime_tests()
     # Start the Python-RQ worker if it's not already running
     if not os.path.exists(TEST_WORKER_PIDFILE):
-        subprocess.Popen(["rqworker",
-                          "-P", config.SECUREDROP_ROOT,
+        subprocess.Popen(["rqworker"] + worker.queue_names() +
+                         ["-P", config.SECUREDROP_ROOT,
                           "--pid", TEST_WORKER_PIDFILE])
 
 
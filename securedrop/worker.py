@@ -1,14 +1,171 @@
 import os
+import time
 
 from redis import Redis
-from rq import Queue
+from rq import Queue, Worker
+from rq.timeouts import JobTimeoutException
+from rq.utils import utcnow
 
-queue_name = 'test' if os.environ.get(
-    'SECUREDROP_ENV') == 'test' else 'default'
+# Shared connection for the job queues and for other short-lived state that
+# should be visible to every app process (e.g. login throttling)
+redis = Redis()
 
-# `srm` can take a long time on large files, so allow it run for up to an hour
-q = Queue(name=queue_name, connection=Redis(), default_timeout=3600)
+# The job queues, highest priority first, with the timeouts of their jobs in
+# seconds. A worker listening on several queues always runs the next job from
+# the first of them that has one, and supervisor runs a separate worker for
+# the bulk queue so long deletions don't hold up other jobs.
+QUEUES = (
+    # Jobs a journalist may be waiting for
+    ('high', 600),
+    # `srm` can take a long time on large files, so allow it run for up to an
+    # hour
+    ('default', 3600),
+    # Deleting whole collections, which can be several GB
+    ('bulk', 4 * 3600),
+)
 
+# The queue for each kind of job, by function name. Other jobs go to the
+# default queue.
+JOB_QUEUES = {
+    'store.update_unread_archive': 'high',
+    'store.secure_unlink': 'default',
+    'store.secure_unlink_many': 'default',
+    'store.delete_source_directory': 'bulk',
+    'store.delete_source_directories': 'bulk',
+}
 
-def enqueue(*args, **kwargs):
-    return q.enqueue(*args, **kwargs)
+TEST_QUEUE_PREFIX = 'test_'
+_prefix = (TEST_QUEUE_PREFIX if os.environ.get('SECUREDROP_ENV') == 'test'
+           else '')
+queues = dict((name, Queue(name=_prefix + name, connection=redis,
+                           default_timeout=timeout))
+              for name, timeout in QUEUES)
+
+
+def queue_names():
+    """Return the names of the queues, highest priority first, as passed to
+    rqworker."""
+    return [queues[name].name for name, _ in QUEUES]
+
+
+def enqueue(func, *args, **kwargs):
+    """Add a job calling `func` to the queue for its kind of job."""
+    name = '{}.{}'.format(func.__module__, func.__name__)
+    return queues[JOB_QUEUES.get(name, 'default')].enqueue(func, *args,
+                                                           **kwargs)
+
+
+# Job wait and run times are counted in histogram buckets with these upper
+# bounds, in seconds. The last one is the longest job timeout.
+METRICS_BUCKETS = (0.1, 1, 10, 60, 300, 900, 3600, 4 * 3600)
+
+# Counts for each job function are kept in a Redis hash named like
+# "worker_metrics:store.delete_source_directory"
+METRICS_PREFIX = 'worker_metrics:'
+
+
+def _add_to_histogram(pipe, key, name, seconds):
+    # Buckets are cumulative, as in Prometheus' histograms
+    for bucket in METRICS_BUCKETS:
+        if seconds <= bucket:
+            pipe.hincrby(key, '{}_le_{}'.format(name, bucket), 1)
+    pipe.hincrby(key, name + '_count', 1)
+    pipe.hincrbyfloat(key, name + '_sum', seconds)
+
+
+class MetricsWorker(Worker):
+
+    """A worker that records how long each job waited in the queue and took
+    to run, and whether it failed or timed out, for `metrics_text`. Run it
+    with `rqworker --worker-class worker.MetricsWorker`."""
+
+    def perform_job(self, job, queue):
+        wait = (utcnow() - (job.enqueued_at or utcnow())).total_seconds()
+        self._exc_type = None
+        start = time.time()
+        success = super(MetricsWorker, self).perform_job(job, queue)
+        run = time.time() - start
+
+        key = METRICS_PREFIX + job.func_name
+        pipe = self.connection.pipeline(transaction=False)
+        _add_to_histogram(pipe, key, 'wait', wait)
+        _add_to_histogram(pipe, key, 'run', run)
+        if not success:
+            pipe.hincrby(key, 'failed', 1)
+            if self._exc_type is JobTimeoutException:
+                pipe.hincrby(key, 'timed_out', 1)
+        try:
+            pipe.execute()
+        except Exception as e:
+            self.log.warning("Couldn't record job metrics: {}".format(e))
+        return success
+
+    def handle_exception(self, job, *exc_info):
+        self._exc_type = exc_info[0]
+        super(MetricsWorker, self).handle_exception(job, *exc_info)
+
+
+def _labels(**labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, value)
+                          for name, value in sorted(labels.items())) + '}'
+
+
+def metrics_text():
+    """Return the queue's depth and the metrics recorded by MetricsWorker, in
+    Prometheus' text format."""
+    lines = []
+
+    def metric(name, metric_type, help_text, samples):
+        lines.append('# HELP securedrop_worker_{} {}'.format(name, help_text))
+        lines.append('# TYPE securedrop_worker_{} {}'.format(name,
+                                                             metric_type))
+        for suffix, labels, value in samples:
+            lines.append('securedrop_worker_{}{}{} {}'.format(
+                name, suffix, _labels(**labels), value))
+
+    depths = []
+    oldest_ages = []
+    for name, _ in QUEUES:
+        queue = queues[name]
+        oldest_age = 0
+        job_ids = queue.get_job_ids(0, 1)
+        if job_ids:
+            job = queue.fetch_job(job_ids[0])
+            if job is not None and job.enqueued_at is not None:
+                oldest_age = (utcnow() - job.enqueued_at).total_seconds()
+        depths.append(('', dict(queue=queue.name), queue.count))
+        oldest_ages.append(('', dict(queue=queue.name), oldest_age))
+    metric('queue_depth', 'gauge', 'Jobs waiting to be run.', depths)
+    metric('oldest_job_age_seconds', 'gauge',
+           'How long the next job to be run has been waiting.', oldest_ages)
+    metric('failed_queue_depth', 'gauge',
+           'Failed jobs that have not been requeued or deleted.',
+           [('', {}, Queue('failed', connection=redis).count)])
+
+    functions = {}
+    for key in redis.scan_iter(METRICS_PREFIX + '*'):
+        functions[key[len(METRICS_PREFIX):]] = redis.hgetall(key)
+    for name, help_text in (('failed', 'Jobs that failed.'),
+                            ('timed_out', 'Jobs that ran out of time.')):
+        metric('jobs_{}_total'.format(name), 'counter', help_text,
+               [('', dict(function=function), values.get(name, 0))
+                for function, values in sorted(functions.items())])
+    for name, help_text in (
+            ('wait', 'How long jobs waited in the queue.'),
+            ('run', 'How long jobs took to run.')):
+        samples = []
+        for function, values in sorted(functions.items()):
+            for bucket in METRICS_BUCKETS:
+                samples.append(
+                    ('_bucket', dict(function=function, le=bucket),
+                     values.get('{}_le_{}'.format(name, bucket), 0)))
+            samples.append(('_bucket', dict(function=function, le='+Inf'),
+                            values.get(name + '_count', 0)))
+            samples.append(('_sum', dict(function=function),
+                            values.get(name + '_sum', 0)))
+            samples.append(('_count', dict(function=function),
+                            values.get(name + '_count', 0)))
+        metric('job_{}_seconds'.format(name), 'histogram', help_text, samples)
+    return '\n'.join(lines) + '\n'
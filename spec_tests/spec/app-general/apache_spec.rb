@@ -117,6 +117,21 @@ common_apache2_directory_declarations = <<eos
   </LimitExcept>
 </Directory>
 eos
+
+# declare static file caching and compression settings, common to the
+# source and journalist interfaces.
+common_apache2_static_declarations = <<eos
+<LocationMatch "^/static/gen/[^/]+\\.[0-9a-f]{8}\\.(css|js)(\\.gz)?$">
+  Header set Cache-Control "public, max-age=31536000, immutable"
+</LocationMatch>
+
+# Send the gzipped copies of the static files (made when the package is
+# built) to clients that accept them.
+RewriteCond %{HTTP:Accept-Encoding} gzip
+RewriteCond #{property['securedrop_code']}/static/$1.gz -f
+RewriteRule ^/static/(.+\\.(css|js|svg))$ /static/$1.gz [PT,E=no-gzip:1]
+eos
+
 # declare desired apache2 available sites
 apache2_available_sites = [
   '/etc/apache2/sites-available/journalist.conf',
@@ -133,6 +148,7 @@ apache2_available_sites.each do |apache2_available_site|
       its(:content) { should match /^#{apache2_common_header_regex}$/ }
     end
     its(:content) { should contain(common_apache2_directory_declarations) }
+    its(:content) { should contain(common_apache2_static_declarations) }
   end
 end
 
@@ -180,6 +196,8 @@ journalist_apache2_config_settings = [
   'XSendFile        On',
   'XSendFilePath    /var/lib/securedrop/store/',
   'XSendFilePath    /var/lib/securedrop/tmp/',
+  '<LocationMatch "^/(col/[^/]+/[^/]+|bulk)$">',
+  '  Header set Cache-Control "private, no-cache"',
   'ErrorLog /var/log/apache2/journalist-error.log',
   'CustomLog /var/log/apache2/journalist-access.log combined',
 ]
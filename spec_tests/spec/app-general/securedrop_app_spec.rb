@@ -49,6 +49,16 @@ describe cron do
   it { should have_entry "@daily #{property['securedrop_code']}/manage.py clean-tmp" }
 end
 
+# ensure cron job for pruning journalist login attempts is enabled
+describe cron do
+  it { should have_entry "@hourly #{property['securedrop_code']}/manage.py prune-login-attempts" }
+end
+
+# ensure cron job for compacting the gpg keyring is enabled
+describe cron do
+  it { should have_entry "@weekly #{property['securedrop_code']}/manage.py compact-keyrings" }
+end
+
 # ensure directory for worker logs is present
 describe file('/var/log/securedrop_worker') do
   it { should be_directory }
@@ -23,6 +23,42 @@ end
   end
 end
 
+# The apps fail at import if apache2 can't read one of their modules, so
+# every module they import must be listed
+apache2_app_modules = %w(
+  metrics
+  server_session
+  static_files
+  template_cache
+)
+apache2_app_rules = apache2_app_modules.map do |app_module|
+  [
+    "/var/www/securedrop/#{app_module}.py r,",
+    "/var/www/securedrop/#{app_module}.pyc rw,",
+  ]
+end.flatten
+apache2_app_rules += [
+  # The templates compiled when the package was built
+  '/var/www/securedrop/template_cache/ r,',
+  '/var/www/securedrop/template_cache/** r,',
+  # The hashed asset bundles and the gzipped copies of the static files
+  '/var/www/securedrop/static/gen/ r,',
+  '/var/www/securedrop/static/gen/** r,',
+  '/var/www/securedrop/static/**.gz r,',
+  # The app keeps each source's reply keypair in a keyring of its own, under
+  # keys/sources/<shard>/<filesystem id>/, which apache2 must be able to
+  # create, lock and delete
+  '/var/lib/securedrop/keys/sources/ rw,',
+  '/var/lib/securedrop/keys/sources/** rwkl,',
+  # Changes to the reply keypairs are serialized with flock on this file
+  '/var/lib/securedrop/keys/.keyring.lock rwk,',
+]
+describe file('/etc/apparmor.d/usr.sbin.apache2') do
+  apache2_app_rules.each do |rule|
+    its(:content) { should contain(rule) }
+  end
+end
+
 # declare expected app-armor capabilities for apache2
 apache2_capabilities = %w(
   kill
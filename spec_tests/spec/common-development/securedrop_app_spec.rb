@@ -74,15 +74,27 @@ end
 # declare config options for securedrop worker
 securedrop_worker_config_options = [
   '[program:securedrop_worker]',
-  'command=/usr/local/bin/rqworker',
+  'command=/usr/local/bin/rqworker --worker-class worker.MetricsWorker high default',
+  'process_name=%(program_name)s_%(process_num)02d',
   "directory=#{property['securedrop_code']}",
   'autostart=true',
   'autorestart=true',
   'startretries=3',
-  'stderr_logfile=/var/log/securedrop_worker/err.log',
-  'stdout_logfile=/var/log/securedrop_worker/out.log',
+  'stderr_logfile=/var/log/securedrop_worker/err_%(process_num)02d.log',
+  'stdout_logfile=/var/log/securedrop_worker/out_%(process_num)02d.log',
   "user=#{property['securedrop_user']}",
   'environment=HOME="/tmp/python-gnupg"',
+  '[program:securedrop_bulk_worker]',
+  'command=/usr/local/bin/rqworker --worker-class worker.MetricsWorker bulk',
+  'stderr_logfile=/var/log/securedrop_worker/bulk_err_%(process_num)02d.log',
+  'stdout_logfile=/var/log/securedrop_worker/bulk_out_%(process_num)02d.log',
+  '[program:securedrop_worker_metrics]',
+  "command=#{property['securedrop_code']}/manage.py worker-metrics",
+  'stderr_logfile=/var/log/securedrop_worker/metrics-err.log',
+  'stdout_logfile=/var/log/securedrop_worker/metrics-out.log',
+  '[program:securedrop_session_redis]',
+  'command=/usr/bin/redis-server --port 6380 --bind 127.0.0.1 --save "" --appendonly no',
+  'user=redis',
 ]
 # ensure securedrop worker config for supervisor is present
 describe file('/etc/supervisor/conf.d/securedrop_worker.conf') do
@@ -96,3 +108,11 @@ describe file('/etc/supervisor/conf.d/securedrop_worker.conf') do
   end
 end
 
+# ensure the Redis instance for source sessions never saves them to disk
+describe command('redis-cli -p 6380 config get save') do
+  its(:stdout) { should eq "save\n\n" }
+end
+describe command('redis-cli -p 6380 config get appendonly') do
+  its(:stdout) { should eq "appendonly\nno\n" }
+end
+
@@ -62,6 +62,12 @@ describe cron do
   it { should have_entry "@daily /vagrant/securedrop/manage.py clean-tmp" }
 end
 
+# ensure the keyring is compacted as the app user, so the compacted keyring
+# files stay readable by the app
+describe cron do
+  it { should have_entry("@weekly /vagrant/securedrop/manage.py compact-keyrings").with_user(property['securedrop_user']) }
+end
+
 
 # ensure default logo header file exists
 # TODO: add check for custom logo header file